@@ -0,0 +1,137 @@
+import click
+
+import os
+import random
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from PIL import Image
+
+from cosmoquest_data_tools.annotation_library import AnnotationLibrary
+
+
+# Storage settings under comparison. Chunk lengths are in rows
+STORAGE_SETTINGS = {
+    "default": {},
+    "gzip": {"compression": "gzip", "compression_opts": 4},
+    "gzip+shuffle": {"compression": "gzip", "compression_opts": 4, "shuffle": True},
+    "lzf": {"compression": "lzf"},
+    "lzf+shuffle": {"compression": "lzf", "shuffle": True},
+    "gzip+shuffle+large-chunks": {
+        "compression": "gzip",
+        "compression_opts": 4,
+        "shuffle": True,
+        "chunks": {"image_data": 1 << 20, "image_offsets": 16384, "shapes": 16384, "bounding_box_offsets": 16384, "bounding_boxes": 65536}
+    }
+}
+
+
+@click.command()
+@click.option("--entries", default=2000)
+@click.option("--image_size", default=450)
+@click.option("--bounding_boxes", default=40, help="Average bounding boxes per entry")
+@click.option("--reads", default=1000)
+@click.option("--seed", default=0)
+def benchmark(entries, image_size, bounding_boxes, reads, seed):
+    random.seed(seed)
+    np.random.seed(seed)
+
+    directory = tempfile.mkdtemp()
+
+    try:
+        print(f"Generating a synthetic library of {entries} {image_size}x{image_size} entries...", end="\n\n")
+        synthetic_entries = _generate_entries(directory, entries, image_size, bounding_boxes)
+
+        print(f"{'setting':<28}{'file size':>12}{'write/s':>10}{'write MB/s':>12}{'read p50':>11}{'read p95':>11}")
+
+        for name, storage in STORAGE_SETTINGS.items():
+            file_path = f"{directory}/{name}.alh5"
+
+            annotation_library = AnnotationLibrary(name, file_path=file_path, storage=storage)
+
+            start = time.perf_counter()
+
+            for entry in synthetic_entries:
+                annotation_library.add_complete_entry(dict(entry))
+
+            annotation_library.commit()
+            annotation_library.close()
+
+            write_time = time.perf_counter() - start
+            file_size = os.path.getsize(file_path)
+
+            # Random reads through a fresh handle, so nothing is served from HDF5's chunk cache of the writer
+            annotation_library = AnnotationLibrary.load(file_path, read_only=True)
+            keys = annotation_library.entries[:]
+
+            latencies = list()
+
+            for _ in range(reads):
+                key = random.choice(keys)
+
+                start = time.perf_counter()
+
+                annotation_library.get_image_bytes(key)
+                annotation_library.get_bounding_boxes_array(key)
+
+                latencies.append(time.perf_counter() - start)
+
+            annotation_library.close()
+
+            p50, p95 = np.percentile(latencies, [50, 95]) * 1000
+
+            print(
+                f"{name:<28}"
+                f"{file_size / 1024 / 1024:>10.1f}MB"
+                f"{len(synthetic_entries) / write_time:>10.0f}"
+                f"{file_size / 1024 / 1024 / write_time:>12.1f}"
+                f"{p50:>9.3f}ms"
+                f"{p95:>9.3f}ms"
+            )
+    finally:
+        shutil.rmtree(directory)
+
+
+# Smooth noise with crater-like dark discs, so PNG sizes are in the range of real data
+def _generate_entries(directory, count, image_size, bounding_boxes):
+    entries = list()
+
+    for i in range(count):
+        image = np.random.normal(128, 12, (image_size, image_size)).clip(0, 255)
+        entry_bounding_boxes = list()
+
+        for _ in range(np.random.poisson(bounding_boxes)):
+            radius = random.uniform(3, image_size / 10)
+            y = random.uniform(0, image_size)
+            x = random.uniform(0, image_size)
+
+            yy, xx = np.ogrid[:image_size, :image_size]
+            image[(yy - y) ** 2 + (xx - x) ** 2 < radius ** 2] *= 0.7
+
+            entry_bounding_boxes.append({
+                "top": y - radius,
+                "left": x - radius,
+                "bottom": y + radius,
+                "right": x + radius,
+                "annotation_class": "crater",
+                "meta": f"user_{random.randint(0, 50)}"
+            })
+
+        file_location = f"{directory}/image_{i}.png"
+        Image.fromarray(image.astype("uint8")).save(file_location)
+
+        entries.append({
+            "file_location": file_location,
+            "width": image_size,
+            "height": image_size,
+            "bounding_boxes": entry_bounding_boxes
+        })
+
+    return entries
+
+
+if __name__ == "__main__":
+    benchmark()
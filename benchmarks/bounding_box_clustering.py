@@ -0,0 +1,60 @@
+import click
+
+import time
+
+import numpy as np
+
+from sklearn.cluster import KMeans
+
+from cosmoquest_data_tools.helpers.algorithms import k_means_1d
+
+
+@click.command()
+@click.option("--group_sizes", default="6,20,50,200,1000", help="Bounding boxes per user group, comma-separated")
+@click.option("--groups", default=200, help="Groups per size")
+@click.option("--seed", default=0)
+def benchmark(group_sizes, groups, seed):
+    np.random.seed(seed)
+
+    print(f"{'boxes':>8}{'KMeans':>12}{'k_means_1d':>14}{'speedup':>10}{'SSE ratio':>12}")
+
+    for group_size in [int(group_size) for group_size in group_sizes.split(",")]:
+        areas = [_generate_areas(group_size) for _ in range(groups)]
+
+        # What cluster_bounding_boxes() used to run, for reference
+        start = time.perf_counter()
+        kmeans_labels = [KMeans(init="k-means++", n_clusters=2, n_init=100).fit(group_areas.reshape(-1, 1)).labels_ for group_areas in areas]
+        kmeans_time = (time.perf_counter() - start) / groups
+
+        start = time.perf_counter()
+        exact_labels = [k_means_1d(group_areas, 2)[0] for group_areas in areas]
+        exact_time = (time.perf_counter() - start) / groups
+
+        # Below 1 when the exact solution beats the restarts; never above
+        sse_ratio = sum(_sum_of_squares(a, l) for a, l in zip(areas, exact_labels)) / max(sum(_sum_of_squares(a, l) for a, l in zip(areas, kmeans_labels)), 1e-12)
+
+        print(
+            f"{group_size:>8}"
+            f"{kmeans_time * 1000:>10.2f}ms"
+            f"{exact_time * 1000:>12.3f}ms"
+            f"{kmeans_time / exact_time:>9.0f}x"
+            f"{sse_ratio:>12.4f}"
+        )
+
+
+# Volunteer marks on a crater: a tight cluster of accurate marks plus a looser one of sloppy (or other crater) marks
+def _generate_areas(group_size):
+    radius = np.random.uniform(5, 50)
+
+    accurate = np.random.normal(radius, radius * 0.05, group_size - group_size // 3)
+    sloppy = np.random.normal(radius * np.random.uniform(1.3, 2.0), radius * 0.2, group_size // 3)
+
+    return (2 * np.concatenate([accurate, sloppy]).clip(1, None)) ** 2
+
+
+def _sum_of_squares(values, labels):
+    return sum(((values[labels == label] - values[labels == label].mean()) ** 2).sum() for label in np.unique(labels))
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,98 @@
+import click
+
+import time
+
+import numpy as np
+
+from cosmoquest_data_tools.helpers.algorithms import batched_non_maximum_suppression, non_maximum_suppression, y1_ranks
+
+
+@click.command()
+@click.option("--group_sizes", default="6,20,50,200,1000", help="Bounding boxes per group, comma-separated")
+@click.option("--groups", default=200, help="Groups per size")
+@click.option("--overlap_threshold", default=0.1)
+@click.option("--seed", default=0)
+def benchmark(group_sizes, groups, overlap_threshold, seed):
+    np.random.seed(seed)
+
+    # First calls pay for numpy's lazy initialization
+    batched_non_maximum_suppression(_generate_bounding_boxes(10), overlap="area", inclusive=True)
+
+    print(f"{'boxes':>8}{'per group':>14}{'batched':>12}{'speedup':>10}{'identical':>11}")
+
+    for group_size in [int(group_size) for group_size in group_sizes.split(",")]:
+        bounding_box_groups = [_generate_bounding_boxes(group_size) for _ in range(groups)]
+
+        # What cluster_bounding_boxes() used to run: one call per group
+        start = time.perf_counter()
+        per_group = [_legacy_non_maximum_suppression(bounding_boxes, overlap_threshold) for bounding_boxes in bounding_box_groups]
+        per_group_time = (time.perf_counter() - start) / groups
+
+        bounding_boxes = np.concatenate(bounding_box_groups)
+        group_offsets = np.arange(groups + 1) * group_size
+        scores = np.concatenate([y1_ranks(group) for group in bounding_box_groups])
+
+        start = time.perf_counter()
+        keep = batched_non_maximum_suppression(bounding_boxes, group_offsets, overlap_threshold, scores=scores, overlap="area", inclusive=True)
+        batched_time = (time.perf_counter() - start) / groups
+
+        identical = np.array_equal(np.concatenate(per_group), bounding_boxes[keep]) and np.array_equal(np.concatenate(per_group), np.concatenate([non_maximum_suppression(group, overlap_threshold) for group in bounding_box_groups]))
+
+        print(
+            f"{group_size:>8}"
+            f"{per_group_time * 1000:>12.3f}ms"
+            f"{batched_time * 1000:>10.3f}ms"
+            f"{per_group_time / batched_time:>9.1f}x"
+            f"{str(identical):>11}"
+        )
+
+
+# Volunteer marks on a few craters of an image: clusters of jittered boxes
+def _generate_bounding_boxes(group_size):
+    craters = np.random.randint(1, 6)
+
+    centers = np.random.uniform(50, 450, (craters, 2))
+    radii = np.random.uniform(5, 50, craters)
+
+    picks = np.random.randint(0, craters, group_size)
+
+    center = centers[picks] + np.random.normal(0, 1, (group_size, 2)) * radii[picks, None] * 0.1
+    radius = radii[picks] * np.random.normal(1, 0.1, group_size).clip(0.5, None)
+
+    return np.round(np.stack([center[:, 0] - radius, center[:, 1] - radius, center[:, 0] + radius, center[:, 1] + radius], axis=1)).astype("int")
+
+
+# The per-group implementation the batched one replaced, for reference
+def _legacy_non_maximum_suppression(bounding_boxes, overlap_threshold):
+    bounding_boxes = bounding_boxes.astype("float")
+
+    mask = list()
+
+    x0, y0, x1, y1 = bounding_boxes[:, 1], bounding_boxes[:, 0], bounding_boxes[:, 3], bounding_boxes[:, 2]
+
+    area = (x1 - x0 + 1) * (y1 - y0 + 1)
+    indices = np.argsort(y1)
+
+    while len(indices) > 0:
+        last = len(indices) - 1
+        i = indices[last]
+
+        mask.append(i)
+
+        xx0 = np.maximum(x0[i], x0[indices[:last]])
+        yy0 = np.maximum(y0[i], y0[indices[:last]])
+        xx1 = np.minimum(x1[i], x1[indices[:last]])
+        yy1 = np.minimum(y1[i], y1[indices[:last]])
+
+        w = np.maximum(0, xx1 - xx0 + 1)
+        h = np.maximum(0, yy1 - yy0 + 1)
+
+        overlap = (w * h) / area[indices[:last]]
+
+        indices = np.delete(indices, np.concatenate(([last], np.where(overlap > overlap_threshold)[0])))
+
+    return bounding_boxes[mask].astype("int")
+
+
+if __name__ == "__main__":
+    benchmark()
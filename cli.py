@@ -48,6 +48,207 @@ def download_images(application, name, count):
             pass
 
 
+@click.command()
+@click.option("--name", required=True)
+def migrate_annotation_library(name):
+    from cosmoquest_data_tools.annotation_library import AnnotationLibrary, LATEST_VERSION
+
+    annotation_library = AnnotationLibrary.load(name, read_only=True)
+    version = annotation_library.version
+    annotation_library.close()
+
+    if version >= LATEST_VERSION:
+        print(f"Annotation Library '{name}' is already at version {version}...")
+        return
+
+    print(f"Migrating Annotation Library '{name}' from version {version} to version {LATEST_VERSION}...")
+
+    annotation_library = AnnotationLibrary.migrate(name)
+
+    print(f"Done! {len(annotation_library.entries)} entries migrated.")
+
+
+@click.command()
+@click.option("--name", required=True)
+@click.option("--batch_size", default=256)
+def materialize_pixels(name, batch_size):
+    from cosmoquest_data_tools.annotation_library import AnnotationLibrary
+
+    annotation_library = AnnotationLibrary.load(name)
+
+    print(f"Materializing raw pixels for {len(annotation_library.entries)} entries of Annotation Library '{name}'...")
+
+    file_path = annotation_library.materialize_pixels(batch_size=batch_size)
+    annotation_library.close()
+
+    print(f"Done! Raw pixels written to '{file_path}'.")
+
+
+@click.command()
+@click.option("--name", required=True)
+@click.option("--destination", default=None, help="Export directory; data/exports/{name} by default")
+@click.option("--images/--no-images", default=False, help="Also export decoded images")
+@click.option("--chunk_rows", default=1024)
+@click.option("--workers", default=None, type=int)
+def export_annotation_library(name, destination, images, chunk_rows, workers):
+    from cosmoquest_data_tools.annotation_library import AnnotationLibrary
+
+    annotation_library = AnnotationLibrary.load(name, read_only=True)
+    destination = destination or f"data/exports/{annotation_library.name}"
+
+    print(f"Exporting {len(annotation_library.entries)} entries of Annotation Library '{name}' to '{destination}'...")
+
+    annotation_library.export(destination, images=images, chunk_rows=chunk_rows, workers=workers)
+    annotation_library.close()
+
+    print(f"Done! Load it with AnnotationLibraryExport.load('{destination}').")
+
+
+@click.command(help="Writes augmentations of every entry to a new Annotation Library, derived from (and next to) the source one, which is left unchanged.")
+@click.option("--name", required=True)
+@click.option("--image_augmentation_pipeline", default="DEFAULT")
+@click.option("--augmentation_count", default=4)
+@click.option("--derived_name", default=None, help="Annotation Library the augmented entries are written to; {name}_augmented by default")
+@click.option("--overwrite/--no-overwrite", default=False, help="Replace the derived Annotation Library if it exists, instead of failing")
+@click.option("--workers", default=None, type=int)
+def augment_annotation_library(name, image_augmentation_pipeline, augmentation_count, derived_name, overwrite, workers):
+    from cosmoquest_data_tools.annotation_library import AnnotationLibrary
+    from cosmoquest_data_tools.annotation_library_transformer import AnnotationLibraryTransformer
+
+    annotation_library = AnnotationLibrary.load(name, read_only=True)
+
+    derived_annotation_library = AnnotationLibraryTransformer.execute(annotation_library, "IMAGE_AUGMENTATION", {
+        "image_augmentation_pipeline": image_augmentation_pipeline,
+        "augmentation_count": augmentation_count,
+        "derived_name": derived_name,
+        "overwrite": overwrite,
+        "workers": workers
+    })
+
+    annotation_library.close()
+
+    print(f"Done! {len(derived_annotation_library.entries)} entries in Annotation Library '{derived_annotation_library.name}'.")
+
+    derived_annotation_library.close()
+
+
+@click.command()
+@click.option("--name", required=True)
+def annotation_library_stats(name):
+    from cosmoquest_data_tools.annotation_library import AnnotationLibrary
+
+    annotation_library = AnnotationLibrary.load(name, read_only=True)
+    statistics = annotation_library.stats()
+    annotation_library.close()
+
+    print(f"Annotation Library '{name}'", end="\n\n")
+    print(f"Entries: {statistics['entry_count']}")
+    print(f"Bounding Boxes: {statistics['bounding_box_count']}", end="\n\n")
+
+    print("Bounding Boxes per Class:")
+
+    for annotation_class, count in sorted(statistics["boxes_per_class"].items(), key=lambda item: -item[1]):
+        print(f"  {annotation_class}: {count}")
+
+    print(f"\nContributors: {len(statistics['boxes_per_contributor'])}")
+
+    for contributor, count in sorted(statistics["boxes_per_contributor"].items(), key=lambda item: -item[1])[:10]:
+        print(f"  {contributor}: {count}")
+
+    for title, histogram in [("Bounding Boxes per Entry", statistics["boxes_per_entry"]), ("Bounding Box Sizes (px)", statistics["box_sizes"])]:
+        print(f"\n{title}:")
+
+        bins = histogram["bins"]
+
+        for i, count in enumerate(histogram["counts"]):
+            label = f"{bins[i]}-{bins[i + 1] - 1}" if i + 1 < len(bins) else f"{bins[i]}+"
+            print(f"  {label:>10}: {count}")
+
+
+@click.command()
+@click.option("--name", required=True)
+@click.option("--destination", default=None)
+def merge_annotation_library_shards(name, destination):
+    from cosmoquest_data_tools.sharded_annotation_library import ShardedAnnotationLibrary
+
+    sharded_annotation_library = ShardedAnnotationLibrary.load(name)
+
+    print(f"Merging {len(sharded_annotation_library.shards)} shards of Annotation Library '{name}'...")
+
+    annotation_library = sharded_annotation_library.merge(destination_file_path=destination)
+    annotation_library.close()
+
+    print(f"Done! {len(annotation_library.entries)} entries merged.")
+
+
+@click.command()
+@click.option("--name", required=True)
+@click.option("--shard_count", default=None, type=int)
+def rebalance_annotation_library_shards(name, shard_count):
+    from cosmoquest_data_tools.sharded_annotation_library import ShardedAnnotationLibrary
+
+    sharded_annotation_library = ShardedAnnotationLibrary.load(name)
+    sharded_annotation_library.rebalance(shard_count=shard_count)
+
+    for annotation_library in sharded_annotation_library.shards:
+        print(f"  {annotation_library.file_path}: {len(annotation_library.entries)} entries")
+
+    sharded_annotation_library.close()
+
+
+@click.command()
+@click.option("--name", multiple=True, help="Annotation Library to convert; all libraries in data/ by default")
+@click.option("--image_store", default="data/image_store")
+def dedupe_annotation_libraries(name, image_store):
+    from cosmoquest_data_tools.annotation_library import AnnotationLibrary
+    from cosmoquest_data_tools.image_store import ImageStore
+    from hurry.filesize import size, alternative
+
+    import os
+
+    names = name or [file[:-len(".alh5")] for file in sorted(os.listdir("data")) if file.endswith(".alh5")]
+
+    store = ImageStore(image_store)
+    store_size = store.stats()["image_bytes"]
+
+    library_bytes_reclaimed = 0
+
+    for name in names:
+        annotation_library = AnnotationLibrary.load(name)
+
+        if annotation_library.version < 2:
+            print(f"Skipping Version {annotation_library.version} Annotation Library '{name}'. Migrate it first...")
+            annotation_library.close()
+            continue
+
+        bytes_reclaimed = annotation_library.dedupe(image_store=image_store)
+        annotation_library.close()
+
+        library_bytes_reclaimed += bytes_reclaimed
+
+        print(f"Annotation Library '{name}': {size(max(bytes_reclaimed, 0), system=alternative)} reclaimed.")
+
+    store_growth = store.stats()["image_bytes"] - store_size
+    store.close()
+
+    print(f"\nImage Store '{image_store}' grew by {size(store_growth, system=alternative)}.")
+    print(f"Space saved: {size(max(library_bytes_reclaimed - store_growth, 0), system=alternative)}")
+
+
+@click.command()
+@click.option("--image_store", default="data/image_store")
+@click.option("--grace_period", default=3600, help="Seconds during which new unreferenced images are kept")
+def gc_image_store(image_store, grace_period):
+    from cosmoquest_data_tools.image_store import ImageStore
+    from hurry.filesize import size, alternative
+
+    store = ImageStore(image_store)
+    freed_images, freed_bytes = store.gc(grace_period=grace_period)
+    store.close()
+
+    print(f"Removed {freed_images} unreferenced images from Image Store '{image_store}': {size(freed_bytes, system=alternative)} freed.")
+
+
 @click.command()
 @click.option("--environment", default="development")
 def web(environment):
@@ -158,6 +359,15 @@ def cli():
 
 
 cli.add_command(download_images)
+cli.add_command(migrate_annotation_library)
+cli.add_command(materialize_pixels)
+cli.add_command(export_annotation_library)
+cli.add_command(augment_annotation_library)
+cli.add_command(annotation_library_stats)
+cli.add_command(merge_annotation_library_shards)
+cli.add_command(rebalance_annotation_library_shards)
+cli.add_command(dedupe_annotation_libraries)
+cli.add_command(gc_image_store)
 cli.add_command(web)
 
 if __name__ == '__main__':
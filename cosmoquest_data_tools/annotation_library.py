@@ -1,38 +1,182 @@
 import h5py
 import os
 import io
-import subprocess
-import shlex
 import base64
+import json
+import zlib
+import uuid
+
+import concurrent.futures
 
 import numpy as np
 
 from PIL import Image
 
-import skimage.color
-import skimage.util
-
 from hurry.filesize import size, alternative
 
+from cosmoquest_data_tools.annotation_library_statistics import AnnotationLibraryStatistics
+from cosmoquest_data_tools.helpers.caching import LRUCache
+from cosmoquest_data_tools.helpers.indexing import OrderedIndex
+from cosmoquest_data_tools.image_store import ImageStore, IMAGE_HASH_LENGTH
+
+
+# Version 1 stores every entry as 3 separate datasets ({key}-image, {key}-shape, {key}-bounding-boxes)
+# Version 2 stores entries column-wise in a handful of resizable datasets, addressed by row number
+LATEST_VERSION = 2
+
+# Version 2 datasets with one row per entry. Image bytes, bounding boxes and spatial indexes live in flat tables
+# sliced through the (start, end) rows of their offsets dataset
+# Nothing is variable-length, which SWMR readers can't follow while a writer appends
+# Images referenced from an Image Store have empty offsets and are found through their 'image_hashes' row
+# Images of derived libraries (see derive()) can sit in the 'image_data' of another library, numbered by 'image_sources'
+ROW_DATASETS = ["image_offsets", "image_hashes", "image_sources", "shapes", "bounding_box_offsets", "spatial_index_cell_offsets", "spatial_index_box_offsets"]
+
+RAGGED_TABLES = [
+    ("image_data", "image_offsets"),
+    ("bounding_boxes", "bounding_box_offsets"),
+    ("spatial_index_cells", "spatial_index_cell_offsets"),
+    ("spatial_index_boxes", "spatial_index_box_offsets")
+]
+
+# Version 2 keeps a uniform grid index of every entry's bounding boxes, in cells of SPATIAL_INDEX_CELL_SIZE pixels
+# An entry's 'spatial_index_cells' row is [cell_size, grid_height, grid_width, then the grid_height * grid_width + 1
+# cell starts], its 'spatial_index_boxes' row holds its bounding box positions grouped by cell. A box is listed in every
+# cell it overlaps. Indexes are built on commit; entries with a stale or missing index are scanned instead
+SPATIAL_INDEX_CELL_SIZE = 64
+
+BATCH_FIELDS = ["image", "image_bytes", "shape", "bounding_boxes", "bounding_boxes_array"]
+
+# Row ranges separated by fewer rows than this are read with a single slice in batched reads
+COALESCE_GAP = 64
+
+# Per-library HDF5 storage options, chosen at creation time and recorded in the 'storage' file attribute
+#   compression: None, "gzip" or "lzf"
+#   compression_opts: gzip level (0-9)
+#   shuffle: Byte shuffle filter, helps compression of the numeric tables
+#   chunks: Dataset name => chunk length in rows, for the resizable Version 2 datasets (h5py guesses otherwise)
+# The PNG bytes in 'image_data' are already compressed, so filters mostly pay off on the other tables
+DEFAULT_STORAGE = {
+    "compression": None,
+    "compression_opts": None,
+    "shuffle": False,
+    "chunks": {}
+}
+
+COMPRESSIONS = [None, "gzip", "lzf"]
+
+# Tables that grow by appending, rather than being rewritten, while a library is open in SWMR mode
+# They're stored as fixed-length strings of SWMR_STRING_LENGTH bytes there
+APPENDABLE_TABLES = ["keys", "annotation_classes", "labels", "metas"]
+SWMR_STRING_LENGTH = 256
+
+# Deleted entries keep their row (and key) until the library is compacted. They're flagged in 'tombstones', a bitmap
+# with one bit per row (row i is bit i % 8 of byte i // 8, least significant bit first), and hidden from 'entries'
+
+# Raw pixel sidecars are N x H x W x C uint8 .npy files stored next to the library file
+PIXEL_SIDECAR_EXTENSION = ".pixels.npy"
+
+# Libraries derived from a library (see derive()) are listed in a JSON sidecar next to it, as paths relative to its
+# directory, so compacting it can relink them. Compaction changes the 'image_data_generation' attribute of a library;
+# derived libraries record the generation of each image source in 'image_source_generations' and refuse to read images
+# from a source whose generation has changed since
+DERIVED_LIBRARIES_EXTENSION = ".derived.json"
+
+# Labels and meta (usernames) are ids into the per-library 'labels' and 'metas' dictionaries
+BOUNDING_BOX_DTYPE = np.dtype([
+    ("y0", "<f4"),
+    ("x0", "<f4"),
+    ("y1", "<f4"),
+    ("x1", "<f4"),
+    ("label", "<u2"),
+    ("meta", "<u4")
+])
+
+
+class AnnotationLibraryError(BaseException):
+    pass
+
+
+# What loading a broken, stale or half-written library file can raise; h5py errors are OSError, KeyError or RuntimeError
+ANNOTATION_LIBRARY_LOAD_ERRORS = (AnnotationLibraryError, OSError, KeyError, ValueError, RuntimeError)
+
 
 class AnnotationLibrary:
 
-    def __init__(self, name, file_path=None, read_only=False):
+    def __init__(self, name, file_path=None, read_only=False, version=None, storage=None, image_cache_size=0, swmr=False, image_store=None):
         self.name = name
-        self.h5_file = h5py.File(file_path or self.file_path, "r" if read_only else "a")
+        self._file_path = file_path or f"data/{name}.alh5"
+
+        # Single-Writer/Multiple-Readers: a writer opened with swmr=True can append entries while
+        # readers opened with swmr=True keep reading, and pick up committed entries through refresh()
+        self.swmr = swmr
 
         self.read_only = read_only
+        self.h5_file = self._open_file()
+        self.version = self._detect_version(version)
+        self.storage = self._detect_storage(storage)
+
+        if self.version >= 2 and not self.read_only:
+            self._create_layout()
+
+        # Optional content-addressed Image Store (path), recorded in the library attributes
+        # New images are then written to the store and only referenced by hash in the library
+        self.image_store = self._detect_image_store(image_store)
 
+        # Ordered key table, decoded once per open. In Version 2 the position of a key is its row number
         self.keys = self._populate_keys()
         self.annotation_classes = self._populate_annotation_classes()
 
+        # Bounding box label and meta dictionaries. Only persisted in Version 2, built on the fly for Version 1
+        self.labels = self._populate_dictionary("labels")
+        self.metas = self._populate_dictionary("metas")
+
+        # Rows of deleted entries, and the bitmap bytes to rewrite on the next commit
+        self._deleted_rows = self._populate_tombstones()
+        self._tombstones_dirty = set()
+        self._live_entries = None
+
+        if self.version >= 2 and not self.read_only:
+            self._discard_uncommitted_rows()
+
+        # Image Store reference count changes since the last commit: {image hash: count change}
+        self._image_reference_changes = dict()
+
+        # A commit that didn't complete may have left the counts off; they're rebuilt once
+        if self.image_store is not None and not self.read_only and self.image_store.pending(self._image_store_id):
+            self.rebuild_image_references()
+
+        # Rows whose spatial index needs (re)building on the next commit
+        self._spatial_index_dirty = set()
+
+        # Optional LRU cache of decoded images, bounded by 'image_cache_size' bytes
+        self.image_cache = LRUCache(image_cache_size) if image_cache_size else None
+
+        # Optional memory-mapped raw pixel sidecar, see materialize_pixels()
+        self.pixels = self._open_pixel_sidecar()
+
+        # Summary statistics, persisted on commit. Writers need them up to date; readers load them on first use
+        self.statistics = None if self.read_only else self._load_statistics()
+
+        if self.swmr and not self.read_only:
+            self._start_swmr()
+
     @property
     def file_path(self):
-        return f"data/{self.name}.alh5"
+        return self._file_path
 
+    # Keys of the live entries. Same as 'keys', unless entries were deleted since the last compaction
     @property
     def entries(self):
-        return [key.decode("utf-8") for key in self.h5_file["keys"].value]
+        if not self._deleted_rows:
+            return self.keys
+
+        if self._live_entries is None or self._live_entries[0] != len(self.keys):
+            from cosmoquest_data_tools.annotation_library_view import AnnotationLibraryViewEntries
+
+            rows = np.setdiff1d(np.arange(len(self.keys)), np.fromiter(self._deleted_rows, dtype="int64", count=len(self._deleted_rows)))
+            self._live_entries = (len(self.keys), AnnotationLibraryViewEntries(self.keys, rows))
+
+        return self._live_entries[1]
 
     def as_json_minimal(self):
         return {
@@ -40,9 +184,26 @@ class AnnotationLibrary:
             "file_path": self.file_path,
             "file_size": size(os.path.getsize(self.file_path), system=alternative),
             "entry_count": len(self.entries),
-            "annotation_classes": list(self.annotation_classes)
+            "annotation_classes": list(self.annotation_classes),
+            "statistics": self.stored_stats()
         }
 
+    # Entry count, boxes per class and contributor, boxes per entry and box size histograms; never touches entry data
+    # Libraries committed before statistics were introduced are scanned once
+    def stats(self):
+        if self.statistics is None:
+            self.statistics = self._load_statistics()
+
+        return self.statistics.as_json()
+
+    # Same as stats(), but None instead of a scan when the library was committed before statistics were introduced;
+    # listings and API responses use this, as read-only handles can't store what a scan computed
+    def stored_stats(self):
+        if self.statistics is None and "statistics" in self.h5_file.attrs:
+            self.statistics = self._load_statistics()
+
+        return self.statistics.as_json() if self.statistics is not None else None
+
     def as_json(self):
         return {
             **self.as_json_minimal(),
@@ -67,63 +228,112 @@ class AnnotationLibrary:
             }
         }
 
+    # Lazy subset of the entries matching the criteria, see AnnotationLibraryView.select()
+    def select(self, **criteria):
+        from cosmoquest_data_tools.annotation_library_view import AnnotationLibraryView
+        return AnnotationLibraryView(self).select(**criteria)
+
     def add_entry(self, key, field, data):
-        self.keys.add(key.encode("utf-8"))
-        self.h5_file.create_dataset(f"{key}-{field}", data=data)
+        if field == "image" and self.image_cache is not None:
+            self.image_cache.discard(key)
 
-    def add_complete_entry(self, entry):
-        key = entry["file_location"].replace(".png", "")
-        self.keys.add(key.encode("utf-8"))
+        # Replacing an image that's materialized in the pixel sidecar makes the sidecar stale
+        if field == "image" and self.pixels is not None and key in self.keys and self.keys.position(key) < len(self.pixels):
+            self._drop_pixel_sidecar()
 
-        # Image Data
-        with open(entry["file_location"], "rb") as f:
-            image_bytes = f.read()
+        if self.version < 2:
+            if key not in self.keys:
+                self.statistics.add_entry()
 
-        self.h5_file.create_dataset(f"{key}-image", data=[image_bytes])
+            if field == "bounding-boxes":
+                self.statistics.replace_bounding_boxes(self._bounding_box_array([]), self._bounding_box_array(data), self.labels, self.metas)
 
-        image_bytes = None
+            self.keys.add(key)
+            self._create_dataset(f"{key}-{field}", data=data)
+            return
 
-        # Image Shape
-        image_shape = (entry["height"], entry["width"], 3)
-        self.h5_file.create_dataset(f"{key}-shape", data=image_shape)
+        row = self._allocate_row(key)
 
-        # Bounding Boxes
-        bounding_boxes = list()
+        if field == "image":
+            self._write_image(row, data[0])
+        elif field == "shape":
+            self.h5_file["shapes"][row] = data
+        elif field == "bounding-boxes":
+            self._write_bounding_boxes(row, self._bounding_box_array(data))
+        else:
+            raise KeyError(f"Unknown entry field: '{field}'")
 
-        for bounding_box in entry["bounding_boxes"]:
-            annotation_class = bounding_box["annotation_class"].encode("utf-8")
+    # Flag the entry as deleted; its data is dropped by the next compaction. Adding the key again starts a new entry
+    def delete_entry(self, key):
+        if self.version < 2:
+            raise AnnotationLibraryError("Deleting entries requires a Version 2 Annotation Library. Use AnnotationLibrary.migrate()...")
 
-            if "meta" not in bounding_box:
-                bounding_box["meta"] = "N/A"
+        if key not in self.entries:
+            raise KeyError(key)
 
-            meta = bounding_box["meta"].encode("utf-8")
+        row = self.keys.position(key)
+        start, end = self.h5_file["bounding_box_offsets"][row]
 
-            bounding_boxes.append((
-                bounding_box["top"],
-                bounding_box["left"],
-                bounding_box["bottom"],
-                bounding_box["right"],
-                annotation_class,
-                meta
-            ))
+        self.statistics.replace_bounding_boxes(self.h5_file["bounding_boxes"][start:end], self._bounding_box_array([]), self.labels, self.metas)
+        self.statistics.remove_entry()
+
+        if self.image_cache is not None:
+            self.image_cache.discard(key)
+
+        self._set_deleted(row, True)
+
+    def add_complete_entry(self, entry):
+        key, image_shape, bounding_boxes = self._prepare_complete_entry(entry)
+
+        # Image Data
+        with open(entry["file_location"], "rb") as f:
+            image_bytes = f.read()
 
-            self.annotation_classes.add(annotation_class)
+        self.add_entry(key, "image", [image_bytes])
+        self.add_entry(key, "shape", image_shape)
+        self.add_entry(key, "bounding-boxes", bounding_boxes)
 
-        self.h5_file.create_dataset(f"{key}-bounding-boxes", data=bounding_boxes)
+    # Buffered alternative to add_complete_entry for large ingests:
+    #   with annotation_library.bulk_writer(batch_size=512) as writer:
+    #       writer.add(entry)
+    def bulk_writer(self, **kwargs):
+        from cosmoquest_data_tools.annotation_library_bulk_writer import AnnotationLibraryBulkWriter
+        return AnnotationLibraryBulkWriter(self, **kwargs)
 
     def get_entry(self, key, field):
-        return self.h5_file[f"{key}-{field}"].value
+        if self.version < 2:
+            return self.h5_file[f"{key}-{field}"][()]
+
+        row = self.keys.position(key)
+
+        if field == "image":
+            return [self._read_images([row])[0]]
+        elif field == "shape":
+            return self.h5_file["shapes"][row]
+        elif field == "bounding-boxes":
+            start, end = self.h5_file["bounding_box_offsets"][row]
+            return self.h5_file["bounding_boxes"][start:end]
+
+        raise KeyError(f"Unknown entry field: '{field}'")
 
     def get_image_bytes(self, key):
         return self.get_entry(key, "image")[0]
 
+    # Cached image arrays are shared between callers and flagged read-only; copy them before modifying
     def get_image_array(self, key):
-        image_array = np.array(Image.open(io.BytesIO(self.get_image_bytes(key))), dtype="uint8")
+        if self._in_pixel_sidecar([key]):
+            return self.pixels[self.keys.position(key)]
 
-        # The image sets are mixes of 2 and 3 channel images
-        # We are going to make sure we only work with 3, for consistency        
-        if len(image_array.shape) == 2:
-            image_array = skimage.util.img_as_ubyte(skimage.color.gray2rgb(image_array))
+        if self.image_cache is None:
+            return self._decode_image(self.get_image_bytes(key))
+
+        image_array = self.image_cache.get(key)
+
+        if image_array is None:
+            image_array = self._decode_image(self.get_image_bytes(key))
+            image_array.flags.writeable = False
+
+            self.image_cache.put(key, image_array)
 
         return image_array
 
@@ -131,115 +341,1621 @@ class AnnotationLibrary:
         return [int(i) for i in self.get_entry(key, "shape")]
 
     def get_bounding_boxes(self, key):
-        return self._format_bounding_boxes(self.get_entry(key, "bounding-boxes"))
+        return self._format_bounding_boxes(self.get_bounding_boxes_array(key))
+
+    # Structured array of BOUNDING_BOX_DTYPE; resolve 'label' and 'meta' ids through self.labels and self.metas
+    def get_bounding_boxes_array(self, key):
+        if self.version < 2:
+            return self._bounding_box_array(self.get_entry(key, "bounding-boxes"))
+
+        return self.get_entry(key, "bounding-boxes")
+
+    # Read several entries at once. Returns {field: values} with values in the order of 'keys'
+    # 'image' is stacked into a single array when all shapes match, and 'shape' is always an (N, 3) array
+    def get_batch(self, keys, fields=("image", "shape", "bounding_boxes"), workers=None):
+        keys = list(keys)
+
+        for field in fields:
+            if field not in BATCH_FIELDS:
+                raise KeyError(f"Unknown batch field: '{field}'. Expected one of: {', '.join(BATCH_FIELDS)}")
+
+        batch = dict()
+
+        from_pixels = "image" in fields and self._in_pixel_sidecar(keys)
+
+        needs_image_bytes = "image_bytes" in fields or ("image" in fields and not from_pixels)
+        needs_bounding_boxes = "bounding_boxes" in fields or "bounding_boxes_array" in fields
+
+        if self.version < 2:
+            image_bytes = [self.get_image_bytes(key) for key in keys] if needs_image_bytes else None
+            shapes = [self.get_entry(key, "shape") for key in keys] if "shape" in fields else None
+            bounding_boxes = [self.get_bounding_boxes_array(key) for key in keys] if needs_bounding_boxes else None
+        else:
+            # HDF5 reads happen in row order, with neighbouring rows coalesced into single slices
+            rows = np.array([self.keys.position(key) for key in keys], dtype="int64")
+
+            image_bytes = None
+            shapes = None
+            bounding_boxes = None
+
+            if needs_image_bytes:
+                image_rows = rows
+
+                # Images already decoded in the cache don't need their bytes read, unless the bytes were asked for
+                if "image_bytes" not in fields and self.image_cache is not None:
+                    image_rows = np.array([row for key, row in zip(keys, rows.tolist()) if key not in self.image_cache], dtype="int64")
+
+                image_bytes = dict(zip(image_rows.tolist(), self._read_images(image_rows, workers)))
+                image_bytes = [image_bytes.get(row) for row in rows.tolist()]
+
+            if "shape" in fields:
+                shapes = _coalesced_read(self.h5_file["shapes"], rows)
+
+            if needs_bounding_boxes:
+                offsets = np.array(_coalesced_read(self.h5_file["bounding_box_offsets"], rows)).reshape(-1, 2)
+                bounding_boxes = _coalesced_read_ranges(self.h5_file["bounding_boxes"], offsets)
+
+        if "image_bytes" in fields:
+            batch["image_bytes"] = image_bytes
+
+        if "image" in fields and from_pixels:
+            batch["image"] = self._read_pixel_sidecar(keys)
+        elif "image" in fields:
+            batch["image"] = _stack_if_uniform(self._decode_images(keys, image_bytes, workers))
+
+        if "shape" in fields:
+            batch["shape"] = np.array(shapes, dtype="int64").reshape(-1, 3)
+
+        if "bounding_boxes_array" in fields:
+            batch["bounding_boxes_array"] = bounding_boxes
+
+        if "bounding_boxes" in fields:
+            batch["bounding_boxes"] = [self._format_bounding_boxes(bounding_box_array) for bounding_box_array in bounding_boxes]
+
+        return batch
 
     def replace_bounding_boxes(self, key, bounding_boxes):
         bounding_boxes = self._encode_bounding_boxes(bounding_boxes)
+
+        if self.version >= 2:
+            self._write_bounding_boxes(self.keys.position(key), self._bounding_box_array(bounding_boxes))
+            return
+
+        self.statistics.replace_bounding_boxes(self.get_bounding_boxes_array(key), self._bounding_box_array(bounding_boxes), self.labels, self.metas)
+
         key = f"{key}-bounding-boxes"
 
         del self.h5_file[key]
-        self.h5_file.create_dataset(key, data=bounding_boxes)
+        self._create_dataset(key, data=bounding_boxes)
+
+    # Decode every image once into an N x H x W x C uint8 sidecar file, registered in the library attributes
+    # Reads of materialized entries then return memory-mapped slices instead of decoding PNGs
+    def materialize_pixels(self, batch_size=256, workers=None):
+        if self.read_only or self._swmr_writing:
+            raise AnnotationLibraryError("Materializing pixels requires a writable Annotation Library, outside of SWMR mode...")
+
+        if not len(self.entries):
+            raise AnnotationLibraryError("Can't materialize pixels for an empty Annotation Library...")
+
+        self._drop_pixel_sidecar()
+
+        # Sidecar rows are the rows of self.keys, read through self.keys.position(); deleted entries stay zeroed
+        keys = self.keys[:]
+
+        image_shapes = set(tuple(image_shape) for image_shape in self.get_batch(self.entries[:], fields=("shape",))["shape"].tolist())
+
+        if len(image_shapes) != 1:
+            raise AnnotationLibraryError(f"Materializing pixels requires a single image shape. Found: {', '.join(str(s) for s in image_shapes)}")
+
+        file_path = f"{os.path.splitext(self.file_path)[0]}{PIXEL_SIDECAR_EXTENSION}"
+        pixels = np.lib.format.open_memmap(f"{file_path}.tmp", mode="w+", dtype="uint8", shape=(len(keys), *image_shapes.pop()))
+
+        for offset in range(0, len(keys), batch_size):
+            rows = [row for row in range(offset, min(offset + batch_size, len(keys))) if row not in self._deleted_rows]
+
+            if not rows:
+                continue
+
+            images = self.get_batch([keys[row] for row in rows], fields=("image",), workers=workers)["image"]
+
+            if isinstance(images, list):
+                raise AnnotationLibraryError(f"Decoded images don't match their stored shapes for entries {offset} to {offset + batch_size}...")
+
+            pixels[rows] = images
+
+        pixels.flush()
+        del pixels
+
+        os.replace(f"{file_path}.tmp", file_path)
+
+        self.h5_file.attrs["pixel_sidecar"] = os.path.basename(file_path)
+        self.h5_file.attrs["pixel_sidecar_rows"] = len(keys)
+        self.h5_file.flush()
+
+        self.pixels = self._open_pixel_sidecar()
+
+        return file_path
+
+    # Columnar .npy export for analysis code, see AnnotationLibraryExport
+    def export(self, path, images=False, chunk_rows=1024, workers=None):
+        from cosmoquest_data_tools.annotation_library_export import AnnotationLibraryExport
+        return AnnotationLibraryExport.write(self, path, images=images, chunk_rows=chunk_rows, workers=workers)
 
     def flush(self):
         self.h5_file.flush()
 
+    def close(self):
+        swmr_writing = self._swmr_writing
+
+        self.h5_file.close()
+
+        if self.image_store is not None:
+            self.image_store.close()
+
+        # Attributes can't be written in SWMR mode; persist the statistics once the SWMR session is over
+        if swmr_writing:
+            with h5py.File(self.file_path, "a") as h5_file:
+                h5_file.attrs["statistics"] = json.dumps(self.statistics.as_json())
+
+    # SWMR readers: pick up entries committed by the writer since the last refresh. Returns the number of new entries
+    def refresh(self):
+        if not self.swmr or not self.read_only:
+            return 0
+
+        for name in [*[name for name, _ in RAGGED_TABLES], *ROW_DATASETS, *APPENDABLE_TABLES]:
+            if name in self.h5_file:
+                self.h5_file[name].refresh()
+
+        entry_count = len(self.keys)
+
+        for name, values in [("labels", self.labels), ("metas", self.metas), ("keys", self.keys)]:
+            if name in self.h5_file:
+                for value in self.h5_file[name][len(values):]:
+                    values.add(value.decode("utf-8"))
+
+        self.annotation_classes = self._populate_annotation_classes()
+
+        if "tombstones" in self.h5_file:
+            self.h5_file["tombstones"].refresh()
+
+            self._deleted_rows = self._populate_tombstones()
+            self._live_entries = None
+
+        return len(self.keys) - entry_count
+
     def commit(self):
-        self.commit_keys()
+        if self._swmr_writing:
+            return self._commit_swmr()
+
+        if self.version >= 2:
+            self.commit_image_references()
+            self.commit_dictionaries()
+            self.commit_spatial_index()
+
+        # Keys last, for readers trust the key table
         self.commit_annotation_classes()
+        self.commit_keys()
+
+        if self.version >= 2:
+            self.commit_tombstones()
+
+        self.commit_statistics()
 
+    # Version 2: The key and class tables are resizable, and commits only append what's new to them, sliced off of the
+    # in-memory tables without copying them
     def commit_keys(self):
+        if self.version >= 2:
+            self._append_table("keys", self.keys[self._appendable_table("keys").shape[0]:])
+            return
+
         if "keys" in self.h5_file:
             del self.h5_file["keys"]
 
-        self.h5_file.create_dataset("keys", data=list(self.keys))
+        self._create_dataset("keys", data=[key.encode("utf-8") for key in self.keys])
 
     def commit_annotation_classes(self):
+        if self.version >= 2:
+            committed_annotation_classes = set(value.decode("utf-8") for value in self._appendable_table("annotation_classes")[()])
+            self._append_table("annotation_classes", sorted(self.annotation_classes - committed_annotation_classes))
+            return
+
         if "annotation_classes" in self.h5_file:
             del self.h5_file["annotation_classes"]
 
-        self.h5_file.create_dataset("annotation_classes", data=list(self.annotation_classes))
+        self._create_dataset("annotation_classes", data=[annotation_class.encode("utf-8") for annotation_class in self.annotation_classes])
+
+    # Only the bitmap bytes holding rows deleted or revived since the last commit are written
+    def commit_tombstones(self):
+        tombstones = self.h5_file["tombstones"]
+        byte_count = (len(self.keys) + 7) // 8
+
+        if tombstones.shape[0] < byte_count:
+            tombstones.resize(byte_count, axis=0)
+
+        dirty = np.array(sorted(index for index in self._tombstones_dirty if index < byte_count), dtype="int64")
+
+        if len(dirty):
+            bits = np.zeros(byte_count * 8, dtype="bool")
+            bits[np.fromiter(self._deleted_rows, dtype="int64", count=len(self._deleted_rows))] = True
+
+            _write_rows(tombstones, dirty, _pack_bits(bits)[dirty])
+
+        self._tombstones_dirty.clear()
+
+        # Read by AnnotationLibraryCatalog; attributes can't be changed in SWMR mode
+        if not self._swmr_writing:
+            self.h5_file.attrs["deleted_entry_count"] = len(self._deleted_rows)
+
+    def commit_statistics(self):
+        self.h5_file.attrs["statistics"] = json.dumps(self.statistics.as_json())
+
+    # Only the references added or released since the last commit are sent to the Image Store
+    # Recorded before the keys, so an interrupted commit leaks references rather than losing them
+    def commit_image_references(self):
+        if self.image_store is None or not self._image_reference_changes:
+            return
+
+        self.image_store.update_references(self._image_store_id, self._image_reference_changes)
+        self._image_reference_changes = dict()
+
+    # Replace the references of this library in the Image Store with its 'image_hashes', e.g. after a compaction or a
+    # commit that didn't complete
+    def rebuild_image_references(self):
+        self._image_reference_changes = dict()
+
+        if self.image_store is None:
+            return
+
+        image_hashes = self.h5_file["image_hashes"][:len(self.keys)]
+        self.image_store.set_references(self._image_store_id, [_decode(image_hash) for image_hash in image_hashes])
+
+    def commit_spatial_index(self, chunk_rows=1024):
+        rows = sorted(self._spatial_index_dirty)
+
+        for offset in range(0, len(rows), chunk_rows):
+            chunk = np.array(rows[offset:offset + chunk_rows], dtype="int64")
+
+            shapes = _coalesced_read(self.h5_file["shapes"], chunk)
+            offsets = np.array(_coalesced_read(self.h5_file["bounding_box_offsets"], chunk)).reshape(-1, 2)
+
+            spatial_indexes = [
+                _build_spatial_index(bounding_boxes, shape)
+                for bounding_boxes, shape in zip(_coalesced_read_ranges(self.h5_file["bounding_boxes"], offsets), shapes)
+            ]
+
+            # Written to the end of the tables in one go, then pointed at
+            _write_rows(self.h5_file["spatial_index_box_offsets"], chunk, self._append_ragged("spatial_index_boxes", [boxes for _, boxes in spatial_indexes]))
+            _write_rows(self.h5_file["spatial_index_cell_offsets"], chunk, self._append_ragged("spatial_index_cells", [cells for cells, _ in spatial_indexes]))
+
+        self._spatial_index_dirty.clear()
+
+    # Build the spatial index of every entry that doesn't have an up to date one, e.g. libraries written before it existed
+    def build_spatial_index(self):
+        if self.version < 2 or self.read_only:
+            raise AnnotationLibraryError("Building the spatial index requires a writable Version 2 Annotation Library...")
+
+        offsets = self.h5_file["spatial_index_cell_offsets"][()]
+
+        self._spatial_index_dirty.update(np.flatnonzero(offsets[:, 1] <= offsets[:, 0]).tolist())
+        self.commit_spatial_index()
+
+    # Bounding boxes of an entry overlapping the y0, x0, y1, x1 window, or fully inside it with contained=True
+    # Returns the matching rows of get_bounding_boxes_array(key), in their original order
+    def query_region(self, key, y0, x0, y1, x1, contained=False):
+        bounding_boxes = self.get_bounding_boxes_array(key)
+        bounding_boxes = bounding_boxes[self._spatial_index_candidates(key, y0, x0, y1, x1, len(bounding_boxes))]
+
+        if contained:
+            mask = (bounding_boxes["y0"] >= y0) & (bounding_boxes["x0"] >= x0) & (bounding_boxes["y1"] <= y1) & (bounding_boxes["x1"] <= x1)
+        else:
+            mask = (bounding_boxes["y0"] <= y1) & (bounding_boxes["x0"] <= x1) & (bounding_boxes["y1"] >= y0) & (bounding_boxes["x1"] >= x0)
+
+        return bounding_boxes[mask]
+
+    # Bounding boxes of an entry whose center is within 'radius' pixels of (y, x), in their original order
+    def query_near(self, key, y, x, radius):
+        bounding_boxes = self.get_bounding_boxes_array(key)
+        bounding_boxes = bounding_boxes[self._spatial_index_candidates(key, y - radius, x - radius, y + radius, x + radius, len(bounding_boxes))]
+
+        center_y = (bounding_boxes["y0"] + bounding_boxes["y1"]) / 2
+        center_x = (bounding_boxes["x0"] + bounding_boxes["x1"]) / 2
+
+        return bounding_boxes[(center_y - y) ** 2 + (center_x - x) ** 2 <= radius ** 2]
+
+    def commit_dictionaries(self):
+        for name, dictionary in [("labels", self.labels), ("metas", self.metas)]:
+            self._append_table(name, dictionary[self._appendable_table(name).shape[0]:])
 
     # In HDF5, due to the sequential nature of the writing, the space occupied by altered / deleted items is not reclaimed
-    # Repacking is one way around this downside.
-    def repack(self):
+    # Compacting copies the live data into a fresh file, in bounded memory, and swaps it in place of the current one
+    def compact(self, chunk_rows=1024):
+        if self.read_only:
+            raise AnnotationLibraryError("Compacting requires a writable Annotation Library...")
+
+        self.commit()
+        self.flush()
+
+        source_size = os.path.getsize(self.file_path)
+        source_checksum = self.checksum(batch_size=chunk_rows)
+
+        destination_file_path = f"{self.file_path}.compact.tmp"
+
+        if os.path.isfile(destination_file_path):
+            os.remove(destination_file_path)
+
+        # SWMR needs the latest file format, which is fixed when a file is created
+        if self.swmr:
+            h5py.File(destination_file_path, "w", libver="latest").close()
+
+        destination = AnnotationLibrary(
+            self.name,
+            file_path=destination_file_path,
+            version=self.version,
+            storage=self.storage,
+            image_store=self.image_store.path if self.image_store is not None else None
+        )
+
+        try:
+            for attribute, value in self.h5_file.attrs.items():
+                destination.h5_file.attrs[attribute] = value
+
+            destination.h5_file.attrs["image_data_generation"] = uuid.uuid4().hex
+
+            # Same directory, so the links stay valid as they are
+            if self._derived:
+                links = [self.h5_file["image_source_links"].get(source, getlink=True) for source in sorted(self.h5_file["image_source_links"], key=int)]
+                destination._link_image_sources(links, self._image_source_generations())
+
+            destination.annotation_classes = set(self.annotation_classes)
+            destination.labels = OrderedIndex(self.labels)
+            destination.metas = OrderedIndex(self.metas)
+
+            keys = self.entries[:]
+
+            for offset in range(0, len(keys), chunk_rows):
+                chunk_keys = keys[offset:offset + chunk_rows]
+
+                if self.version < 2:
+                    for key in chunk_keys:
+                        for field in ["image", "shape", "bounding-boxes"]:
+                            self.h5_file.copy(self.h5_file[f"{key}-{field}"], destination.h5_file, name=f"{key}-{field}")
+
+                        destination.keys.add(key)
+                else:
+                    rows = np.array([self.keys.position(key) for key in chunk_keys], dtype="int64")
+                    batch = self.get_batch(chunk_keys, fields=("shape", "bounding_boxes_array"))
+
+                    # Images of derived libraries that sit in their source libraries stay there
+                    image_links = self._image_links(rows) if self._derived else None
+                    own_rows = np.flatnonzero(image_links[0] == 0) if self._derived else np.arange(len(rows))
+
+                    images = [None] * len(rows)
+
+                    for i, image_bytes in zip(own_rows.tolist(), self._read_images(rows[own_rows])):
+                        images[i] = image_bytes
+
+                    destination._append_rows(chunk_keys, images, batch["shape"], batch["bounding_boxes_array"], image_links=image_links)
+
+            # The content is identical, so are the statistics (Version 1 datasets are copied without tracking them)
+            destination.statistics = AnnotationLibraryStatistics.from_json(self.stats())
+
+            # Same references as this library, minus those of the deleted entries
+            destination.rebuild_image_references()
+
+            destination.commit()
+            destination.flush()
+
+            if len(destination.entries) != len(self.entries):
+                raise AnnotationLibraryError(f"Compaction entry count mismatch: {len(destination.entries)} != {len(self.entries)}")
+
+            if destination.checksum(batch_size=chunk_rows) != source_checksum:
+                raise AnnotationLibraryError("Compaction checksum mismatch; keeping the original file...")
+
+            # The libraries derived from this one point into the 'image_data' about to be replaced
+            self._relink_derived_libraries(destination)
+        except BaseException:
+            destination.close()
+            os.remove(destination_file_path)
+            raise
+
+        destination.close()
         self.h5_file.close()
 
-        FNULL = open(os.devnull, "w")
-        subprocess.call(shlex.split(f"ptrepack {self.file_path} {self.file_path}.tmp"), stdout=FNULL, stderr=subprocess.STDOUT)
-        FNULL.close()
+        os.replace(destination_file_path, self.file_path)
 
-        os.remove(self.file_path)
-        os.rename(f"{self.file_path}.tmp", self.file_path)
+        swmr_writing = self._swmr_writing
+        entries_moved = bool(self._deleted_rows)
 
-        self.h5_file = h5py.File(self.file_path, "r" if self.read_only else "a")
+        self.h5_file = self._open_file()
 
-    def _populate_keys(self):
-        if "keys" in self.h5_file:
-            return set([key.decode("utf-8") for key in self.h5_file["keys"].value])
-        else:
-            return set()
+        # Deleted entries are gone, so the remaining ones may have moved up to other rows
+        if entries_moved:
+            self.keys = self._populate_keys()
+            self._deleted_rows = self._populate_tombstones()
+            self._tombstones_dirty = set()
+            self._live_entries = None
 
-    def _populate_annotation_classes(self):
-        if "annotation_classes" in self.h5_file:
-            return set([annotation_class.decode("utf-8") for annotation_class in self.h5_file["annotation_classes"].value])
-        else:
-            return set()
+            if self.pixels is not None:
+                self._drop_pixel_sidecar()
 
-    # Go from encoded in HDF5 dataset to dict
-    def _format_bounding_boxes(self, bounding_boxes):
-        return [self._format_bounding_box(bounding_box) for bounding_box in bounding_boxes]
+        if swmr_writing:
+            self._start_swmr()
 
-    def _format_bounding_box(self, bounding_box):
-        return {
-            "y0": int(float(bounding_box[0])),
-            "x0": int(float(bounding_box[1])),
-            "y1": int(float(bounding_box[2])),
-            "x1": int(float(bounding_box[3])),
-            "label": bounding_box[4].decode("utf-8"),
-            "meta": bounding_box[5].decode("utf-8")
-        }
+        bytes_reclaimed = source_size - os.path.getsize(self.file_path)
 
-    # Go from dict to encoded in HDF5 dataset
-    def _encode_bounding_boxes(self, bounding_boxes):
-        return [self._encode_bounding_box(bounding_box) for bounding_box in bounding_boxes]
+        print(f"Compacted Annotation Library '{self.name}': {size(max(bytes_reclaimed, 0), system=alternative)} reclaimed.")
 
-    def _encode_bounding_box(self, bounding_box):
-        return [
-            bounding_box["y0"],
-            bounding_box["x0"],
-            bounding_box["y1"],
-            bounding_box["x1"],
-            bounding_box["label"].encode("utf-8"),
-            (bounding_box["meta"] or "N/A").encode("utf-8")
-        ]
+        return bytes_reclaimed
 
-    @classmethod
-    def load(cls, name_or_path, **kwargs):
-        if os.path.isfile(name_or_path):
-            file_path = name_or_path
-            name = name_or_path.split("/")[-1].replace(".alh5", "")
-        else:
-            name = name_or_path
-            file_path = f"data/{name_or_path}.alh5"
+    def compact_if_needed(self, threshold=0.25, **kwargs):
+        free_space_ratio = self.free_space_ratio()
 
-            if not os.path.isfile(file_path):
-                raise FileNotFoundError(file_path)
+        if free_space_ratio < threshold:
+            return 0
 
-        return cls(name, file_path=file_path, **kwargs)
+        print(f"Annotation Library '{self.name}' is {free_space_ratio:.0%} free space. Compacting...")
 
-    @classmethod
-    def discover(cls, path):
-        if not os.path.isdir(path):
-            raise FileNotFoundError(path)
+        return self.compact(**kwargs)
 
-        annotation_library_file_paths = list()
+    # New library with the same entries (or the given subset), sharing this library's images instead of copying them
+    # Its images are HDF5 external links to the 'image_data' of this library (and of the libraries this one derives from)
+    # Only shapes, bounding boxes and whatever is written to the derived library later take up space in it
+    # Compacting (or deduping) the libraries it takes images from relinks it, see DERIVED_LIBRARIES_EXTENSION
+    def derive(self, name, file_path=None, keys=None, chunk_rows=1024):
+        if self.version < 2:
+            raise AnnotationLibraryError("Deriving requires a Version 2 Annotation Library. Use AnnotationLibrary.migrate()...")
 
-        for root, dirs, files in os.walk(path):
-            if root != path:
-                break
+        if not self.read_only:
+            self.commit()
+            self.flush()
 
-            for file in files:
-                if file.endswith(".alh5"):
-                    annotation_library_file_paths.append(f"{root}/{file}")
+        keys = self.entries[:] if keys is None else list(keys)
+
+        destination = AnnotationLibrary(name, file_path=file_path, storage=self.storage, image_store=self.image_store.path if self.image_store is not None else None)
+
+        if len(destination.entries):
+            destination.close()
+            raise AnnotationLibraryError(f"Annotation Library '{name}' already exists...")
+
+        destination_directory = os.path.dirname(os.path.abspath(destination.file_path))
+        source_directory = os.path.dirname(os.path.abspath(self.file_path))
+
+        # Source 1 is this library, the sources of this library follow, shifted by one
+        source_file_paths = [self.file_path]
+        generations = [self._image_data_generation]
+
+        if self._derived:
+            for source in sorted(self.h5_file["image_source_links"], key=int):
+                source_file_paths.append(os.path.join(source_directory, self.h5_file["image_source_links"].get(source, getlink=True).filename))
+
+            generations += self._image_source_generations()
+
+        links = [h5py.ExternalLink(os.path.relpath(os.path.abspath(file_path), destination_directory), "/image_data") for file_path in source_file_paths]
+
+        destination._link_image_sources(links, generations)
+
+        destination.annotation_classes = set(self.annotation_classes)
+        destination.labels = OrderedIndex(self.labels)
+        destination.metas = OrderedIndex(self.metas)
+
+        for offset in range(0, len(keys), chunk_rows):
+            chunk_keys = keys[offset:offset + chunk_rows]
+            rows = np.array([self.keys.position(key) for key in chunk_keys], dtype="int64")
+
+            batch = self.get_batch(chunk_keys, fields=("shape", "bounding_boxes_array"))
+            image_sources, image_offsets, image_hashes = self._image_links(rows)
+
+            destination._append_rows(chunk_keys, [None] * len(chunk_keys), batch["shape"], batch["bounding_boxes_array"], image_links=(image_sources + 1, image_offsets, image_hashes))
+
+        destination.commit()
+
+        for file_path in source_file_paths:
+            _register_derived_library(file_path, destination.file_path)
+
+        return destination
+
+    # Move the embedded images into a content-addressed Image Store, leaving only their hashes in the library, then compact
+    # Images already in the store (from this or any other library) aren't stored twice. Returns the bytes reclaimed
+    def dedupe(self, image_store="data/image_store", chunk_rows=1024):
+        if self.read_only or self.version < 2 or self._swmr_writing:
+            raise AnnotationLibraryError("Deduplicating images requires a writable, non-SWMR Version 2 Annotation Library...")
+
+        if self.image_store is None:
+            self.image_store = self._detect_image_store(image_store)
+
+        self.commit()
+
+        source_size = os.path.getsize(self.file_path)
+
+        for offset in range(0, len(self.keys), chunk_rows):
+            rows = np.arange(offset, min(offset + chunk_rows, len(self.keys)), dtype="int64")
+
+            image_offsets = self.h5_file["image_offsets"][offset:offset + len(rows)]
+            embedded = np.flatnonzero(image_offsets[:, 1] > image_offsets[:, 0])
+
+            if not len(embedded):
+                continue
+
+            image_hashes = list()
+
+            # Images linked from source libraries move to the store as well
+            for image_bytes in self._read_images(rows[embedded]):
+                image_hashes.append(self.image_store.put(image_bytes))
+
+            _write_rows(self.h5_file["image_hashes"], rows[embedded], image_hashes)
+            _write_rows(self.h5_file["image_offsets"], rows[embedded], np.zeros((len(embedded), 2), dtype="int64"))
+
+            if self._derived:
+                _write_rows(self.h5_file["image_sources"], rows[embedded], np.zeros(len(embedded), dtype="uint16"))
+
+        self.rebuild_image_references()
+
+        self.commit()
+        self.compact(chunk_rows=chunk_rows)
+
+        return source_size - os.path.getsize(self.file_path)
+
+    # Kept for backwards compatibility
+    def repack(self):
+        return self.compact()
+
+    # Fraction of the file taken up by space HDF5 knows to be free, plus flat table rows orphaned by replacements
+    def free_space_ratio(self):
+        self.flush()
+
+        file_size = os.path.getsize(self.file_path)
+
+        if not file_size:
+            return 0.0
+
+        free_bytes = self.h5_file.id.get_freespace()
+
+        if self.version >= 2:
+            deleted_rows = np.fromiter(self._deleted_rows, dtype="int64", count=len(self._deleted_rows))
+
+            # The data of deleted entries is free space as well
+            for name, offsets_name in RAGGED_TABLES:
+                offsets = np.delete(self.h5_file[offsets_name][()], deleted_rows, axis=0)
+                live_rows = int((offsets[:, 1] - offsets[:, 0]).sum()) if len(offsets) else 0
+
+                free_bytes += (self.h5_file[name].shape[0] - live_rows) * self.h5_file[name].dtype.itemsize
+
+        return min(free_bytes / file_size, 1.0)
+
+    # CRC32 over every entry's image bytes, shape and bounding boxes (with labels and meta resolved), in entry order
+    # Restricted to 'keys', in their order, when given
+    def checksum(self, batch_size=1024, keys=None):
+        checksum = 0
+
+        keys = self.entries[:] if keys is None else list(keys)
+
+        for offset in range(0, len(keys), batch_size):
+            batch = self.get_batch(keys[offset:offset + batch_size], fields=("image_bytes", "shape", "bounding_boxes_array"))
+
+            for image_bytes, image_shape, bounding_boxes in zip(batch["image_bytes"], batch["shape"], batch["bounding_boxes_array"]):
+                checksum = zlib.crc32(image_bytes, checksum)
+                checksum = zlib.crc32(np.asarray(image_shape, dtype="int64").tobytes(), checksum)
+
+                for field in ["y0", "x0", "y1", "x1"]:
+                    checksum = zlib.crc32(np.ascontiguousarray(bounding_boxes[field]).tobytes(), checksum)
+
+                labels = [self.labels[label] for label in bounding_boxes["label"].tolist()]
+                metas = [self.metas[meta] for meta in bounding_boxes["meta"].tolist()]
+
+                checksum = zlib.crc32("\n".join(labels + metas).encode("utf-8"), checksum)
+
+        return checksum
+
+    @staticmethod
+    def _decode_image(image_bytes):
+        image_array = np.array(Image.open(io.BytesIO(image_bytes)), dtype="uint8")
+
+        # The image sets are mixes of 2 and 3 channel images
+        # We are going to make sure we only work with 3, for consistency
+        if len(image_array.shape) == 2:
+            image_array = np.repeat(image_array[:, :, np.newaxis], 3, axis=2)
+
+        return image_array
+
+    # Everything add_complete_entry needs from an entry, apart from the image file contents
+    def _prepare_complete_entry(self, entry):
+        key = entry["file_location"].replace(".png", "")
+
+        # Image Shape
+        image_shape = (entry["height"], entry["width"], 3)
+
+        # Bounding Boxes
+        bounding_boxes = list()
+
+        for bounding_box in entry["bounding_boxes"]:
+            if "meta" not in bounding_box:
+                bounding_box["meta"] = "N/A"
+
+            bounding_boxes.append((
+                bounding_box["top"],
+                bounding_box["left"],
+                bounding_box["bottom"],
+                bounding_box["right"],
+                bounding_box["annotation_class"].encode("utf-8"),
+                bounding_box["meta"].encode("utf-8")
+            ))
+
+            self.annotation_classes.add(bounding_box["annotation_class"])
+
+        return key, image_shape, bounding_boxes
+
+    # Version 2: Append new entries as one contiguous block of rows, with a single resize and write per dataset
+    # Bounding boxes are either encoded rows or structured arrays already using this library's label and meta ids
+    # 'image_links' are optional (sources, offsets, hashes) rows; rows with a non-zero source keep their image in that
+    # source library (see derive()) and have None as image bytes
+    def _append_rows(self, keys, images, image_shapes, bounding_boxes, image_links=None):
+        start = len(self.keys)
+        count = len(keys)
+
+        bounding_boxes = [
+            entry_bounding_boxes if getattr(entry_bounding_boxes, "dtype", None) == BOUNDING_BOX_DTYPE else self._bounding_box_array(entry_bounding_boxes)
+            for entry_bounding_boxes in bounding_boxes
+        ]
+
+        for key, entry_bounding_boxes in zip(keys, bounding_boxes):
+            self.keys.add(key)
+
+            self.statistics.add_entry()
+            self.statistics.replace_bounding_boxes(entry_bounding_boxes[:0], entry_bounding_boxes, self.labels, self.metas)
+
+        for dataset in ROW_DATASETS:
+            self.h5_file[dataset].resize(start + count, axis=0)
+
+        if image_links is None:
+            image_links = (np.zeros(count, dtype="int64"), np.zeros((count, 2), dtype="int64"), [None] * count)
+
+        image_sources, image_offsets, image_hashes = np.asarray(image_links[0]), np.array(image_links[1], dtype="int64").reshape(-1, 2), list(image_links[2])
+        own_rows = np.flatnonzero(image_sources == 0).tolist()
+
+        for i in own_rows:
+            image_hashes[i] = ImageStore.hash(images[i])
+
+        if self.image_store is not None:
+            for i in own_rows:
+                self.image_store.put(images[i], image_hashes[i])
+
+            image_offsets[own_rows] = 0
+        elif len(own_rows):
+            image_offsets[own_rows] = self._append_ragged("image_data", [np.frombuffer(images[i], dtype="uint8") for i in own_rows])
+
+        self.h5_file["image_offsets"][start:start + count] = image_offsets
+        self.h5_file["image_hashes"][start:start + count] = image_hashes
+
+        for image_hash in image_hashes:
+            self._change_image_reference(image_hash, 1)
+
+        self.h5_file["image_sources"][start:start + count] = image_sources
+        self.h5_file["shapes"][start:start + count] = np.array(image_shapes, dtype="int32").reshape(-1, 3)
+        self.h5_file["bounding_box_offsets"][start:start + count] = self._append_ragged("bounding_boxes", bounding_boxes)
+
+        self.h5_file["spatial_index_cell_offsets"][start:start + count] = 0
+        self._spatial_index_dirty.update(range(start, start + count))
+
+    # Version 2: Append the given entries of another Annotation Library (of any version, sharded or not)
+    # Label and meta ids are translated from the source's dictionaries into this library's
+    def _copy_entries(self, source, keys=None, chunk_rows=1024):
+        keys = list(source.entries if keys is None else keys)
+
+        for key in keys:
+            if key in self.keys:
+                raise AnnotationLibraryError(f"Annotation Library '{self.name}' already has an entry for '{key}'...")
+
+        for offset in range(0, len(keys), chunk_rows):
+            chunk_keys = keys[offset:offset + chunk_rows]
+            batch = source.get_batch(chunk_keys, fields=("image_bytes", "shape", "bounding_boxes_array"))
+
+            # Version 1 sources build their dictionaries while reading, so the maps are made after the batch
+            label_map = _dictionary_map(source.labels, self.labels)
+            meta_map = _dictionary_map(source.metas, self.metas)
+
+            self.annotation_classes |= source.annotation_classes
+
+            bounding_boxes = [_translate_bounding_boxes(bounding_box_array, label_map, meta_map) for bounding_box_array in batch["bounding_boxes_array"]]
+
+            self._append_rows(chunk_keys, batch["image_bytes"], batch["shape"], bounding_boxes)
+
+    # Images are embedded in 'image_data', or kept in the Image Store and referenced by their 'image_hashes' row
+    def _write_image(self, row, image_bytes):
+        image_hash = ImageStore.hash(image_bytes)
+
+        self._change_image_reference(_decode(self.h5_file["image_hashes"][row]), -1)
+        self._change_image_reference(image_hash, 1)
+
+        # Images are never overwritten in place, libraries derived from this one may still read the old bytes. Neither are
+        # those that sit in a source library
+        self.h5_file["image_offsets"][row] = (0, 0)
+
+        if self._derived:
+            self.h5_file["image_sources"][row] = 0
+
+        if self.image_store is not None:
+            self.image_store.put(image_bytes, image_hash)
+        else:
+            self._write_ragged_row("image_data", "image_offsets", row, np.frombuffer(image_bytes, dtype="uint8"))
+
+        self.h5_file["image_hashes"][row] = image_hash
+
+    def _change_image_reference(self, image_hash, change):
+        if self.image_store is None or not image_hash:
+            return
+
+        if not self._image_reference_changes:
+            self.image_store.mark_pending(self._image_store_id)
+
+        self._image_reference_changes[image_hash] = self._image_reference_changes.get(image_hash, 0) + change
+
+    @property
+    def _image_store_id(self):
+        return _decode(self.h5_file.attrs["image_store_id"])
+
+    @property
+    def _derived(self):
+        return self.version >= 2 and "image_source_links" in self.h5_file
+
+    # Bytes of the rows' images, read from this library's 'image_data', from the libraries it was derived from, or from
+    # the Image Store
+    def _read_images(self, rows, workers=None):
+        rows = np.asarray(rows, dtype="int64")
+
+        image_offsets = np.array(_coalesced_read(self.h5_file["image_offsets"], rows)).reshape(-1, 2)
+        image_sources = np.array(_coalesced_read(self.h5_file["image_sources"], rows), dtype="int64") if self._derived else np.zeros(len(rows), dtype="int64")
+
+        image_bytes = [b""] * len(rows)
+
+        for source in np.unique(image_sources).tolist():
+            indices = np.flatnonzero(image_sources == source)
+
+            for i, image in zip(indices.tolist(), _coalesced_read_ranges(self._image_source(source), image_offsets[indices])):
+                image_bytes[i] = image.tobytes()
+
+        if self.image_store is not None:
+            self._read_stored_images(rows, image_offsets, image_bytes, workers)
+
+        return image_bytes
+
+    # The 'image_data' table of an image source: 0 is this library's own, the others are external links
+    # Links are opened read-only, so source libraries can be read by any number of processes at the same time
+    def _image_source(self, source):
+        if not source:
+            return self.h5_file["image_data"]
+
+        link_access = h5py.h5p.create(h5py.h5p.LINK_ACCESS)
+        link_access.set_elink_acc_flags(h5py.h5f.ACC_RDONLY)
+
+        image_data = h5py.Dataset(h5py.h5o.open(self.h5_file["image_source_links"].id, str(source).encode("utf-8"), lapl=link_access))
+
+        # The offsets of this library are only valid for the 'image_data' it was linked to
+        if _decode(image_data.file.attrs.get("image_data_generation", "")) != self._image_source_generations()[source - 1]:
+            raise AnnotationLibraryError(f"'{image_data.file.filename}' was compacted without relinking Annotation Library '{self.name}', which was derived from it. Derive it again...")
+
+        return image_data
+
+    # Changed whenever compaction rewrites 'image_data'; libraries that were never compacted have none
+    @property
+    def _image_data_generation(self):
+        return _decode(self.h5_file.attrs.get("image_data_generation", ""))
+
+    # Generations of the image sources 1..N as of linking them; not recorded by libraries derived before they existed
+    def _image_source_generations(self):
+        if "image_source_generations" not in self.h5_file.attrs:
+            return [""] * len(self.h5_file["image_source_links"])
+
+        return json.loads(self.h5_file.attrs["image_source_generations"])
+
+    # (image_sources, image_offsets, image_hashes) of the rows, see _append_rows()
+    def _image_links(self, rows):
+        image_sources = np.array(_coalesced_read(self.h5_file["image_sources"], rows), dtype="int64") if self._derived else np.zeros(len(rows), dtype="int64")
+        image_offsets = np.array(_coalesced_read(self.h5_file["image_offsets"], rows), dtype="int64").reshape(-1, 2)
+        image_hashes = [_decode(image_hash) for image_hash in _coalesced_read(self.h5_file["image_hashes"], rows)]
+
+        return image_sources, image_offsets, image_hashes
+
+    # Image sources 1..N, as HDF5 external links to the 'image_data' of other libraries (relative to this file's directory)
+    def _link_image_sources(self, links, generations):
+        group = self.h5_file.require_group("image_source_links")
+
+        for source, link in enumerate(links, start=1):
+            if str(source) in group:
+                del group[str(source)]
+
+            group[str(source)] = h5py.ExternalLink(link.filename, link.path)
+
+        self.h5_file.attrs["image_source_generations"] = json.dumps(generations)
+
+    # Relink the libraries derived from this one to 'destination', its compacted copy, before it replaces this file
+    # All of them are opened first, so one that can't be opened leaves every library as it was
+    def _relink_derived_libraries(self, destination):
+        derived_libraries = list()
+
+        try:
+            for file_path in self._derived_libraries():
+                derived_libraries.append(AnnotationLibrary.load(file_path))
+
+            for derived_library in derived_libraries:
+                derived_library._relink_image_source(self.file_path, destination)
+        finally:
+            for derived_library in derived_libraries:
+                derived_library.close()
+
+    # Derived libraries registered by derive(), minus those deleted since
+    def _derived_libraries(self):
+        sidecar_path = f"{self.file_path}{DERIVED_LIBRARIES_EXTENSION}"
+
+        if not os.path.isfile(sidecar_path):
+            return list()
+
+        with open(sidecar_path, "r") as f:
+            file_paths = [os.path.join(os.path.dirname(os.path.abspath(self.file_path)), file_path) for file_path in json.load(f)]
+
+        return [file_path for file_path in file_paths if os.path.isfile(file_path)]
+
+    # Point the rows whose image sits in the library at 'file_path' to the offsets of the same image (by hash) in
+    # 'destination', the compacted copy of that library. Images compaction drops (those of deleted entries, or moved to
+    # the Image Store by dedupe()) are first written to this library, or to the store, while the old file still has them
+    def _relink_image_source(self, file_path, destination):
+        if not self._derived:
+            return
+
+        directory = os.path.dirname(os.path.abspath(self.file_path))
+        links = self.h5_file["image_source_links"]
+
+        sources = [int(source) for source in links if os.path.abspath(os.path.join(directory, links.get(source, getlink=True).filename)) == os.path.abspath(file_path)]
+
+        destination_rows = len(destination.keys)
+        destination_offsets = destination.h5_file["image_offsets"][:destination_rows]
+        embedded = (destination_offsets[:, 1] > destination_offsets[:, 0]) & (destination.h5_file["image_sources"][:destination_rows] == 0)
+
+        new_offsets = dict(zip(destination.h5_file["image_hashes"][:destination_rows][embedded].tolist(), destination_offsets[embedded].tolist()))
+
+        image_offsets = self.h5_file["image_offsets"][:len(self.keys)]
+        image_hashes = self.h5_file["image_hashes"][:len(self.keys)]
+
+        rows = np.flatnonzero(np.isin(self.h5_file["image_sources"][:len(self.keys)], sources) & (image_offsets[:, 1] > image_offsets[:, 0]))
+
+        moved = np.array([row for row in rows.tolist() if image_hashes[row] in new_offsets], dtype="int64")
+        dropped = np.array([row for row in rows.tolist() if image_hashes[row] not in new_offsets], dtype="int64")
+
+        adopt_image_store = len(dropped) and self.image_store is None and destination.image_store is not None
+
+        if adopt_image_store:
+            self.image_store = self._detect_image_store(destination.image_store.path)
+
+        for row, image_bytes in zip(dropped.tolist(), self._read_images(dropped)):
+            self._write_image(row, image_bytes)
+
+        # None of this library's images were referenced in the store until now
+        if adopt_image_store:
+            self.rebuild_image_references()
+
+        _write_rows(self.h5_file["image_offsets"], moved, np.array([new_offsets[image_hashes[row]] for row in moved.tolist()], dtype="int64").reshape(-1, 2))
+
+        generations = self._image_source_generations()
+
+        for source in sources:
+            generations[source - 1] = destination._image_data_generation
+
+        self.h5_file.attrs["image_source_generations"] = json.dumps(generations)
+
+        self.commit()
+
+    # Fill in the bytes of the rows whose image lives in the Image Store (empty offsets and a hash)
+    def _read_stored_images(self, rows, image_offsets, image_bytes, workers=None):
+        stored = np.flatnonzero(image_offsets[:, 1] <= image_offsets[:, 0])
+
+        if not len(stored):
+            return
+
+        image_hashes = [_decode(image_hash) for image_hash in _coalesced_read(self.h5_file["image_hashes"], rows[stored])]
+        stored = [(i, image_hash) for i, image_hash in zip(stored.tolist(), image_hashes) if image_hash]
+
+        for (i, _), stored_image_bytes in zip(stored, self.image_store.get_many([image_hash for _, image_hash in stored], workers)):
+            image_bytes[i] = stored_image_bytes
+
+    # Append a list of arrays to the end of a flat table with a single write, returning their (start, end) rows
+    def _append_ragged(self, name, arrays):
+        table = self.h5_file[name]
+        table_start = table.shape[0]
+
+        counts = np.array([len(array) for array in arrays], dtype="int64")
+        ends = table_start + np.cumsum(counts)
+
+        if counts.sum():
+            table.resize(ends[-1], axis=0)
+            table[table_start:] = np.concatenate(arrays)
+
+        return np.stack([ends - counts, ends], axis=1)
+
+    # PIL releases the GIL while decoding, so a thread pool decodes PNGs in parallel
+    # Missing bytes (None) are only expected for keys already held in the image cache
+    def _decode_images(self, keys, image_bytes, workers=None):
+        image_arrays = [None] * len(keys)
+        pending = list()
+
+        for i, key in enumerate(keys):
+            if self.image_cache is not None:
+                image_arrays[i] = self.image_cache.get(key)
+
+            if image_arrays[i] is None:
+                if image_bytes[i] is None:
+                    image_bytes[i] = self.get_image_bytes(key)
+
+                pending.append(i)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for i, image_array in zip(pending, executor.map(self._decode_image, [image_bytes[i] for i in pending])):
+                if self.image_cache is not None:
+                    image_array.flags.writeable = False
+                    self.image_cache.put(keys[i], image_array)
+
+                image_arrays[i] = image_array
+
+        return image_arrays
+
+    def _load_statistics(self):
+        if "statistics" in self.h5_file.attrs:
+            return AnnotationLibraryStatistics.from_json(json.loads(_decode(self.h5_file.attrs["statistics"])))
+
+        statistics = AnnotationLibraryStatistics()
+
+        keys = self.entries[:]
+
+        for offset in range(0, len(keys), 1024):
+            for bounding_boxes in self.get_batch(keys[offset:offset + 1024], fields=("bounding_boxes_array",))["bounding_boxes_array"]:
+                statistics.add_entry()
+                statistics.replace_bounding_boxes(bounding_boxes[:0], bounding_boxes, self.labels, self.metas)
+
+        return statistics
+
+    def _open_pixel_sidecar(self):
+        if "pixel_sidecar" not in self.h5_file.attrs:
+            return None
+
+        file_path = os.path.join(os.path.dirname(self.file_path), _decode(self.h5_file.attrs["pixel_sidecar"]))
+
+        if not os.path.isfile(file_path):
+            return None
+
+        pixels = np.load(file_path, mmap_mode="r")
+
+        return pixels[:int(self.h5_file.attrs["pixel_sidecar_rows"])]
+
+    def _drop_pixel_sidecar(self):
+        self.pixels = None
+
+        if self.read_only or "pixel_sidecar" not in self.h5_file.attrs:
+            return
+
+        if self._swmr_writing:
+            raise AnnotationLibraryError("Materialized images can't be replaced in SWMR mode...")
+
+        file_path = os.path.join(os.path.dirname(self.file_path), _decode(self.h5_file.attrs["pixel_sidecar"]))
+
+        del self.h5_file.attrs["pixel_sidecar"]
+        del self.h5_file.attrs["pixel_sidecar_rows"]
+
+        if os.path.isfile(file_path):
+            os.remove(file_path)
+
+    def _in_pixel_sidecar(self, keys):
+        if self.pixels is None:
+            return False
+
+        return all(key in self.keys and self.keys.position(key) < len(self.pixels) and self.keys.position(key) not in self._deleted_rows for key in keys)
+
+    # Contiguous ascending rows come back as a zero-copy memmap slice, anything else as a single gathered copy
+    def _read_pixel_sidecar(self, keys):
+        rows = np.array([self.keys.position(key) for key in keys], dtype="int64")
+
+        if len(rows) and (rows == np.arange(rows[0], rows[0] + len(rows))).all():
+            return self.pixels[rows[0]:rows[0] + len(rows)]
+
+        return self.pixels[rows]
+
+    def _open_file(self):
+        if not self.swmr:
+            return h5py.File(self.file_path, "r" if self.read_only else "a")
+
+        if self.read_only:
+            return h5py.File(self.file_path, "r", libver="latest", swmr=True)
+
+        return h5py.File(self.file_path, "a", libver="latest")
+
+    @property
+    def _swmr_writing(self):
+        return not self.read_only and self.h5_file.id.valid and self.h5_file.swmr_mode
+
+    # Once SWMR mode starts, no dataset or attribute can be created or deleted. Everything a writer touches has to exist
+    # beforehand, and the tables that are normally rewritten on commit become resizable so they can be appended to
+    def _start_swmr(self):
+        if self.version < 2:
+            raise AnnotationLibraryError("SWMR mode requires a Version 2 Annotation Library. Use AnnotationLibrary.migrate()...")
+
+        # Files created without the latest file format are rewritten in it first
+        if self.h5_file.id.get_create_plist().get_version()[0] < 3:
+            print(f"Upgrading the file format of Annotation Library '{self.name}' for SWMR...")
+            self.compact()
+
+        tables = [
+            ("keys", list(self.keys)),
+            ("annotation_classes", sorted(self.annotation_classes)),
+            ("labels", list(self.labels)),
+            ("metas", list(self.metas))
+        ]
+
+        for name, values in tables:
+            if name in self.h5_file and self.h5_file[name].maxshape[0] is None and self.h5_file[name].dtype.kind == "S":
+                continue
+
+            if name in self.h5_file:
+                del self.h5_file[name]
+
+            self._create_dataset(name, shape=(0,), maxshape=(None,), dtype=f"S{SWMR_STRING_LENGTH}")
+            self._append_table(name, values)
+
+        self.commit_statistics()
+        self.h5_file.flush()
+
+        self.h5_file.swmr_mode = True
+
+    # Readers trust the key table, so everything a key points at is flushed before the key is appended
+    def _commit_swmr(self):
+        self.commit_image_references()
+        self.commit_spatial_index()
+
+        for name in [*[name for name, _ in RAGGED_TABLES], *ROW_DATASETS]:
+            self.h5_file[name].flush()
+
+        self.commit_annotation_classes()
+        self.commit_dictionaries()
+        self.commit_keys()
+        self.commit_tombstones()
+
+        self.h5_file["tombstones"].flush()
+        self.h5_file.flush()
+
+    # Version 2 tables are resizable; those written before are converted once, on the first commit that needs them
+    def _appendable_table(self, name):
+        if name in self.h5_file and self.h5_file[name].maxshape[0] is None:
+            return self.h5_file[name]
+
+        values = self.h5_file[name][()] if name in self.h5_file else list()
+
+        if name in self.h5_file:
+            del self.h5_file[name]
+
+        dataset = self._create_dataset(name, shape=(0,), maxshape=(None,), dtype=h5py.special_dtype(vlen=bytes))
+
+        if len(values):
+            dataset.resize(len(values), axis=0)
+            dataset[:] = values
+
+        return dataset
+
+    def _append_table(self, name, values):
+        if not len(values):
+            return
+
+        encoded_values = [value.encode("utf-8") for value in values]
+
+        # SWMR tables hold fixed-length strings
+        if self.h5_file[name].dtype.kind == "S":
+            for encoded_value in encoded_values:
+                if len(encoded_value) > self.h5_file[name].dtype.itemsize:
+                    raise AnnotationLibraryError(f"'{encoded_value.decode('utf-8')}' is longer than the {SWMR_STRING_LENGTH} bytes SWMR tables can hold...")
+
+        dataset = self.h5_file[name]
+        start = dataset.shape[0]
+
+        dataset.resize(start + len(values), axis=0)
+        dataset[start:] = encoded_values
+        dataset.flush()
+
+    def _detect_version(self, version):
+        if "version" in self.h5_file.attrs:
+            return int(self.h5_file.attrs["version"])
+
+        # Files written before versioning was introduced
+        if len(self.h5_file):
+            return 1
+
+        version = version or LATEST_VERSION
+
+        if not self.read_only:
+            self.h5_file.attrs["version"] = version
+
+        return version
+
+    def _detect_storage(self, storage):
+        if "storage" in self.h5_file.attrs:
+            return {**DEFAULT_STORAGE, **json.loads(_decode(self.h5_file.attrs["storage"]))}
+
+        storage = {**DEFAULT_STORAGE, **(storage or dict())}
+
+        if storage["compression"] not in COMPRESSIONS:
+            raise AnnotationLibraryError(f"'compression' is expected to be one of: {', '.join(str(c) for c in COMPRESSIONS)}")
+
+        if not self.read_only:
+            self.h5_file.attrs["storage"] = json.dumps(storage)
+
+        return storage
+
+    def _detect_image_store(self, image_store):
+        if "image_store" in self.h5_file.attrs:
+            if image_store is not None and image_store != _decode(self.h5_file.attrs["image_store"]):
+                raise AnnotationLibraryError(f"Annotation Library '{self.name}' already references Image Store '{_decode(self.h5_file.attrs['image_store'])}'...")
+
+            return ImageStore(_decode(self.h5_file.attrs["image_store"]))
+
+        if image_store is None:
+            return None
+
+        if self.version < 2 or self.read_only or self._swmr_writing:
+            raise AnnotationLibraryError("Referencing an Image Store requires a writable Version 2 Annotation Library...")
+
+        # Identifies this library's references in the store; kept by compaction, which copies the attributes
+        self.h5_file.attrs["image_store"] = image_store
+        self.h5_file.attrs["image_store_id"] = uuid.uuid4().hex
+
+        return ImageStore(image_store)
+
+    def _create_layout(self):
+        layout = [
+            ("image_data", dict(shape=(0,), maxshape=(None,), dtype="uint8")),
+            ("image_offsets", dict(shape=(0, 2), maxshape=(None, 2), dtype="int64")),
+            ("image_hashes", dict(shape=(0,), maxshape=(None,), dtype=f"S{IMAGE_HASH_LENGTH}")),
+            ("image_sources", dict(shape=(0,), maxshape=(None,), dtype="uint16")),
+            ("shapes", dict(shape=(0, 3), maxshape=(None, 3), dtype="int32")),
+            ("bounding_box_offsets", dict(shape=(0, 2), maxshape=(None, 2), dtype="int64")),
+            ("bounding_boxes", dict(shape=(0,), maxshape=(None,), dtype=BOUNDING_BOX_DTYPE)),
+            ("spatial_index_cell_offsets", dict(shape=(0, 2), maxshape=(None, 2), dtype="int64")),
+            ("spatial_index_cells", dict(shape=(0,), maxshape=(None,), dtype="int32")),
+            ("spatial_index_box_offsets", dict(shape=(0, 2), maxshape=(None, 2), dtype="int64")),
+            ("spatial_index_boxes", dict(shape=(0,), maxshape=(None,), dtype="int32")),
+            ("tombstones", dict(shape=(0,), maxshape=(None,), dtype="uint8"))
+        ]
+
+        # Libraries written before a dataset was introduced get it on their next writable open
+        # Row datasets are then grown to the entry count by _discard_uncommitted_rows(), with (0, 0) offsets
+        for name, kwargs in layout:
+            if name not in self.h5_file:
+                self._create_dataset(name, **kwargs)
+
+    # All datasets go through here so they pick up the library's storage options
+    def _create_dataset(self, name, **kwargs):
+        options = dict()
+
+        chunk_rows = self.storage["chunks"].get(name)
+
+        if chunk_rows and "maxshape" in kwargs:
+            options["chunks"] = (chunk_rows, *kwargs["maxshape"][1:])
+
+        # Filters require chunking, which isn't possible for fixed-size empty datasets
+        shape = kwargs["shape"] if "shape" in kwargs else np.shape(kwargs.get("data"))
+
+        if "maxshape" in kwargs or np.prod(shape):
+            if self.storage["compression"] is not None:
+                options["compression"] = self.storage["compression"]
+
+                if self.storage["compression_opts"] is not None:
+                    options["compression_opts"] = self.storage["compression_opts"]
+
+            if self.storage["shuffle"]:
+                options["shuffle"] = True
+
+        return self.h5_file.create_dataset(name, **kwargs, **options)
+
+    def _allocate_row(self, key):
+        if key in self.keys and self.keys.position(key) not in self._deleted_rows:
+            return self.keys.position(key)
+
+        if key in self.keys:
+            # A deleted entry that's added again starts over from an empty row
+            row = self.keys.position(key)
+
+            self._change_image_reference(_decode(self.h5_file["image_hashes"][row]), -1)
+
+            self.h5_file["image_hashes"][row] = b""
+            self.h5_file["image_sources"][row] = 0
+            self.h5_file["shapes"][row] = 0
+
+            self._set_deleted(row, False)
+        else:
+            row = self.keys.add(key)
+
+            for dataset in ROW_DATASETS:
+                self.h5_file[dataset].resize(row + 1, axis=0)
+
+        for dataset in ["image_offsets", "bounding_box_offsets", "spatial_index_cell_offsets", "spatial_index_box_offsets"]:
+            self.h5_file[dataset][row] = (0, 0)
+
+        self.statistics.add_entry()
+
+        return row
+
+    # Rows written after the last commit have no key and can't be addressed; drop them
+    def _discard_uncommitted_rows(self):
+        for dataset in ROW_DATASETS:
+            self.h5_file[dataset].resize(len(self.keys), axis=0)
+
+    def _write_bounding_boxes(self, row, bounding_boxes):
+        start, end = self.h5_file["bounding_box_offsets"][row]
+
+        self.statistics.replace_bounding_boxes(self.h5_file["bounding_boxes"][start:end], bounding_boxes, self.labels, self.metas)
+
+        self._write_ragged_row("bounding_boxes", "bounding_box_offsets", row, bounding_boxes)
+
+        self._invalidate_spatial_index([row])
+
+    # The index of rebuilt entries is appended on commit; until then queries scan their bounding boxes
+    def _invalidate_spatial_index(self, rows):
+        for row in rows:
+            self.h5_file["spatial_index_cell_offsets"][row] = (0, 0)
+
+        self._spatial_index_dirty.update(rows)
+
+    # Shrinking (or same-size) replacements are written in place, growing ones are appended at the end of the table
+    # The rows left behind are dead space until the library is compacted
+    def _write_ragged_row(self, name, offsets_name, row, values):
+        offsets = self.h5_file[offsets_name]
+        table = self.h5_file[name]
+
+        start, end = offsets[row]
+
+        if len(values) > end - start:
+            start = table.shape[0]
+            table.resize(start + len(values), axis=0)
+
+        if len(values):
+            table[start:start + len(values)] = values
+
+        offsets[row] = (start, start + len(values))
+
+    # Sorted positions of the entry's bounding boxes listed in the grid cells the window touches; all of them without an index
+    def _spatial_index_candidates(self, key, y0, x0, y1, x1, bounding_box_count):
+        if self.version < 2 or "spatial_index_cell_offsets" not in self.h5_file:
+            return np.arange(bounding_box_count)
+
+        row = self.keys.position(key)
+        cells_start, cells_end = self.h5_file["spatial_index_cell_offsets"][row]
+
+        if cells_end <= cells_start:
+            return np.arange(bounding_box_count)
+
+        boxes_start, boxes_end = self.h5_file["spatial_index_box_offsets"][row]
+
+        cells = self.h5_file["spatial_index_cells"][cells_start:cells_end]
+        boxes = self.h5_file["spatial_index_boxes"][boxes_start:boxes_end]
+
+        cell_size, grid_height, grid_width = cells[:3].tolist()
+        cell_starts = cells[3:]
+
+        cell_y0, cell_y1 = np.clip(np.floor_divide([y0, y1], cell_size), 0, grid_height - 1).astype("int64").tolist()
+        cell_x0, cell_x1 = np.clip(np.floor_divide([x0, x1], cell_size), 0, grid_width - 1).astype("int64").tolist()
+
+        candidates = [
+            boxes[cell_starts[cell]:cell_starts[cell + 1]]
+            for cell_y in range(cell_y0, cell_y1 + 1)
+            for cell in range(cell_y * grid_width + cell_x0, cell_y * grid_width + cell_x1 + 1)
+        ]
+
+        return np.unique(np.concatenate(candidates)) if len(candidates) else np.arange(0)
+
+    def _populate_keys(self):
+        if "keys" in self.h5_file:
+            return OrderedIndex([key.decode("utf-8") for key in self.h5_file["keys"][()]])
+        else:
+            return OrderedIndex()
+
+    def _populate_tombstones(self):
+        if self.version < 2 or "tombstones" not in self.h5_file:
+            return set()
+
+        bits = _unpack_bits(self.h5_file["tombstones"][()])[:len(self.keys)]
+
+        return set(np.flatnonzero(bits).tolist())
+
+    def _set_deleted(self, row, deleted):
+        if deleted:
+            self._deleted_rows.add(row)
+        else:
+            self._deleted_rows.discard(row)
+
+        self._tombstones_dirty.add(row // 8)
+        self._live_entries = None
+
+    def _populate_annotation_classes(self):
+        if "annotation_classes" in self.h5_file:
+            return set([annotation_class.decode("utf-8") for annotation_class in self.h5_file["annotation_classes"][()]])
+        else:
+            return set()
+
+    def _populate_dictionary(self, name):
+        if name in self.h5_file:
+            return OrderedIndex([value.decode("utf-8") for value in self.h5_file[name][()]])
+        else:
+            return OrderedIndex()
+
+    # Go from a structured array to dicts
+    def _format_bounding_boxes(self, bounding_boxes):
+        labels = [self.labels[label] for label in bounding_boxes["label"].tolist()]
+        metas = [self.metas[meta] for meta in bounding_boxes["meta"].tolist()]
+
+        return [
+            {"y0": y0, "x0": x0, "y1": y1, "x1": x1, "label": label, "meta": meta}
+            for y0, x0, y1, x1, label, meta in zip(
+                bounding_boxes["y0"].astype("int").tolist(),
+                bounding_boxes["x0"].astype("int").tolist(),
+                bounding_boxes["y1"].astype("int").tolist(),
+                bounding_boxes["x1"].astype("int").tolist(),
+                labels,
+                metas
+            )
+        ]
+
+    # Go from dict to encoded in HDF5 dataset
+    def _encode_bounding_boxes(self, bounding_boxes):
+        return [self._encode_bounding_box(bounding_box) for bounding_box in bounding_boxes]
+
+    def _encode_bounding_box(self, bounding_box):
+        return [
+            bounding_box["y0"],
+            bounding_box["x0"],
+            bounding_box["y1"],
+            bounding_box["x1"],
+            bounding_box["label"].encode("utf-8"),
+            (bounding_box["meta"] or "N/A").encode("utf-8")
+        ]
+
+    # Go from encoded rows (Version 1 dataset rows or the output of _encode_bounding_boxes) to a structured array
+    def _bounding_box_array(self, bounding_boxes):
+        bounding_box_array = np.zeros(len(bounding_boxes), dtype=BOUNDING_BOX_DTYPE)
+
+        for i, bounding_box in enumerate(bounding_boxes):
+            label = _decode(bounding_box[4])
+            self.annotation_classes.add(label)
+
+            bounding_box_array[i] = (
+                float(bounding_box[0]),
+                float(bounding_box[1]),
+                float(bounding_box[2]),
+                float(bounding_box[3]),
+                self.labels.add(label),
+                self.metas.add(_decode(bounding_box[5]))
+            )
+
+        return bounding_box_array
+
+    @classmethod
+    def load(cls, name_or_path, **kwargs):
+        from cosmoquest_data_tools.sharded_annotation_library import ShardedAnnotationLibrary, SHARDED_MANIFEST_EXTENSION
+        from cosmoquest_data_tools.annotation_library_view import AnnotationLibraryView, ANNOTATION_LIBRARY_VIEW_EXTENSION
+
+        if os.path.isfile(name_or_path) and name_or_path.endswith(SHARDED_MANIFEST_EXTENSION):
+            return ShardedAnnotationLibrary.load(name_or_path, **kwargs)
+
+        if os.path.isfile(name_or_path) and name_or_path.endswith(ANNOTATION_LIBRARY_VIEW_EXTENSION):
+            return AnnotationLibraryView.load(name_or_path, **kwargs)
+
+        if os.path.isfile(name_or_path):
+            file_path = name_or_path
+            name = name_or_path.split("/")[-1].replace(".alh5", "")
+        else:
+            name = name_or_path
+            file_path = f"data/{name_or_path}.alh5"
+
+            # Sharded Annotation Libraries are loaded by name the same way, through their manifest
+            if not os.path.isfile(file_path) and os.path.isfile(f"data/{name_or_path}{SHARDED_MANIFEST_EXTENSION}"):
+                return ShardedAnnotationLibrary.load(name_or_path, **kwargs)
+
+            # So are saved Annotation Library Views, through their sidecar
+            if not os.path.isfile(file_path) and os.path.isfile(f"data/{name_or_path}{ANNOTATION_LIBRARY_VIEW_EXTENSION}"):
+                return AnnotationLibraryView.load(name_or_path, **kwargs)
+
+            if not os.path.isfile(file_path):
+                raise FileNotFoundError(file_path)
+
+        return cls(name, file_path=file_path, **kwargs)
+
+    @classmethod
+    def migrate(cls, name_or_path, destination_file_path=None):
+        source = cls.load(name_or_path, read_only=True)
+
+        if source.version >= LATEST_VERSION:
+            return source
+
+        in_place = destination_file_path is None
+        destination_file_path = destination_file_path or f"{source.file_path}.tmp"
+
+        destination = cls(source.name, file_path=destination_file_path, version=LATEST_VERSION)
+
+        for key in source.entries:
+            destination.add_entry(key, "image", [source.get_image_bytes(key)])
+            destination.add_entry(key, "shape", source.get_entry(key, "shape"))
+            destination.add_entry(key, "bounding-boxes", source.get_entry(key, "bounding-boxes"))
+
+        destination.annotation_classes |= source.annotation_classes
+        destination.commit()
+
+        source.close()
+        destination.close()
+
+        if in_place:
+            os.replace(destination_file_path, source.file_path)
+            destination_file_path = source.file_path
+
+        return cls(source.name, file_path=destination_file_path)
+
+    @classmethod
+    def discover(cls, path, metadata_only=False):
+        from cosmoquest_data_tools.sharded_annotation_library import SHARDED_MANIFEST_EXTENSION
+        from cosmoquest_data_tools.annotation_library_view import ANNOTATION_LIBRARY_VIEW_EXTENSION
+
+        if not os.path.isdir(path):
+            raise FileNotFoundError(path)
+
+        annotation_library_file_paths = list()
+
+        for root, dirs, files in os.walk(path):
+            if root != path:
+                break
+
+            for file in files:
+                if file.endswith((".alh5", SHARDED_MANIFEST_EXTENSION, ANNOTATION_LIBRARY_VIEW_EXTENSION)):
+                    annotation_library_file_paths.append(f"{root}/{file}")
+
+        # Summaries read from the file headers (see AnnotationLibraryCatalog), with the same as_json_minimal() as libraries
+        if metadata_only:
+            from cosmoquest_data_tools.annotation_library_catalog import AnnotationLibraryCatalog
+            return AnnotationLibraryCatalog(path).discover(annotation_library_file_paths)
+
+        annotation_libraries = list()
+
+        # A stale view (its parent was compacted since) or a broken file doesn't keep the others from being listed
+        for file_path in annotation_library_file_paths:
+            try:
+                annotation_libraries.append(cls.load(file_path, read_only=True))
+            except ANNOTATION_LIBRARY_LOAD_ERRORS as e:
+                print(f"Skipping unreadable Annotation Library '{file_path}': {e}")
+
+        return annotation_libraries
+
+
+# source_id => destination_id, adding the source values missing from the destination dictionary
+def _dictionary_map(source, destination):
+    return np.array([destination.add(value) for value in source], dtype="int64")
+
+
+def _translate_bounding_boxes(bounding_boxes, label_map, meta_map):
+    bounding_boxes = bounding_boxes.copy()
+
+    bounding_boxes["label"] = label_map[bounding_boxes["label"]]
+    bounding_boxes["meta"] = meta_map[bounding_boxes["meta"]]
+
+    return bounding_boxes
+
+
+# Uniform grid index of an entry's bounding boxes, see SPATIAL_INDEX_CELL_SIZE. Returns the (cells, boxes) rows
+def _build_spatial_index(bounding_boxes, image_shape, cell_size=SPATIAL_INDEX_CELL_SIZE):
+    grid_height = max(int(np.ceil(image_shape[0] / cell_size)), 1)
+    grid_width = max(int(np.ceil(image_shape[1] / cell_size)), 1)
+
+    # Boxes reaching outside the image are listed in the border cells
+    cell_y0 = np.clip(np.floor_divide(bounding_boxes["y0"], cell_size), 0, grid_height - 1).astype("int64")
+    cell_y1 = np.clip(np.floor_divide(bounding_boxes["y1"], cell_size), 0, grid_height - 1).astype("int64")
+    cell_x0 = np.clip(np.floor_divide(bounding_boxes["x0"], cell_size), 0, grid_width - 1).astype("int64")
+    cell_x1 = np.clip(np.floor_divide(bounding_boxes["x1"], cell_size), 0, grid_width - 1).astype("int64")
+
+    cell_y1 = np.maximum(cell_y0, cell_y1)
+    cell_x1 = np.maximum(cell_x0, cell_x1)
+
+    # One (box, cell) pair per cell of each box's cell rectangle, enumerated without a Python loop
+    widths = cell_x1 - cell_x0 + 1
+    counts = (cell_y1 - cell_y0 + 1) * widths
+
+    box_positions = np.repeat(np.arange(len(bounding_boxes)), counts)
+    steps = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    cells = (cell_y0[box_positions] + steps // widths[box_positions]) * grid_width + cell_x0[box_positions] + steps % widths[box_positions]
+    order = np.argsort(cells, kind="stable")
+
+    cell_starts = np.searchsorted(cells[order], np.arange(grid_height * grid_width + 1))
+
+    return (
+        np.concatenate([[cell_size, grid_height, grid_width], cell_starts]).astype("int32"),
+        box_positions[order].astype("int32")
+    )
+
+
+# List the library at 'file_path' in the derived libraries sidecar of the library at 'source_file_path'
+def _register_derived_library(source_file_path, file_path):
+    sidecar_path = f"{source_file_path}{DERIVED_LIBRARIES_EXTENSION}"
+    relative_path = os.path.relpath(os.path.abspath(file_path), os.path.dirname(os.path.abspath(source_file_path)))
+
+    file_paths = list()
+
+    if os.path.isfile(sidecar_path):
+        with open(sidecar_path, "r") as f:
+            file_paths = json.load(f)
+
+    if relative_path in file_paths:
+        return
+
+    # Written to a temporary file and renamed, so a compaction never reads a partial list
+    with open(f"{sidecar_path}.tmp", "w") as f:
+        json.dump(file_paths + [relative_path], f, indent=2)
+
+    os.replace(f"{sidecar_path}.tmp", sidecar_path)
+
+
+# Bitmap bytes of bits, least significant bit first; numpy's 'bitorder' argument needs numpy 1.17
+def _pack_bits(bits):
+    return np.packbits(np.asarray(bits, dtype="bool").reshape(-1, 8)[:, ::-1], axis=1).ravel()
+
+
+def _unpack_bits(bitmap):
+    return np.unpackbits(np.asarray(bitmap, dtype="uint8").reshape(-1, 1), axis=1)[:, ::-1].ravel()
+
+
+# dataset[row] = value for each row (sorted), with runs of consecutive rows written as single slices
+def _write_rows(dataset, rows, values):
+    rows = np.asarray(rows, dtype="int64")
+    run_starts = np.flatnonzero(np.diff(np.concatenate(([-2], rows))) != 1).tolist() + [len(rows)]
+
+    for start, end in zip(run_starts[:-1], run_starts[1:]):
+        dataset[rows[start]:rows[end - 1] + 1] = values[start:end]
+
+
+# Read dataset[row] for each row, visiting the rows in sorted order and merging close rows into single slices
+def _coalesced_read(dataset, rows):
+    rows = np.asarray(rows, dtype="int64")
+    values = _coalesced_read_ranges(dataset, np.stack([rows, rows + 1], axis=1))
+
+    return [value[0] for value in values]
+
+
+# Read dataset[start:end] for each (start, end) pair, merging close ranges into single slices
+def _coalesced_read_ranges(dataset, ranges):
+    ranges = np.asarray(ranges, dtype="int64").reshape(-1, 2)
+    result = [dataset[0:0]] * len(ranges)
+
+    runs = list()
+
+    for i in np.argsort(ranges[:, 0], kind="stable").tolist():
+        start, end = ranges[i]
+
+        if end <= start:
+            continue
+
+        if len(runs) and start - runs[-1][1] <= COALESCE_GAP:
+            runs[-1][1] = max(runs[-1][1], end)
+            runs[-1][2].append(i)
+        else:
+            runs.append([start, end, [i]])
+
+    for start, end, members in runs:
+        values = dataset[start:end]
+
+        for i in members:
+            result[i] = values[ranges[i, 0] - start:ranges[i, 1] - start]
+
+    return result
+
+
+def _stack_if_uniform(arrays):
+    if len(arrays) and all(array.shape == arrays[0].shape for array in arrays):
+        return np.stack(arrays)
+
+    return arrays
+
+
+# Encoded bounding box rows carry their label and meta as either str or bytes
+def _decode(value):
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
 
-        return [cls.load(file_path, read_only=True) for file_path in annotation_library_file_paths]
+    return value
@@ -56,12 +56,13 @@ class CosmoquestAnnotationLibraryBuilder(AnnotationLibraryBuilder):
 
         super().__init__(targets=targets)
 
+    # With an 'image_store', images already seen by any library referencing the same store are only referenced
     @db_session
-    def build(self, name):
+    def build(self, name, image_store=None):
         if not len(self.targets):
             return None
         
-        annotation_library = AnnotationLibrary(name)
+        annotation_library = AnnotationLibrary(name, image_store=image_store)
 
         for target in self.targets:
             print(f"Collecting data for user '{target}'...")
@@ -86,15 +87,16 @@ class CosmoquestAnnotationLibraryBuilder(AnnotationLibraryBuilder):
             # Generate and append the bounding boxes from marks
             self._generate_bounding_boxes(marks, target)
 
-        for file_name, bounding_boxes in self.bounding_boxes.items():
-            entry = {
-                "file_location": f"data/images/{self.application}/{file_name}",
-                "width": self.image_shape[1],
-                "height": self.image_shape[0],
-                "bounding_boxes": bounding_boxes
-            }
+        with annotation_library.bulk_writer() as writer:
+            for file_name, bounding_boxes in self.bounding_boxes.items():
+                entry = {
+                    "file_location": f"data/images/{self.application}/{file_name}",
+                    "width": self.image_shape[1],
+                    "height": self.image_shape[0],
+                    "bounding_boxes": bounding_boxes
+                }
 
-            annotation_library.add_complete_entry(entry)
+                writer.add(entry)
 
         annotation_library.commit()
 
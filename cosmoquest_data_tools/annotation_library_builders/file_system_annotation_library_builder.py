@@ -32,27 +32,29 @@ class FileSystemAnnotationLibraryBuilder(AnnotationLibraryBuilder):
 
         super().__init__(targets=targets)
 
-    def build(self, name):
+    # With an 'image_store', images already seen by any library referencing the same store are only referenced
+    def build(self, name, image_store=None):
         if not len(self.targets):
             return None
         
-        annotation_library = AnnotationLibrary(name)
+        annotation_library = AnnotationLibrary(name, image_store=image_store)
 
-        for target in self.targets:
-            with open(target, "r") as f:
-                entries = json.loads(f.read())
+        with annotation_library.bulk_writer() as writer:
+            for target in self.targets:
+                with open(target, "r") as f:
+                    entries = json.loads(f.read())
 
-            for entry in entries:
-                # Exception for craters legacy files...
-                if "craters" in entry:
-                    entry["bounding_boxes"] = entry["craters"]
+                for entry in entries:
+                    # Exception for craters legacy files...
+                    if "craters" in entry:
+                        entry["bounding_boxes"] = entry["craters"]
 
-                    for bounding_box in entry["bounding_boxes"]:
-                        bounding_box["annotation_class"] = "crater"
+                        for bounding_box in entry["bounding_boxes"]:
+                            bounding_box["annotation_class"] = "crater"
+
+                    entry["file_location"] = f"{self.base_directory}/{entry['file_location']}"
+                    writer.add(entry)
 
-                entry["file_location"] = f"{self.base_directory}/{entry['file_location']}"
-                annotation_library.add_complete_entry(entry)
-        
         annotation_library.commit()
 
         return annotation_library
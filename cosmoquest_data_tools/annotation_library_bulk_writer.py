@@ -0,0 +1,128 @@
+import concurrent.futures
+import threading
+import time
+
+
+class AnnotationLibraryBulkWriter:
+    """
+    Buffered, context-managed writer for ingesting many complete entries into an Annotation Library.
+
+    Image files are read ahead on a background thread while entries accumulate in memory. Every 'batch_size'
+    entries, or once the buffered image bytes pass 'buffer_bytes', the buffer is flushed to the library as one
+    contiguous append per dataset. Version 1 libraries are written entry by entry, but still benefit from the read-ahead.
+    """
+
+    def __init__(self, annotation_library, batch_size=512, buffer_bytes=256 * 1024 * 1024, read_ahead_threads=1):
+        self.annotation_library = annotation_library
+
+        self.batch_size = batch_size
+        self.buffer_bytes = buffer_bytes
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=read_ahead_threads)
+        self.buffer = list()
+
+        # Bytes of the buffered image files read so far, maintained by the read-ahead thread
+        self.buffered_bytes = 0
+        self.buffered_bytes_lock = threading.Lock()
+
+        self.entries_written = 0
+        self.bytes_written = 0
+        self.flushes = 0
+
+        self.started_at = None
+        self.stats = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, entry):
+        if self.started_at is None:
+            self.started_at = time.perf_counter()
+
+        image_bytes = self.executor.submit(_read_file, entry["file_location"])
+        image_bytes.add_done_callback(self._count_buffered_bytes)
+
+        self.buffer.append((entry, image_bytes))
+
+        if len(self.buffer) >= self.batch_size or self.buffered_bytes >= self.buffer_bytes:
+            self.flush()
+
+    def flush(self):
+        if not len(self.buffer):
+            return
+
+        keys = list()
+        images = list()
+        image_shapes = list()
+        bounding_boxes = list()
+
+        # Entries that overwrite an existing key (or repeat one in this batch) can't be part of a contiguous append
+        overwrites = list()
+
+        for entry, image_bytes in self.buffer:
+            image_bytes = image_bytes.result()
+            key, image_shape, entry_bounding_boxes = self.annotation_library._prepare_complete_entry(entry)
+
+            if self.annotation_library.version < 2 or key in self.annotation_library.keys or key in keys:
+                overwrites.append((key, image_bytes, image_shape, entry_bounding_boxes))
+            else:
+                keys.append(key)
+                images.append(image_bytes)
+                image_shapes.append(image_shape)
+                bounding_boxes.append(entry_bounding_boxes)
+
+            self.bytes_written += len(image_bytes)
+
+        if len(keys):
+            self.annotation_library._append_rows(keys, images, image_shapes, bounding_boxes)
+
+        for key, image_bytes, image_shape, entry_bounding_boxes in overwrites:
+            self.annotation_library.add_entry(key, "image", [image_bytes])
+            self.annotation_library.add_entry(key, "shape", image_shape)
+            self.annotation_library.add_entry(key, "bounding-boxes", entry_bounding_boxes)
+
+        self.entries_written += len(self.buffer)
+        self.flushes += 1
+
+        self.buffer = list()
+
+        with self.buffered_bytes_lock:
+            self.buffered_bytes = 0
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown()
+
+        elapsed = (time.perf_counter() - self.started_at) if self.started_at is not None else 0.0
+
+        self.stats = {
+            "entries": self.entries_written,
+            "bytes": self.bytes_written,
+            "flushes": self.flushes,
+            "seconds": elapsed,
+            "entries_per_second": (self.entries_written / elapsed) if elapsed else 0.0,
+            "megabytes_per_second": (self.bytes_written / 1024 / 1024 / elapsed) if elapsed else 0.0
+        }
+
+        print(
+            f"Bulk wrote {self.stats['entries']} entries ({self.stats['bytes'] / 1024 / 1024:.1f} MB) "
+            f"in {self.stats['flushes']} flushes and {self.stats['seconds']:.1f}s: "
+            f"{self.stats['entries_per_second']:.1f} entries/s, {self.stats['megabytes_per_second']:.1f} MB/s"
+        )
+
+        return self.stats
+
+    def _count_buffered_bytes(self, image_bytes):
+        if image_bytes.exception() is not None:
+            return
+
+        with self.buffered_bytes_lock:
+            self.buffered_bytes += len(image_bytes.result())
+
+
+def _read_file(file_path):
+    with open(file_path, "rb") as f:
+        return f.read()
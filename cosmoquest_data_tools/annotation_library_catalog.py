@@ -0,0 +1,215 @@
+import os
+import json
+
+import h5py
+import numpy as np
+
+from hurry.filesize import size, alternative
+
+from cosmoquest_data_tools.annotation_library import ANNOTATION_LIBRARY_LOAD_ERRORS
+from cosmoquest_data_tools.annotation_library_statistics import AnnotationLibraryStatistics
+
+
+# Lives in the directory it describes; a dotfile, so it's never mistaken for a library
+ANNOTATION_LIBRARY_CATALOG_FILE_NAME = ".annotation_library_catalog.json"
+ANNOTATION_LIBRARY_CATALOG_VERSION = 1
+
+
+class AnnotationLibraryCatalog:
+    """
+    Header-only listing of the Annotation Libraries in a directory, for AnnotationLibrary.discover(metadata_only=True).
+
+    Summaries are read from the file attributes and the small 'keys' and 'annotation_classes' datasets, without
+    decoding any key. They are cached in a JSON catalog next to the libraries, and reused for as long as the (mtime,
+    size) of the library file, and of the files it depends on (a view's parent, a sharded library's shards), match.
+    Sharded libraries and views are loaded once to be summarized. Entries are never scanned: as with
+    AnnotationLibrary.stored_stats(), 'statistics' is None for libraries committed before statistics were introduced.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.catalog_file_path = os.path.join(path, ANNOTATION_LIBRARY_CATALOG_FILE_NAME)
+
+        self.catalog = self._load_catalog()
+
+    # One AnnotationLibrarySummary per library file, in directory listing order
+    def discover(self, file_paths):
+        summaries = list()
+        catalog = dict()
+
+        for file_path in file_paths:
+            file_name = os.path.basename(file_path)
+
+            try:
+                signature = _signature(file_path)
+            except ANNOTATION_LIBRARY_LOAD_ERRORS:
+                # Files being written or deleted while listing are left out until the next call
+                continue
+
+            cached = self.catalog.get(file_name)
+
+            if cached is not None and cached["signature"] == signature:
+                entry = cached
+            else:
+                try:
+                    entry = {"signature": signature, "summary": self._summarize(file_path)}
+                except ANNOTATION_LIBRARY_LOAD_ERRORS as e:
+                    # e.g. a view whose parent was compacted since it was saved. Recorded as unreadable, so it isn't
+                    # loaded again until it (or a file it depends on) changes
+                    print(f"Skipping unreadable Annotation Library '{file_path}': {e}")
+                    entry = {"signature": signature, "error": str(e)}
+
+            catalog[file_name] = entry
+
+            if "error" not in entry:
+                summaries.append(AnnotationLibrarySummary(file_path=file_path, file_size=_file_size(file_path, signature), **entry["summary"]))
+
+        if catalog != self.catalog:
+            self.catalog = catalog
+            self._write_catalog()
+
+        return summaries
+
+    def _summarize(self, file_path):
+        if not file_path.endswith(".alh5"):
+            return _summarize_loaded(file_path)
+
+        with _open_header(file_path) as h5_file:
+            statistics = AnnotationLibraryStatistics.from_json(json.loads(_decode(h5_file.attrs["statistics"]))) if "statistics" in h5_file.attrs else None
+
+            return {
+                "name": os.path.basename(file_path).replace(".alh5", ""),
+                "version": int(h5_file.attrs.get("version", 1)),
+                "entry_count": (int(h5_file["keys"].shape[0]) if "keys" in h5_file else 0) - int(h5_file.attrs.get("deleted_entry_count", 0)),
+                "annotation_classes": sorted(_decode(value) for value in h5_file["annotation_classes"][()]) if "annotation_classes" in h5_file else list(),
+                "statistics": statistics.as_json() if statistics is not None else None
+            }
+
+    def _load_catalog(self):
+        try:
+            with open(self.catalog_file_path, "r") as f:
+                catalog = json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+        if catalog.get("version") != ANNOTATION_LIBRARY_CATALOG_VERSION:
+            return dict()
+
+        return catalog["libraries"]
+
+    # Best effort: a read-only data directory just means no caching
+    def _write_catalog(self):
+        try:
+            with open(f"{self.catalog_file_path}.{os.getpid()}.tmp", "w") as f:
+                json.dump({"version": ANNOTATION_LIBRARY_CATALOG_VERSION, "libraries": self.catalog}, f)
+
+            os.replace(f"{self.catalog_file_path}.{os.getpid()}.tmp", self.catalog_file_path)
+        except OSError:
+            pass
+
+
+class AnnotationLibrarySummary:
+    """
+    What AnnotationLibrary.as_json_minimal() reports about a library, without the library being opened.
+    """
+
+    def __init__(self, name, file_path, file_size, version, entry_count, annotation_classes, statistics, **extra):
+        self.name = name
+        self.file_path = file_path
+        self.file_size = file_size
+        self.version = version
+        self.entry_count = entry_count
+        self.annotation_classes = annotation_classes
+        self.statistics = statistics
+
+        # e.g. 'shard_count' or 'annotation_library'
+        self.extra = extra
+
+    def as_json_minimal(self):
+        return {
+            "name": self.name,
+            "file_path": self.file_path,
+            "file_size": size(self.file_size, system=alternative),
+            "entry_count": self.entry_count,
+            "annotation_classes": list(self.annotation_classes),
+            "statistics": self.statistics,
+            **self.extra
+        }
+
+    # None when the library has no stored statistics; load it and call stats() to compute them
+    def stats(self):
+        return self.statistics
+
+    def stored_stats(self):
+        return self.statistics
+
+    def __repr__(self):
+        return f"AnnotationLibrarySummary('{self.name}', {self.entry_count} entries)"
+
+
+def _summarize_loaded(file_path):
+    from cosmoquest_data_tools.annotation_library import AnnotationLibrary
+
+    annotation_library = AnnotationLibrary.load(file_path, read_only=True)
+
+    try:
+        summary = annotation_library.as_json_minimal()
+        summary["version"] = annotation_library.version
+        summary["annotation_classes"] = sorted(summary["annotation_classes"])
+    finally:
+        annotation_library.close()
+
+    del summary["file_path"]
+    del summary["file_size"]
+
+    return summary
+
+
+# Libraries being written in SWMR mode can only be opened by SWMR readers
+def _open_header(file_path):
+    try:
+        return h5py.File(file_path, "r")
+    except OSError:
+        return h5py.File(file_path, "r", libver="latest", swmr=True)
+
+
+# (mtime, size) of a library file and of every file it's made of or points to
+def _signature(file_path):
+    signature = list()
+
+    for dependency in [file_path, *_dependencies(file_path)]:
+        stat = os.stat(dependency)
+        signature.append([dependency, stat.st_mtime_ns, stat.st_size])
+
+    return signature
+
+
+# Sharded libraries are as big as their shards, see ShardedAnnotationLibrary.as_json_minimal()
+def _file_size(file_path, signature):
+    from cosmoquest_data_tools.sharded_annotation_library import SHARDED_MANIFEST_EXTENSION
+
+    if file_path.endswith(SHARDED_MANIFEST_EXTENSION):
+        return sum(file_size for _, _, file_size in signature[1:])
+
+    return signature[0][2]
+
+
+def _dependencies(file_path):
+    from cosmoquest_data_tools.sharded_annotation_library import SHARDED_MANIFEST_EXTENSION
+    from cosmoquest_data_tools.annotation_library_view import ANNOTATION_LIBRARY_VIEW_EXTENSION
+
+    if file_path.endswith(SHARDED_MANIFEST_EXTENSION):
+        with open(file_path, "r") as f:
+            manifest = json.load(f)
+
+        return [os.path.join(os.path.dirname(file_path), shard_path) for shard_path in manifest["shards"]]
+
+    if file_path.endswith(ANNOTATION_LIBRARY_VIEW_EXTENSION):
+        with np.load(file_path) as data:
+            return [str(data["annotation_library"])]
+
+    return list()
+
+
+def _decode(value):
+    return value.decode("utf-8") if isinstance(value, bytes) else str(value)
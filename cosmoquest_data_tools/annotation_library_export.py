@@ -0,0 +1,258 @@
+import os
+import json
+import shutil
+
+import concurrent.futures
+
+import numpy as np
+
+from cosmoquest_data_tools.annotation_library import AnnotationLibrary, AnnotationLibraryError, BOUNDING_BOX_DTYPE, _dictionary_map
+from cosmoquest_data_tools.helpers.indexing import OrderedIndex
+
+
+ANNOTATION_LIBRARY_EXPORT_VERSION = 1
+
+# Columns of an export directory, one .npy file each. Image columns are only there when images were exported
+#   keys, labels, metas: Unicode arrays; bounding box 'label' and 'meta' fields are ids into labels and metas
+#   shapes: N x 3 stored image shapes
+#   bounding_boxes: Flat BOUNDING_BOX_DTYPE table, sliced by the (start, end) rows of bounding_box_offsets (N x 2)
+#   images: Flat uint8 table of decoded pixels, sliced by image_offsets (N x 2) and reshaped to image_shapes (N x 3)
+EXPORT_COLUMNS = ["keys", "labels", "metas", "shapes", "bounding_box_offsets", "bounding_boxes"]
+EXPORT_IMAGE_COLUMNS = ["image_offsets", "image_shapes", "images"]
+
+
+class AnnotationLibraryExport:
+    """
+    Columnar export of an Annotation Library to a directory of .npy files, for notebooks and other analysis code.
+
+        annotation_library.export("data/exports/my_library", images=True)
+
+        export = AnnotationLibraryExport.load("data/exports/my_library")
+        export.bounding_boxes[export.bounding_boxes["label"] == export.labels.tolist().index("crater")]
+
+    Exports are written chunk by chunk by worker processes, then stitched into single files, so memory use is bounded
+    by the chunk size. Loaded exports memory-map every column; nothing is read until it's accessed.
+    """
+
+    def __init__(self, path, columns, manifest):
+        self.path = path
+        self.manifest = manifest
+
+        for name, column in columns.items():
+            setattr(self, name, column)
+
+        self.has_images = "images" in columns
+
+        self._key_positions = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    def position(self, key):
+        if self._key_positions is None:
+            self._key_positions = {key: i for i, key in enumerate(self.keys.tolist())}
+
+        return self._key_positions[key]
+
+    # Structured array of BOUNDING_BOX_DTYPE; resolve 'label' and 'meta' ids through self.labels and self.metas
+    def get_bounding_boxes_array(self, index):
+        start, end = self.bounding_box_offsets[index]
+        return self.bounding_boxes[start:end]
+
+    # Memory-mapped, read-only view of the decoded pixels
+    def get_image_array(self, index):
+        if not self.has_images:
+            raise AnnotationLibraryError(f"Annotation Library Export '{self.path}' was written without images...")
+
+        start, end = self.image_offsets[index]
+        image_shape = self.image_shapes[index]
+
+        return self.images[start:end].reshape(image_shape if image_shape[2] > 1 else image_shape[:2])
+
+    @classmethod
+    def write(cls, annotation_library, path, images=False, chunk_rows=1024, workers=None):
+        if not annotation_library.read_only:
+            annotation_library.commit()
+            annotation_library.flush()
+
+        keys = annotation_library.entries[:]
+
+        parts_path = os.path.join(path, ".parts")
+
+        # Previous (or interrupted) exports are replaced, anything else is left alone
+        if os.path.isdir(path) and os.listdir(path):
+            if not os.path.isfile(os.path.join(path, "manifest.json")) and not os.path.isdir(parts_path):
+                raise AnnotationLibraryError(f"'{path}' already exists and isn't an Annotation Library Export...")
+
+            shutil.rmtree(path)
+
+        os.makedirs(parts_path)
+
+        # Sharded libraries are loaded through their manifest, views through their parent (and the given keys)
+        file_path = annotation_library.file_path
+        chunks = [keys[offset:offset + chunk_rows] for offset in range(0, len(keys), chunk_rows)]
+
+        parts = [None] * len(chunks)
+
+        workers = workers or os.cpu_count()
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = dict()
+
+            # A bounded number of chunks in flight, so pending keys and results don't pile up
+            for i, chunk_keys in enumerate(chunks):
+                futures[executor.submit(execute_export_chunk, file_path, chunk_keys, os.path.join(parts_path, f"{i:06d}"), images)] = i
+
+                if len(futures) >= 2 * workers:
+                    _collect(futures, parts, concurrent.futures.FIRST_COMPLETED)
+
+            _collect(futures, parts, concurrent.futures.ALL_COMPLETED)
+
+        labels = OrderedIndex()
+        metas = OrderedIndex()
+
+        label_maps = [_dictionary_map(part["labels"], labels) for part in parts]
+        meta_maps = [_dictionary_map(part["metas"], metas) for part in parts]
+
+        bounding_box_count = sum(part["bounding_box_count"] for part in parts)
+        image_size = sum(part["image_size"] for part in parts)
+
+        np.save(os.path.join(path, "keys.npy"), np.array(keys, dtype="str"))
+        np.save(os.path.join(path, "labels.npy"), np.array(list(labels), dtype="str"))
+        np.save(os.path.join(path, "metas.npy"), np.array(list(metas), dtype="str"))
+
+        columns = {
+            "shapes": np.lib.format.open_memmap(os.path.join(path, "shapes.npy"), mode="w+", dtype="int64", shape=(len(keys), 3)),
+            "bounding_box_offsets": np.lib.format.open_memmap(os.path.join(path, "bounding_box_offsets.npy"), mode="w+", dtype="int64", shape=(len(keys), 2)),
+            "bounding_boxes": np.lib.format.open_memmap(os.path.join(path, "bounding_boxes.npy"), mode="w+", dtype=BOUNDING_BOX_DTYPE, shape=(bounding_box_count,))
+        }
+
+        if images:
+            columns["image_offsets"] = np.lib.format.open_memmap(os.path.join(path, "image_offsets.npy"), mode="w+", dtype="int64", shape=(len(keys), 2))
+            columns["image_shapes"] = np.lib.format.open_memmap(os.path.join(path, "image_shapes.npy"), mode="w+", dtype="int64", shape=(len(keys), 3))
+            columns["images"] = np.lib.format.open_memmap(os.path.join(path, "images.npy"), mode="w+", dtype="uint8", shape=(image_size,))
+
+        # Stitch the parts together, one at a time
+        row = 0
+        bounding_box_start = 0
+        image_start = 0
+
+        for i, part in enumerate(parts):
+            part_path = os.path.join(parts_path, f"{i:06d}")
+
+            shapes = np.load(f"{part_path}.shapes.npy")
+            bounding_box_counts = np.load(f"{part_path}.bounding_box_counts.npy")
+
+            bounding_boxes = np.load(f"{part_path}.bounding_boxes.npy")
+            bounding_boxes["label"] = label_maps[i][bounding_boxes["label"]]
+            bounding_boxes["meta"] = meta_maps[i][bounding_boxes["meta"]]
+
+            rows = slice(row, row + len(shapes))
+
+            columns["shapes"][rows] = shapes
+            columns["bounding_box_offsets"][rows] = _offsets(bounding_box_start, bounding_box_counts)
+            columns["bounding_boxes"][bounding_box_start:bounding_box_start + len(bounding_boxes)] = bounding_boxes
+
+            bounding_box_start += len(bounding_boxes)
+
+            if images:
+                image_shapes = np.load(f"{part_path}.image_shapes.npy")
+                pixels = np.load(f"{part_path}.images.npy")
+
+                columns["image_offsets"][rows] = _offsets(image_start, np.prod(image_shapes, axis=1))
+                columns["image_shapes"][rows] = image_shapes
+                columns["images"][image_start:image_start + len(pixels)] = pixels
+
+                image_start += len(pixels)
+
+            row += len(shapes)
+
+        for column in columns.values():
+            column.flush()
+
+        del columns
+
+        shutil.rmtree(parts_path)
+
+        manifest = {
+            "version": ANNOTATION_LIBRARY_EXPORT_VERSION,
+            "name": annotation_library.name,
+            "file_path": file_path,
+            "entry_count": len(keys),
+            "bounding_box_count": bounding_box_count,
+            "images": images,
+            "columns": EXPORT_COLUMNS + (EXPORT_IMAGE_COLUMNS if images else list())
+        }
+
+        # Written last; a directory without it is an interrupted export
+        with open(os.path.join(path, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=4)
+
+        return path
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        manifest_path = os.path.join(path, "manifest.json")
+
+        if not os.path.isfile(manifest_path):
+            raise FileNotFoundError(manifest_path)
+
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+
+        if manifest["version"] > ANNOTATION_LIBRARY_EXPORT_VERSION:
+            raise AnnotationLibraryError(f"Unsupported Annotation Library Export version: {manifest['version']}")
+
+        columns = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode) for name in manifest["columns"]}
+
+        return cls(path, columns, manifest)
+
+
+# Instance Methods are not serializable by Pickle (when they have foreign data types, such as here)
+# Using a regular function is required for multiprocessing concurrency
+# Bounding box ids refer to this process' dictionaries (built on the fly for Version 1), returned for translation
+def execute_export_chunk(annotation_library_file_path, keys, part_path, images):
+    annotation_library = AnnotationLibrary.load(annotation_library_file_path, read_only=True)
+
+    fields = ("shape", "bounding_boxes_array", *(("image",) if images else ()))
+    batch = annotation_library.get_batch(keys, fields=fields)
+
+    bounding_boxes = batch["bounding_boxes_array"]
+
+    np.save(f"{part_path}.shapes.npy", np.asarray(batch["shape"], dtype="int64").reshape(-1, 3))
+    np.save(f"{part_path}.bounding_box_counts.npy", np.array([len(array) for array in bounding_boxes], dtype="int64"))
+    np.save(f"{part_path}.bounding_boxes.npy", np.concatenate(bounding_boxes) if len(bounding_boxes) else np.zeros(0, dtype=BOUNDING_BOX_DTYPE))
+
+    image_size = 0
+
+    if images:
+        image_arrays = list(batch["image"])
+        image_shapes = np.array([image_array.shape if image_array.ndim == 3 else (*image_array.shape, 1) for image_array in image_arrays], dtype="int64").reshape(-1, 3)
+
+        np.save(f"{part_path}.image_shapes.npy", image_shapes)
+        np.save(f"{part_path}.images.npy", np.concatenate([image_array.ravel() for image_array in image_arrays]) if image_arrays else np.zeros(0, dtype="uint8"))
+
+        image_size = int(np.prod(image_shapes, axis=1).sum())
+
+    result = {
+        "labels": list(annotation_library.labels),
+        "metas": list(annotation_library.metas),
+        "bounding_box_count": int(sum(len(array) for array in bounding_boxes)),
+        "image_size": image_size
+    }
+
+    annotation_library.close()
+
+    return result
+
+
+def _collect(futures, parts, return_when):
+    done, _ = concurrent.futures.wait(futures, return_when=return_when)
+
+    for future in done:
+        parts[futures.pop(future)] = future.result()
+
+
+def _offsets(start, counts):
+    ends = start + np.cumsum(counts, dtype="int64")
+    return np.stack([ends - counts, ends], axis=1)
@@ -0,0 +1,117 @@
+import numpy as np
+
+
+# Histogram bin lower edges; the last bin is open-ended
+BOXES_PER_ENTRY_BINS = [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+BOX_SIZE_BINS = [0, 4, 8, 16, 32, 64, 128, 256, 512]  # sqrt(width * height), in pixels
+
+# Meta of the boxes a CONSENSUS deduplication merged several users' marks into, followed by their votes and agreement
+# They have no single contributor, so they're left out of boxes_per_contributor
+CONSENSUS_META_PREFIX = "consensus:"
+
+
+class AnnotationLibraryStatistics:
+    """
+    Summary statistics of an Annotation Library, maintained incrementally as entries are written.
+
+    Bounding boxes are passed as structured arrays (see annotation_library.BOUNDING_BOX_DTYPE) along with the
+    library's label and meta dictionaries, so updates never go through per-box Python objects.
+    """
+
+    def __init__(self):
+        self.entry_count = 0
+        self.bounding_box_count = 0
+
+        self.boxes_per_class = dict()
+        self.boxes_per_contributor = dict()
+
+        self.boxes_per_entry = np.zeros(len(BOXES_PER_ENTRY_BINS), dtype="int64")
+        self.box_sizes = np.zeros(len(BOX_SIZE_BINS), dtype="int64")
+
+    def add_entry(self):
+        self.entry_count += 1
+        self.boxes_per_entry[_bin(BOXES_PER_ENTRY_BINS, 0)] += 1
+
+    # Entries are removed once their bounding boxes have been replaced with none
+    def remove_entry(self):
+        self.entry_count -= 1
+        self.boxes_per_entry[_bin(BOXES_PER_ENTRY_BINS, 0)] -= 1
+
+    # Swap the contribution of one entry's old bounding boxes for its new ones
+    def replace_bounding_boxes(self, old_bounding_boxes, new_bounding_boxes, labels, metas):
+        self.boxes_per_entry[_bin(BOXES_PER_ENTRY_BINS, len(old_bounding_boxes))] -= 1
+        self.boxes_per_entry[_bin(BOXES_PER_ENTRY_BINS, len(new_bounding_boxes))] += 1
+
+        for bounding_boxes, sign in [(old_bounding_boxes, -1), (new_bounding_boxes, 1)]:
+            if not len(bounding_boxes):
+                continue
+
+            self.bounding_box_count += sign * len(bounding_boxes)
+
+            _count(self.boxes_per_class, bounding_boxes["label"], labels, sign)
+            _count(self.boxes_per_contributor, bounding_boxes["meta"], metas, sign, skip_prefix=CONSENSUS_META_PREFIX)
+
+            sizes = np.sqrt(
+                np.clip(bounding_boxes["y1"] - bounding_boxes["y0"], 0, None) *
+                np.clip(bounding_boxes["x1"] - bounding_boxes["x0"], 0, None)
+            )
+
+            self.box_sizes += sign * np.bincount(_bin(BOX_SIZE_BINS, sizes), minlength=len(BOX_SIZE_BINS))
+
+    # Fold in the statistics of another library, e.g. another shard of the same Sharded Annotation Library
+    def merge(self, other):
+        self.entry_count += other.entry_count
+        self.bounding_box_count += other.bounding_box_count
+
+        for counts, other_counts in [(self.boxes_per_class, other.boxes_per_class), (self.boxes_per_contributor, other.boxes_per_contributor)]:
+            for value, count in other_counts.items():
+                counts[value] = counts.get(value, 0) + count
+
+        self.boxes_per_entry += other.boxes_per_entry
+        self.box_sizes += other.box_sizes
+
+        return self
+
+    def as_json(self):
+        return {
+            "entry_count": self.entry_count,
+            "bounding_box_count": self.bounding_box_count,
+            "boxes_per_class": dict(self.boxes_per_class),
+            "boxes_per_contributor": dict(self.boxes_per_contributor),
+            "boxes_per_entry": {"bins": BOXES_PER_ENTRY_BINS, "counts": self.boxes_per_entry.tolist()},
+            "box_sizes": {"bins": BOX_SIZE_BINS, "counts": self.box_sizes.tolist()}
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        statistics = cls()
+
+        statistics.entry_count = data["entry_count"]
+        statistics.bounding_box_count = data["bounding_box_count"]
+
+        statistics.boxes_per_class = dict(data["boxes_per_class"])
+        statistics.boxes_per_contributor = dict(data["boxes_per_contributor"])
+
+        statistics.boxes_per_entry = np.array(data["boxes_per_entry"]["counts"], dtype="int64")
+        statistics.box_sizes = np.array(data["box_sizes"]["counts"], dtype="int64")
+
+        return statistics
+
+
+def _bin(bins, values):
+    return np.searchsorted(bins, values, side="right") - 1
+
+
+def _count(counts, ids, dictionary, sign, skip_prefix=None):
+    ids, id_counts = np.unique(ids, return_counts=True)
+
+    for value_id, value_count in zip(ids.tolist(), id_counts.tolist()):
+        value = dictionary[value_id]
+
+        if skip_prefix is not None and value.startswith(skip_prefix):
+            continue
+
+        counts[value] = counts.get(value, 0) + sign * value_count
+
+        if not counts[value]:
+            del counts[value]
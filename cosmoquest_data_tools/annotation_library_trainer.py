@@ -1,6 +1,8 @@
 import enum
 
 from cosmoquest_data_tools.annotation_library import AnnotationLibrary
+from cosmoquest_data_tools.sharded_annotation_library import ShardedAnnotationLibrary
+from cosmoquest_data_tools.annotation_library_view import AnnotationLibraryView
 
 
 class AnnotationLibraryTrainerError(BaseException):
@@ -35,8 +37,8 @@ class AnnotationLibraryTrainer:
 
     @classmethod
     def execute(cls, annotation_library, trainer, trainer_kwargs=None):
-        if not isinstance(annotation_library, AnnotationLibrary):
-            raise AnnotationLibraryTrainerError("Provided 'annotation_library' should be an AnnotationLibrary object...")
+        if not isinstance(annotation_library, (AnnotationLibrary, ShardedAnnotationLibrary, AnnotationLibraryView)):
+            raise AnnotationLibraryTrainerError("Provided 'annotation_library' should be an AnnotationLibrary or AnnotationLibraryView object...")
 
         if trainer not in cls.TRAINERS:
             raise AnnotationLibraryTrainerError(f"Unknown provided 'trainer': '{trainer}'")
@@ -155,7 +155,7 @@ class LuminothAnnotationLibraryTrainer(AnnotationLibraryTrainer):
             "max_proposals_per_class": train_config["model"]["rcnn"]["proposals"]["class_max_detections"],
             "non_maximum_suppression_threshold": train_config["model"]["rcnn"]["proposals"]["class_nms_threshold"],
             "max_proposals": train_config["model"]["rcnn"]["proposals"]["total_max_detections"],
-            "minimum_probability": train_config["model"]["rcnn"]["proposals"]["min_prob_threshold"]cli
+            "minimum_probability": train_config["model"]["rcnn"]["proposals"]["min_prob_threshold"]
         }
 
         return train_config, hyperparams
@@ -166,12 +166,15 @@ class LuminothAnnotationLibraryTrainer(AnnotationLibraryTrainer):
 
 
 class LuminothAnnotationLibraryReader(ObjectDetectionReader):
-    def __init__(self, annotation_library, **kwargs):
+    def __init__(self, annotation_library, batch_size=64, **kwargs):
         super().__init__(**kwargs)
 
         self.annotation_library = annotation_library
         self.provided_classes = list(self.annotation_library.annotation_classes)
 
+        # Entries are read from the Annotation Library in batches of this size
+        self.batch_size = batch_size
+
         self.yielded_records = 0
         self.errors = 0
 
@@ -182,39 +185,60 @@ class LuminothAnnotationLibraryReader(ObjectDetectionReader):
         return self.provided_classes
 
     def iterate(self):
-        for key in self.annotation_library.entries:
-            if self._stop_iteration():
-                return
+        keys = self.annotation_library.entries
+
+        for offset in range(0, len(keys), self.batch_size):
+            for key, image, image_shape, bounding_boxes in self._read_batch(keys[offset:offset + self.batch_size]):
+                if self._stop_iteration():
+                    return
+
+                formatted_bounding_boxes = list()
+
+                for bounding_box in bounding_boxes:
+                    formatted_bounding_boxes.append({
+                        "label": self.provided_classes.index(bounding_box["label"]),
+                        "xmin": bounding_box["x0"],
+                        "ymin": bounding_box["y0"],
+                        "xmax": bounding_box["x1"],
+                        "ymax": bounding_box["y1"]
+                    })
+
+                if not len(formatted_bounding_boxes):
+                    continue
+
+                self.yielded_records += 1
+
+                yield {
+                    "width": int(image_shape[1]),
+                    "height": int(image_shape[0]),
+                    "depth": int(image_shape[2]),
+                    "filename": key,
+                    "image_raw": image,
+                    "gt_boxes": formatted_bounding_boxes,
+                }
+
+    # (key, image bytes, shape, bounding boxes) of the keys that could be read. When the batch read fails, the keys are
+    # read one at a time, so only the bad ones are skipped
+    def _read_batch(self, keys):
+        fields = ("image_bytes", "shape", "bounding_boxes")
+
+        try:
+            batch = self.annotation_library.get_batch(keys, fields=fields)
+
+            return list(zip(keys, batch["image_bytes"], batch["shape"], batch["bounding_boxes"]))
+        except Exception:
+            pass
+
+        entries = list()
+
+        for key in keys:
             try:
-                image = self.annotation_library.get_image_bytes(key)
-                image_shape = self.annotation_library.get_image_shape(key)
-                bounding_boxes = self.annotation_library.get_bounding_boxes(key)
+                batch = self.annotation_library.get_batch([key], fields=fields)
             except Exception as e:
                 print(f"An exception got raised for key '{key}'")
                 print(e, end="\n\n")
                 continue
 
-            formatted_bounding_boxes = list()
-
-            for bounding_box in bounding_boxes:
-                formatted_bounding_boxes.append({
-                    "label": self.provided_classes.index(bounding_box["label"]),
-                    "xmin": bounding_box["x0"],
-                    "ymin": bounding_box["y0"],
-                    "xmax": bounding_box["x1"],
-                    "ymax": bounding_box["y1"]
-                })
-
-            if not len(formatted_bounding_boxes):
-                continue
-
-            self.yielded_records += 1
+            entries.append((key, batch["image_bytes"][0], batch["shape"][0], batch["bounding_boxes"][0]))
 
-            yield {
-                "width": image_shape[1],
-                "height": image_shape[0],
-                "depth": image_shape[2],
-                "filename": key,
-                "image_raw": image,
-                "gt_boxes": formatted_bounding_boxes,
-            }
+        return entries
@@ -1,6 +1,10 @@
+import os
 import enum
+import json
+import zlib
 
 from cosmoquest_data_tools.annotation_library import AnnotationLibrary
+from cosmoquest_data_tools.annotation_library_view import AnnotationLibraryView
 
 
 class AnnotationLibraryTransformerError(BaseException):
@@ -27,13 +31,32 @@ class AnnotationLibraryTransformer:
 
         self.annotation_library = kwargs["annotation_library"]  # expected
 
+        # Progress is journaled next to the library; a rerun with the same parameters skips the keys already done
+        self.resume = kwargs.get("resume", True)
+
     def transform(self):
         raise NotImplementedError
 
+    # Everything that changes the output of the transform, so a journal is only resumed by an identical rerun
+    def journal_parameters(self):
+        return dict()
+
+    def open_journal(self):
+        parameters = {
+            "transformer": type(self).__name__,
+            "entries": zlib.crc32("\n".join(self.annotation_library.entries).encode("utf-8")),
+            **self.journal_parameters()
+        }
+
+        journal = AnnotationLibraryTransformJournal(f"{self.annotation_library.file_path}.{type(self).__name__}.journal", parameters)
+        journal.open(resume=self.resume)
+
+        return journal
+
     @classmethod
     def execute(cls, annotation_library, transformer, transformer_kwargs=None):
-        if not isinstance(annotation_library, AnnotationLibrary):
-            raise AnnotationLibraryTransformerError("Provided 'annotation_library' should be an AnnotationLibrary object...")
+        if not isinstance(annotation_library, (AnnotationLibrary, AnnotationLibraryView)):
+            raise AnnotationLibraryTransformerError("Provided 'annotation_library' should be an AnnotationLibrary or AnnotationLibraryView object...")
 
         if transformer not in cls.TRANSFORMERS:
             raise AnnotationLibraryTransformerError(f"Unknown provided 'transformer': '{transformer}'")
@@ -62,3 +85,97 @@ class AnnotationLibraryTransformer:
             return BoundingBoxFiltrationAnnotationLibraryTransformer
 
         return None
+
+
+class AnnotationLibraryTransformJournal:
+    """
+    Append-only sidecar recording the keys a transform is done with: a JSON header line with the transform parameters,
+    then one JSON-encoded key per line.
+
+    Keys are recorded only once their results are committed to the library, and the journal is fsync'd, so after a
+    crash every recorded key is done and at worst a few done keys get transformed again. The journal is removed once
+    the transform completes.
+    """
+
+    def __init__(self, file_path, parameters):
+        self.file_path = file_path
+        self.parameters = parameters
+
+        self.completed_keys = set()
+        self.resumed = False
+        self.file = None
+
+    # Picks up the completed keys of a previous run with the same parameters, or starts over
+    def open(self, resume=True):
+        completed_keys = self._read() if resume and os.path.isfile(self.file_path) else None
+
+        # Whether a previous run with the same parameters was interrupted
+        self.resumed = completed_keys is not None
+
+        if self.resumed:
+            print(f"Resuming from '{self.file_path}': {len(completed_keys)} keys already done.")
+
+        # Rewritten whole, which also drops a line cut short by a crash
+        with open(f"{self.file_path}.tmp", "w") as f:
+            f.write(json.dumps(self.parameters) + "\n")
+            f.write("".join(json.dumps(key) + "\n" for key in completed_keys or list()))
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(f"{self.file_path}.tmp", self.file_path)
+
+        self.completed_keys = completed_keys or set()
+        self.file = open(self.file_path, "a")
+
+    def record(self, keys):
+        keys = [key for key in keys if key not in self.completed_keys]
+
+        if not keys:
+            return
+
+        self.file.write("".join(json.dumps(key) + "\n" for key in keys))
+        self._sync()
+
+        self.completed_keys.update(keys)
+
+    def complete(self):
+        self.close()
+
+        if os.path.isfile(self.file_path):
+            os.remove(self.file_path)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __contains__(self, key):
+        return key in self.completed_keys
+
+    def _read(self):
+        with open(self.file_path, "r") as f:
+            lines = f.read().split("\n")
+
+        try:
+            parameters = json.loads(lines[0])
+        except ValueError:
+            parameters = None
+
+        if parameters != self.parameters:
+            print(f"'{self.file_path}' was written with other parameters. Starting over...")
+            return None
+
+        completed_keys = set()
+
+        # The last line may have been cut short by a crash
+        for line in lines[1:]:
+            try:
+                completed_keys.add(json.loads(line))
+            except ValueError:
+                break
+
+        return completed_keys
+
+    def _sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
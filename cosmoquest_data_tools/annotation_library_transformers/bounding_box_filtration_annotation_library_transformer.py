@@ -1,11 +1,11 @@
 from cosmoquest_data_tools.annotation_library_transformer import AnnotationLibraryTransformer, AnnotationLibraryTransformerError
-from cosmoquest_data_tools.annotation_library import AnnotationLibrary
+from cosmoquest_data_tools.annotation_library_statistics import CONSENSUS_META_PREFIX
 
-from cosmoquest_data_tools.helpers.algorithms import non_maximum_suppression
-
-from sklearn.cluster import KMeans
+from cosmoquest_data_tools.helpers.algorithms import batched_non_maximum_suppression, box_overlaps, grid_hash_pairs, k_means_1d, union_find, y1_ranks
 
 import enum
+import json
+import time
 import concurrent.futures
 
 import numpy as np
@@ -14,12 +14,14 @@ import numpy as np
 class BoundingBoxDeduplicateMode(enum.Enum):
     ALL = 0
     USER = 1
+    CONSENSUS = 2
 
 
 class BoundingBoxFiltrationAnnotationLibraryTransformer(AnnotationLibraryTransformer):
     DEDUPLICATE_MODES = {
         "ALL": BoundingBoxDeduplicateMode.ALL,
-        "USER": BoundingBoxDeduplicateMode.USER
+        "USER": BoundingBoxDeduplicateMode.USER,
+        "CONSENSUS": BoundingBoxDeduplicateMode.CONSENSUS
     }
 
     def __init__(self, **kwargs):
@@ -31,51 +33,114 @@ class BoundingBoxFiltrationAnnotationLibraryTransformer(AnnotationLibraryTransfo
 
         self.deduplicate_mode = self.DEDUPLICATE_MODES[self.deduplicate_mode]
 
+        # CONSENSUS: marks of the same class overlapping by at least this IoU are the same object, which is kept when
+        # at least this many distinct users marked it
+        self.consensus_iou_threshold = kwargs.get("consensus_iou_threshold", 0.5)
+        self.consensus_min_votes = kwargs.get("consensus_min_votes", 2)
+
+        if not isinstance(self.consensus_iou_threshold, (int, float)) or not 0 < self.consensus_iou_threshold <= 1:
+            raise AnnotationLibraryTransformerError("'consensus_iou_threshold' is expected to be in (0, 1]")
+
+        if not isinstance(self.consensus_min_votes, int) or self.consensus_min_votes < 1:
+            raise AnnotationLibraryTransformerError("'consensus_min_votes' is expected to be an integer of at least 1")
+
+        # Keys between checkpoints: commits to the library, then records the keys in the journal
+        self.checkpoint_keys = kwargs.get("checkpoint_keys") or 200
+
+        # Keys sent to a worker at once
+        self.chunk_keys = kwargs.get("chunk_keys") or 64
+
         super().__init__(**kwargs)
 
+    def journal_parameters(self):
+        return {
+            "deduplicate": self.deduplicate,
+            "deduplicate_mode": self.deduplicate_mode.name,
+            "consensus_iou_threshold": self.consensus_iou_threshold,
+            "consensus_min_votes": self.consensus_min_votes
+        }
+
     def transform(self):
+        journal = self.open_journal()
+
+        keys = [key for key in self.annotation_library.entries if key not in journal]
+        chunks = [keys[offset:offset + self.chunk_keys] for offset in range(0, len(keys), self.chunk_keys)]
+
+        processed_keys = list()
+
+        processed_key_count = 0
+        processed_bounding_boxes = 0
+        filtered_bounding_boxes = 0
+
+        started_at = time.time()
+
+        # Workers are sent chunks of keys along with their bounding boxes, read here: they hold no handle on the library
+        # this process writes to
         with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as executor:
-            futures = list()
-
-            processed_keys = 0
-            filtered_bounding_boxes = 0
-
-            for key in self.annotation_library.entries:
-                futures.append(
-                    executor.submit(
-                        execute_transform, 
-                        self.annotation_library.name,
-                        key,
-                        self.deduplicate,
-                        self.deduplicate_mode
-                    )
-                )
+            pending = set()
+            next_chunk = 0
+
+            while next_chunk < len(chunks) or pending:
+                # A bounded number of chunks in flight, so results stream back as they're written
+                while next_chunk < len(chunks) and len(pending) < 2 * self.workers:
+                    bounding_boxes = self.annotation_library.get_batch(chunks[next_chunk], fields=("bounding_boxes",))["bounding_boxes"]
+
+                    pending.add(executor.submit(execute_transform, chunks[next_chunk], bounding_boxes, self.deduplicate, self.deduplicate_mode, self.consensus_iou_threshold, self.consensus_min_votes))
+                    next_chunk += 1
 
-            for future in concurrent.futures.as_completed(futures):
-                key, bounding_boxes, filtered_count = future.result()
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
 
-                filtered_bounding_boxes += filtered_count
-                self.annotation_library.replace_bounding_boxes(key, bounding_boxes)
+                for future in done:
+                    for key, bounding_boxes, bounding_box_count in future.result():
+                        self.annotation_library.replace_bounding_boxes(key, bounding_boxes)
 
-                processed_keys += 1
-                print(f"{filtered_bounding_boxes} total bounding boxes filtered.")
+                        processed_keys.append(key)
 
-                # Flush the HDF5 changes to disk every 200 keys
-                if not processed_keys % 200:
-                    self.annotation_library.flush()
+                        processed_key_count += 1
+                        processed_bounding_boxes += bounding_box_count
+                        filtered_bounding_boxes += bounding_box_count - len(bounding_boxes)
+
+                    if len(processed_keys) >= self.checkpoint_keys:
+                        self._checkpoint(journal, processed_keys)
+                        processed_keys = list()
+
+                elapsed = max(time.time() - started_at, 1e-9)
+
+                print(
+                    f"{processed_key_count}/{len(keys)} keys processed, {filtered_bounding_boxes} total bounding boxes filtered "
+                    f"({processed_key_count / elapsed:.1f} keys/s, {processed_bounding_boxes / elapsed:.1f} boxes/s)."
+                )
 
-        # self.annotation_library.repack()  ... TODO: repack breaks images atm... why?
+        self._checkpoint(journal, processed_keys)
+
+        # Replaced bounding boxes leave dead rows behind; reclaim them once they take up enough of the file
+        self.annotation_library.compact_if_needed()
+
+        journal.complete()
 
         return self.annotation_library
 
+    # Keys are only journaled once their bounding boxes are committed and on disk
+    def _checkpoint(self, journal, keys):
+        self.annotation_library.commit()
+        self.annotation_library.flush()
+
+        journal.record(keys)
+
 
 # Instance Methods are not serializable by Pickle (when they have foreign data types, such as here) 
 # Using a regular function is required for multiprocessing concurrency
-def execute_transform(annotation_library_name, key, deduplicate, deduplicate_mode):
-    annotation_library = AnnotationLibrary.load(annotation_library_name, read_only=True)
+# Returns (key, filtered bounding boxes, original bounding box count) for every key of the chunk
+def execute_transform(keys, bounding_boxes, deduplicate, deduplicate_mode, consensus_iou_threshold=0.5, consensus_min_votes=2):
+    return [
+        (key, filter_bounding_boxes(key_bounding_boxes, deduplicate, deduplicate_mode, consensus_iou_threshold, consensus_min_votes), len(key_bounding_boxes))
+        for key, key_bounding_boxes in zip(keys, bounding_boxes)
+    ]
+
 
-    # Get the Bounding Boxes
-    bounding_boxes = annotation_library.get_bounding_boxes(key)
+def filter_bounding_boxes(bounding_boxes, deduplicate, deduplicate_mode, consensus_iou_threshold=0.5, consensus_min_votes=2):
+    if deduplicate and deduplicate_mode == BoundingBoxDeduplicateMode.CONSENSUS:
+        return consensus_bounding_boxes(bounding_boxes, consensus_iou_threshold, consensus_min_votes)
 
     # Index the Bounding Boxes
     bounding_box_index = dict()
@@ -94,6 +159,11 @@ def execute_transform(annotation_library_name, key, deduplicate, deduplicate_mod
             bounding_box_groups["ALL"] = bounding_boxes
         elif deduplicate_mode == BoundingBoxDeduplicateMode.USER:
             for bounding_box in bounding_boxes:
+                # Consensus boxes have no contributor, and are deduplicated already
+                if bounding_box["meta"].startswith(CONSENSUS_META_PREFIX):
+                    filtered_bounding_boxes.append(bounding_box)
+                    continue
+
                 if bounding_box["meta"] not in bounding_box_groups:
                     bounding_box_groups[bounding_box["meta"]] = list()
 
@@ -119,23 +189,72 @@ def execute_transform(annotation_library_name, key, deduplicate, deduplicate_mod
                 index = f"{output_box[0]}-{output_box[1]}-{output_box[2]}-{output_box[3]}"
                 filtered_bounding_boxes.append(bounding_box_index[index])
 
-    return key, filtered_bounding_boxes, (len(bounding_boxes) - len(filtered_bounding_boxes))
+    return filtered_bounding_boxes
 
 
 def cluster_bounding_boxes(bounding_boxes, clusters=2):
-    input_areas = np.array(list(map(lambda bb: (bb[2] - bb[0]) * (bb[3] - bb[1]), bounding_boxes))).reshape(-1, 1)
+    input_areas = (bounding_boxes[:, 2] - bounding_boxes[:, 0]) * (bounding_boxes[:, 3] - bounding_boxes[:, 1])
+
+    # Exact clustering of the areas; same objective as k-means, without the random restarts
+    labels, _ = k_means_1d(input_areas, clusters)
+
+    # Every cluster suppressed in one call, cluster by cluster
+    grouped = np.argsort(labels, kind="stable")
+    group_offsets = np.concatenate(([0], np.cumsum(np.bincount(labels, minlength=clusters))))
+
+    grouped_bounding_boxes = bounding_boxes[grouped]
+    scores = np.concatenate([y1_ranks(grouped_bounding_boxes[start:end]) for start, end in zip(group_offsets[:-1], group_offsets[1:])])
+
+    keep = batched_non_maximum_suppression(grouped_bounding_boxes, group_offsets, 0.1, scores=scores, overlap="area", inclusive=True)
+
+    return bounding_boxes[grouped[keep]].astype("int")
+
+
+# One box per object marked by several users: marks of the same class are candidate neighbours when they share a cell
+# of a grid hash, and joined (union-find) when they overlap by at least 'iou_threshold'. Clusters marked by at least
+# 'min_votes' distinct users become their coordinate-wise median box. Its meta is CONSENSUS_META_PREFIX followed by a JSON
+# object of the number of users ('votes') and their mean IoU with it ('agreement'); boxes of an earlier run are kept as is
+def consensus_bounding_boxes(bounding_boxes, iou_threshold=0.5, min_votes=2):
+    previous_bounding_boxes = [box for box in bounding_boxes if box["meta"].startswith(CONSENSUS_META_PREFIX)]
+    bounding_boxes = [box for box in bounding_boxes if not box["meta"].startswith(CONSENSUS_META_PREFIX)]
+
+    if not len(bounding_boxes):
+        return previous_bounding_boxes
+
+    boxes = np.array([[box["y0"], box["x0"], box["y1"], box["x1"]] for box in bounding_boxes], dtype="float64")
+
+    _, labels = np.unique([box["label"] for box in bounding_boxes], return_inverse=True)
+    _, users = np.unique([box["meta"] for box in bounding_boxes], return_inverse=True)
+
+    a, b = grid_hash_pairs(boxes, groups=labels.reshape(-1))
+
+    joined = box_overlaps(boxes, a, b) >= iou_threshold
+    clusters = union_find(len(boxes), a[joined], b[joined])
 
-    estimator = KMeans(init="k-means++", n_clusters=clusters, n_init=100)
-    estimator.fit(input_areas)
+    cluster_count = clusters.max() + 1
 
-    bounding_box_groups = [list() for _ in range(clusters)]
+    votes = np.bincount(np.unique(clusters * (users.max() + 1) + users.reshape(-1)) // (users.max() + 1), minlength=cluster_count)
 
-    for i, bounding_box in enumerate(bounding_boxes):
-        bounding_box_groups[estimator.labels_[i]].append(bounding_box)
+    # Coordinate-wise median of every cluster, over the contiguous slices of the members sorted by cluster
+    members = np.argsort(clusters, kind="stable")
+    cluster_offsets = np.concatenate(([0], np.cumsum(np.bincount(clusters, minlength=cluster_count))))
 
-    output_bounding_boxes = list()    
+    medians = np.array([np.median(boxes[members[start:end]], axis=0) for start, end in zip(cluster_offsets[:-1].tolist(), cluster_offsets[1:].tolist())])
+    medians = np.round(medians).astype("int")
 
-    for bounding_box_group in bounding_box_groups:
-        output_bounding_boxes += list(non_maximum_suppression(np.array(bounding_box_group), 0.1))
+    # Mean IoU of the members with their cluster's box
+    overlaps = box_overlaps(np.concatenate([medians, boxes]), clusters, cluster_count + np.arange(len(boxes)))
+    agreements = np.bincount(clusters, weights=overlaps, minlength=cluster_count) / np.diff(cluster_offsets)
 
-    return np.array(output_bounding_boxes)
+    return previous_bounding_boxes + [
+        {
+            "y0": int(y0),
+            "x0": int(x0),
+            "y1": int(y1),
+            "x1": int(x1),
+            "label": bounding_boxes[members[cluster_offsets[cluster]]]["label"],
+            "meta": CONSENSUS_META_PREFIX + json.dumps({"votes": int(votes[cluster]), "agreement": round(float(agreements[cluster]), 2)})
+        }
+        for cluster, (y0, x0, y1, x1) in enumerate(medians.tolist())
+        if votes[cluster] >= min_votes
+    ]
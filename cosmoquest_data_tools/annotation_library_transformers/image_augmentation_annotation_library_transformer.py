@@ -1,20 +1,33 @@
 from cosmoquest_data_tools.annotation_library_transformer import AnnotationLibraryTransformer, AnnotationLibraryTransformerError
-from cosmoquest_data_tools.annotation_library import AnnotationLibrary
+from cosmoquest_data_tools.annotation_library import AnnotationLibrary, PIXEL_SIDECAR_EXTENSION
 
 from cosmoquest_data_tools.helpers.image_augmentation_pipelines import IMAGE_AUGMENTATION_PIPELINES
 
 import io
 import os
-import shutil
+import time
+import queue
+import functools
+import threading
 
 import concurrent.futures
 
+import numpy as np
+
 import imgaug as ia
 
 from PIL import Image
 
 
 class ImageAugmentationAnnotationLibraryTransformer(AnnotationLibraryTransformer):
+    """
+    Writes 'augmentation_count' augmentations of every entry to a library derived from the source one (see
+    AnnotationLibrary.derive()), next to it: '<name>_augmented' unless 'derived_name' is given.
+
+    transform() returns that derived library, open for writing; closing it is up to the caller. The source library is
+    only read, and the handle it was passed in is left open. An existing derived library is picked up by a resumed
+    transform, and otherwise only replaced with 'overwrite'.
+    """
 
     def __init__(self, **kwargs):
         self.image_augmentation_pipeline = kwargs.get("image_augmentation_pipeline") or "DEFAULT"
@@ -24,81 +37,221 @@ class ImageAugmentationAnnotationLibraryTransformer(AnnotationLibraryTransformer
 
         self.augmentation_count = kwargs.get("augmentation_count") or 4
 
+        # Augmented entries go to a new library derived from the source one, which only stores the augmented images
+        self.derived_name = kwargs.get("derived_name")
+
+        # Whether a derived library left behind by a completed (or journal-less) run is replaced, instead of an error
+        self.overwrite = kwargs.get("overwrite") or False
+
+        # Bytes of results in flight at once: computed, being computed or waiting to be written
+        self.max_in_flight_bytes = kwargs.get("max_in_flight_bytes") or 512 * 1024 * 1024
+
+        self.writer_error = None
+
         super().__init__(**kwargs)
 
+        # Keys between commits of the derived library, which then records them in the journal
+        self.checkpoint_keys = kwargs.get("checkpoint_keys") or self.workers * 10
+
+    def journal_parameters(self):
+        return {
+            "image_augmentation_pipeline": self.image_augmentation_pipeline,
+            "augmentation_count": self.augmentation_count,
+            "derived_name": self.derived_name
+        }
+
     def transform(self):
-        chunk_size = self.workers * 10
-        offset = 0
+        journal = self.open_journal()
+
+        keys = [key for key in self.annotation_library.entries if key not in journal]
+
+        try:
+            derived_annotation_library = self._open_derived_annotation_library(journal)
+        except AnnotationLibraryTransformerError:
+            # Nothing was done; left behind, the fresh journal would have the next run resume into the existing library
+            journal.complete()
+            raise
 
-        keys = self.annotation_library.entries[:]
+        # What a key takes up in the parent until its results are written: its input PNG and one per augmentation, all
+        # at most raw-sized
+        shapes = self.annotation_library.get_batch(keys, fields=("shape",))["shape"] if keys else list()
+        result_sizes = [(self.augmentation_count + 1) * int(np.prod(shape)) for shape in shapes]
 
-        # Make a copy for the workers to read off of
-        shutil.copyfile(self.annotation_library.file_path, f"{self.annotation_library.file_path}.tmp")
+        window = InFlightWindow(self.max_in_flight_bytes)
+        results = queue.Queue()
 
-        while True:
+        writer = threading.Thread(target=self._write_results, args=(derived_annotation_library, journal, results, window, len(keys)))
+        writer.start()
+
+        print(f"Performing {self.augmentation_count} augmentations for {len(keys)} images...")
+
+        try:
+            # One pool for the whole transform. Workers are sent their inputs rather than opening the source library,
+            # which the caller may still hold open for writing
             with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as executor:
-                chunk_start = offset
-                chunk_end = offset + chunk_size
-
-                print(f"Performing {self.augmentation_count} augmentations for images {chunk_start} to {chunk_end}...")
-
-                if chunk_end >= len(keys):
-                    chunk_end = -1
-
-                futures = list()
-
-                for key in keys[chunk_start:chunk_end]:
-                    futures.append(
-                        executor.submit(
-                            execute_transform, 
-                            f"{self.annotation_library.file_path}.tmp",
-                            key,
-                            self.image_augmentation_pipeline,
-                            self.augmentation_count
-                        )
-                    )
-
-                for future in concurrent.futures.as_completed(futures):
-                    try:
-                        result = future.result()
-                    except Exception as e:
-                        print(e)
-                        continue               
-
-                    for entry in result:
-                        self.annotation_library.add_entry(entry[0], "image", [entry[1]])
-                        self.annotation_library.add_entry(entry[0], "shape", entry[2])
-                        self.annotation_library.add_entry(entry[0], "bounding-boxes", entry[3])
+                for (key, image_bytes, bounding_boxes), result_size in zip(self._iterate_inputs(keys), result_sizes):
+                    # Blocks while the results in flight (computing, or waiting for the writer) would exceed the window
+                    if not window.acquire(result_size):
+                        break
 
-                    result = None
+                    future = executor.submit(execute_transform, key, image_bytes, bounding_boxes, self.image_augmentation_pipeline, self.augmentation_count)
+                    future.add_done_callback(functools.partial(_enqueue_result, results, key, result_size))
+        except BaseException:
+            # The writer commits and journals what it has, then stops
+            results.put(None)
+            writer.join()
 
-                self.annotation_library.flush()
+            raise
 
-                if chunk_end == -1:
+        writer.join()
+
+        if self.writer_error is not None:
+            raise self.writer_error
+
+        journal.complete()
+
+        return derived_annotation_library
+
+    # (key, image bytes, bounding boxes), read off of the source library a few keys at a time
+    def _iterate_inputs(self, keys):
+        for offset in range(0, len(keys), self.workers):
+            batch_keys = keys[offset:offset + self.workers]
+            batch = self.annotation_library.get_batch(batch_keys, fields=("image_bytes", "bounding_boxes"))
+
+            yield from zip(batch_keys, batch["image_bytes"], batch["bounding_boxes"])
+
+    # Runs on the writer thread, which is the only one touching the derived library. Results come in as they complete
+    def _write_results(self, derived_annotation_library, journal, results, window, result_count):
+        completed_keys = list()
+        written_count = 0
+
+        started_at = time.time()
+
+        try:
+            for _ in range(result_count):
+                item = results.get()
+
+                if item is None:
                     break
 
-                offset += chunk_size
+                key, future, result_size = item
+
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(e)
+                    result = None
+
+                for entry in result or list():
+                    derived_annotation_library.add_entry(entry[0], "image", [entry[1]])
+                    derived_annotation_library.add_entry(entry[0], "shape", entry[2])
+                    derived_annotation_library.add_entry(entry[0], "bounding-boxes", entry[3])
+
+                if result is not None:
+                    completed_keys.append(key)
 
-        self.annotation_library.commit()
+                written_count += 1
 
-        os.remove(f"{self.annotation_library.file_path}.tmp")
+                # The result is only released once it's in the library
+                future = result = None
+                window.release(result_size)
 
-        return self.annotation_library
+                if len(completed_keys) >= self.checkpoint_keys:
+                    self._checkpoint(derived_annotation_library, journal, completed_keys)
+                    completed_keys = list()
+
+                    print(f"{written_count}/{result_count} images augmented ({written_count / max(time.time() - started_at, 1e-9):.1f} images/s).")
+
+            self._checkpoint(derived_annotation_library, journal, completed_keys)
+        except BaseException as e:
+            self.writer_error = e
+
+            # Unblocks the submitting thread, which stops submitting
+            window.close()
+
+    # Keys that failed aren't journaled, so a rerun retries them
+    @staticmethod
+    def _checkpoint(derived_annotation_library, journal, keys):
+        derived_annotation_library.commit()
+        derived_annotation_library.flush()
+
+        journal.record(keys)
+
+    # Original entries are linked to the source library's images, not copied
+    # A resumed transform picks up the derived library it was writing to
+    def _open_derived_annotation_library(self, journal):
+        derived_name = self.derived_name or f"{self.annotation_library.name}_augmented"
+        derived_file_path = os.path.join(os.path.dirname(self.annotation_library.file_path), f"{derived_name}.alh5")
+
+        if os.path.isfile(derived_file_path) and journal.resumed:
+            derived_annotation_library = AnnotationLibrary.load(derived_file_path)
+
+            # Derivation commits once, at the end; an interrupted one left no entries behind
+            if len(derived_annotation_library.entries):
+                return derived_annotation_library
+
+            derived_annotation_library.close()
+        elif os.path.isfile(derived_file_path) and not self.overwrite:
+            raise AnnotationLibraryTransformerError(f"Annotation Library '{derived_file_path}' already exists. Pass 'overwrite' to replace it, or another 'derived_name'...")
+
+        for file_path in [derived_file_path, f"{os.path.splitext(derived_file_path)[0]}{PIXEL_SIDECAR_EXTENSION}"]:
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+
+        return self.annotation_library.derive(derived_name, file_path=derived_file_path)
+
+
+class InFlightWindow:
+    """
+    Bound on the bytes of results in flight between the submitting thread and the writer thread. A single result
+    larger than the window still goes through, alone.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+
+        self.in_flight_bytes = 0
+        self.closed = False
+
+        self.condition = threading.Condition()
+
+    # Waits for room; False once the window is closed
+    def acquire(self, size):
+        with self.condition:
+            self.condition.wait_for(lambda: self.closed or not self.in_flight_bytes or self.in_flight_bytes + size <= self.max_bytes)
+
+            if self.closed:
+                return False
+
+            self.in_flight_bytes += size
+
+            return True
+
+    def release(self, size):
+        with self.condition:
+            self.in_flight_bytes -= size
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+# Runs on the pool's management thread as soon as a task is done, successful or not
+def _enqueue_result(results, key, result_size, future):
+    results.put((key, future, result_size))
 
 
 # Instance Methods are not serializable by Pickle (when they have foreign data types, such as here) 
 # Using a regular function is required for multiprocessing concurrency
-def execute_transform(annotation_library_file_path, key, image_augmentation_pipeline, augmentation_count):
-    annotation_library = AnnotationLibrary.load(annotation_library_file_path, read_only=True)
+def execute_transform(key, image_bytes, bounding_boxes, image_augmentation_pipeline, augmentation_count):
     image_augmentation_pipeline = IMAGE_AUGMENTATION_PIPELINES[image_augmentation_pipeline]()
 
-    # Get the Image Data
-    image_array = annotation_library.get_image_array(key)
+    # Decode the Image Data
+    image_array = AnnotationLibrary._decode_image(image_bytes)
     height, width, channels = image_array.shape
 
-    # Get the Bounding Boxes
-    bounding_boxes = annotation_library.get_bounding_boxes(key)
-
     # Prepare the Bounding Boxes for Image Augmentation
     ia_bounding_boxes = list()
 
@@ -0,0 +1,364 @@
+import os
+import json
+import zlib
+
+import numpy as np
+
+from hurry.filesize import size, alternative
+
+from cosmoquest_data_tools.annotation_library import AnnotationLibrary, AnnotationLibraryError
+from cosmoquest_data_tools.annotation_library_statistics import AnnotationLibraryStatistics
+
+
+# Views are saved as small .npz sidecars: the parent library path, the selected positions and the selection criteria
+ANNOTATION_LIBRARY_VIEW_EXTENSION = ".alv"
+
+
+class AnnotationLibraryView:
+    """
+    A lazy subset of an Annotation Library's entries, holding nothing but an array of entry positions into its parent.
+
+        view = annotation_library.select(annotation_classes="crater", min_bounding_boxes=10)
+        view = view.select(metas=["user_a", "user_b"])
+
+    Views expose the same read API as Annotation Libraries, and can be combined with &, | and -. Entries keep the
+    order of the parent library. Writes go through to the parent, and entries added through a view join it.
+    """
+
+    def __init__(self, annotation_library, positions=None, name=None, criteria=None):
+        self.annotation_library = annotation_library
+        self.name = name or annotation_library.name
+
+        # Positions are rows of the parent's key table, so they don't move when parent entries are deleted
+        if positions is None and isinstance(annotation_library.entries, AnnotationLibraryViewEntries):
+            positions = annotation_library.entries.positions
+        elif positions is None:
+            positions = np.arange(len(annotation_library.entries))
+
+        self.positions = np.unique(np.asarray(positions, dtype="int64"))
+
+        # Every select() applied to get here, kept in the sidecar for reference
+        self.criteria = criteria or list()
+
+        self.view_file_path = None
+        self.statistics = None
+
+    @property
+    def file_path(self):
+        return self.annotation_library.file_path
+
+    @property
+    def entries(self):
+        return AnnotationLibraryViewEntries(self.annotation_library.keys, self.positions)
+
+    @property
+    def version(self):
+        return self.annotation_library.version
+
+    @property
+    def read_only(self):
+        return self.annotation_library.read_only
+
+    @property
+    def annotation_classes(self):
+        return self.annotation_library.annotation_classes
+
+    @property
+    def labels(self):
+        return self.annotation_library.labels
+
+    @property
+    def metas(self):
+        return self.annotation_library.metas
+
+    def as_json_minimal(self):
+        return {
+            "name": self.name,
+            "file_path": self.view_file_path or self.file_path,
+            "file_size": size(os.path.getsize(self.view_file_path or self.file_path), system=alternative),
+            "entry_count": len(self.entries),
+            "annotation_classes": list(self.annotation_classes),
+            "statistics": self.stored_stats(),
+            "annotation_library": self.annotation_library.name
+        }
+
+    # Unlike libraries, views have no stored statistics; they're computed from the selected bounding boxes on first use
+    def stats(self):
+        if self.statistics is None:
+            self.statistics = AnnotationLibraryStatistics()
+
+            for bounding_boxes in self._iterate_bounding_boxes():
+                self.statistics.add_entry()
+                self.statistics.replace_bounding_boxes(bounding_boxes[:0], bounding_boxes, self.labels, self.metas)
+
+        return self.statistics.as_json()
+
+    # Nothing is stored for views, so this is None until stats() computed them
+    def stored_stats(self):
+        return self.statistics.as_json() if self.statistics is not None else None
+
+    # Implemented purely in terms of the read API, so shared with AnnotationLibrary
+    as_json = AnnotationLibrary.as_json
+    as_json_entry = AnnotationLibrary.as_json_entry
+    checksum = AnnotationLibrary.checksum
+    export = AnnotationLibrary.export
+
+    # Narrow the view down to the entries matching every given criterion:
+    #   annotation_classes: Class or list of classes; entries with at least one bounding box of any of them
+    #   metas: User (meta) or list of users; entries with at least one bounding box marked by any of them
+    #   min_bounding_boxes, max_bounding_boxes: Inclusive bounds on the entry's bounding box count
+    #   keys: Explicit collection of keys
+    def select(self, annotation_classes=None, metas=None, min_bounding_boxes=None, max_bounding_boxes=None, keys=None, name=None, chunk_rows=1024):
+        criteria = {
+            "annotation_classes": [annotation_classes] if isinstance(annotation_classes, str) else annotation_classes,
+            "metas": [metas] if isinstance(metas, str) else metas,
+            "min_bounding_boxes": min_bounding_boxes,
+            "max_bounding_boxes": max_bounding_boxes
+        }
+
+        mask = np.ones(len(self.positions), dtype="bool")
+
+        if keys is not None:
+            keys = set(keys)
+            mask &= np.array([key in keys for key in self.entries], dtype="bool")
+
+        if any(value is not None for value in criteria.values()):
+            dictionary_sizes = None
+
+            for i, bounding_boxes in enumerate(self._iterate_bounding_boxes(chunk_rows)):
+                # Version 1 parents fill their dictionaries as bounding boxes are decoded, so ids are resolved again
+                # whenever they grew
+                if dictionary_sizes != (len(self.labels), len(self.metas)):
+                    dictionary_sizes = (len(self.labels), len(self.metas))
+
+                    label_ids = _dictionary_ids(self.labels, criteria["annotation_classes"])
+                    meta_ids = _dictionary_ids(self.metas, criteria["metas"])
+
+                if label_ids is not None:
+                    mask[i] &= bool(np.isin(bounding_boxes["label"], label_ids).any())
+
+                if meta_ids is not None:
+                    mask[i] &= bool(np.isin(bounding_boxes["meta"], meta_ids).any())
+
+                if min_bounding_boxes is not None:
+                    mask[i] &= len(bounding_boxes) >= min_bounding_boxes
+
+                if max_bounding_boxes is not None:
+                    mask[i] &= len(bounding_boxes) <= max_bounding_boxes
+
+        criteria = {criterion: value for criterion, value in criteria.items() if value is not None}
+
+        if keys is not None:
+            criteria["keys"] = len(keys)
+
+        return AnnotationLibraryView(self.annotation_library, self.positions[mask], name=name or self.name, criteria=[*self.criteria, criteria])
+
+    def __and__(self, other):
+        return self._combine(other, np.intersect1d(self.positions, other.positions), "&")
+
+    def __or__(self, other):
+        return self._combine(other, np.union1d(self.positions, other.positions), "|")
+
+    def __sub__(self, other):
+        return self._combine(other, np.setdiff1d(self.positions, other.positions), "-")
+
+    def get_entry(self, key, field):
+        return self.annotation_library.get_entry(self._check_key(key), field)
+
+    def get_image_bytes(self, key):
+        return self.annotation_library.get_image_bytes(self._check_key(key))
+
+    def get_image_array(self, key):
+        return self.annotation_library.get_image_array(self._check_key(key))
+
+    def get_image_shape(self, key):
+        return self.annotation_library.get_image_shape(self._check_key(key))
+
+    def get_bounding_boxes(self, key):
+        return self.annotation_library.get_bounding_boxes(self._check_key(key))
+
+    def get_bounding_boxes_array(self, key):
+        return self.annotation_library.get_bounding_boxes_array(self._check_key(key))
+
+    def get_batch(self, keys, fields=("image", "shape", "bounding_boxes"), workers=None):
+        keys = list(keys)
+
+        for key in keys:
+            self._check_key(key)
+
+        return self.annotation_library.get_batch(keys, fields=fields, workers=workers)
+
+    def query_region(self, key, y0, x0, y1, x1, contained=False):
+        return self.annotation_library.query_region(self._check_key(key), y0, x0, y1, x1, contained=contained)
+
+    def query_near(self, key, y, x, radius):
+        return self.annotation_library.query_near(self._check_key(key), y, x, radius)
+
+    def add_entry(self, key, field, data):
+        self.annotation_library.add_entry(key, field, data)
+        self._include(key)
+
+    def add_complete_entry(self, entry):
+        self.annotation_library.add_complete_entry(entry)
+        self._include(entry["file_location"].replace(".png", ""))
+
+    def delete_entry(self, key):
+        self.annotation_library.delete_entry(self._check_key(key))
+        self.positions = np.delete(self.positions, self.entries.position(key))
+        self.statistics = None
+
+    def replace_bounding_boxes(self, key, bounding_boxes):
+        self.annotation_library.replace_bounding_boxes(self._check_key(key), bounding_boxes)
+        self.statistics = None
+
+    # Zero-copy library of just the selected entries, see AnnotationLibrary.derive()
+    def derive(self, name, file_path=None, chunk_rows=1024):
+        return self.annotation_library.derive(name, file_path=file_path, keys=self.entries[:], chunk_rows=chunk_rows)
+
+    def flush(self):
+        self.annotation_library.flush()
+
+    def commit(self):
+        self.annotation_library.commit()
+
+        if self.view_file_path is not None:
+            self.save(self.view_file_path)
+
+    def compact_if_needed(self, **kwargs):
+        return self.annotation_library.compact_if_needed(**kwargs)
+
+    # Views don't own their parent, unless they were loaded from a sidecar
+    def close(self):
+        if self.view_file_path is not None:
+            self.annotation_library.close()
+
+    def save(self, name_or_path=None):
+        file_path = name_or_path or self.view_file_path or self.name
+
+        if not file_path.endswith(ANNOTATION_LIBRARY_VIEW_EXTENSION):
+            file_path = f"data/{file_path}{ANNOTATION_LIBRARY_VIEW_EXTENSION}"
+
+        # A saved view is known by its sidecar name, e.g. in AnnotationLibrary.discover()
+        self.name = file_path.split("/")[-1].replace(ANNOTATION_LIBRARY_VIEW_EXTENSION, "")
+
+        # np.savez() appends .npz to file names, but not to file objects
+        with open(f"{file_path}.tmp", "wb") as f:
+            np.savez(
+                f,
+                positions=self.positions,
+                annotation_library=np.array(self.annotation_library.file_path),
+                name=np.array(self.name),
+                criteria=np.array(json.dumps(self.criteria)),
+                keys_checksum=np.array(self._keys_checksum(), dtype="int64")
+            )
+
+        os.replace(f"{file_path}.tmp", file_path)
+
+        self.view_file_path = file_path
+
+        return file_path
+
+    def _check_key(self, key):
+        if key not in self.entries:
+            raise KeyError(f"'{key}' is not part of Annotation Library View '{self.name}'")
+
+        return key
+
+    def _include(self, key):
+        position = self.annotation_library.keys.position(key)
+
+        if key not in self.entries:
+            self.positions = np.insert(self.positions, np.searchsorted(self.positions, position), position)
+
+        self.statistics = None
+
+    def _combine(self, other, positions, operator):
+        if other.annotation_library is not self.annotation_library and other.annotation_library.file_path != self.annotation_library.file_path:
+            raise AnnotationLibraryError("Only views of the same Annotation Library can be combined...")
+
+        return AnnotationLibraryView(self.annotation_library, positions, name=self.name, criteria=[{operator: [self.criteria, other.criteria]}])
+
+    def _iterate_bounding_boxes(self, chunk_rows=1024):
+        keys = self.entries[:]
+
+        for offset in range(0, len(keys), chunk_rows):
+            yield from self.annotation_library.get_batch(keys[offset:offset + chunk_rows], fields=("bounding_boxes_array",))["bounding_boxes_array"]
+
+    # Guards sidecars against parents whose entries moved since the view was saved
+    def _keys_checksum(self):
+        return zlib.crc32("\n".join(self.entries[:]).encode("utf-8"))
+
+    @classmethod
+    def load(cls, name_or_path, **kwargs):
+        if os.path.isfile(name_or_path):
+            file_path = name_or_path
+        else:
+            file_path = f"data/{name_or_path}{ANNOTATION_LIBRARY_VIEW_EXTENSION}"
+
+            if not os.path.isfile(file_path):
+                raise FileNotFoundError(file_path)
+
+        with np.load(file_path) as data:
+            annotation_library = AnnotationLibrary.load(str(data["annotation_library"]), **kwargs)
+            view = cls(annotation_library, data["positions"], name=str(data["name"]), criteria=json.loads(str(data["criteria"])))
+
+            keys_checksum = int(data["keys_checksum"])
+
+        view.view_file_path = file_path
+
+        if len(view.positions) and view.positions[-1] >= len(annotation_library.keys) or view._keys_checksum() != keys_checksum:
+            annotation_library.close()
+            raise AnnotationLibraryError(f"The entries of '{annotation_library.file_path}' changed since Annotation Library View '{view.name}' was saved...")
+
+        return view
+
+
+class AnnotationLibraryViewEntries:
+    """
+    Read-only sequence of the keys of an Annotation Library View, resolved through the parent's key table.
+    """
+
+    def __init__(self, keys, positions):
+        self.keys = keys
+        self.positions = positions
+
+    def position(self, key):
+        position = self.keys.position(key)
+        index = int(np.searchsorted(self.positions, position))
+
+        if index == len(self.positions) or self.positions[index] != position:
+            raise KeyError(key)
+
+        return index
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.keys[position] for position in self.positions[index].tolist()]
+
+        return self.keys[int(self.positions[index])]
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __iter__(self):
+        return (self.keys[position] for position in self.positions.tolist())
+
+    def __contains__(self, key):
+        if key not in self.keys:
+            return False
+
+        position = self.keys.position(key)
+        index = int(np.searchsorted(self.positions, position))
+
+        return index < len(self.positions) and self.positions[index] == position
+
+    def __repr__(self):
+        return f"AnnotationLibraryViewEntries({len(self.positions)} values)"
+
+
+# Dictionary ids of the given values, skipping unknown ones. None when there's nothing to filter on
+def _dictionary_ids(dictionary, values):
+    if values is None:
+        return None
+
+    return np.array([dictionary.position(value) for value in values if value in dictionary], dtype="int64")
@@ -11,35 +11,419 @@ def non_maximum_suppression(bounding_boxes, overlap_threshold=0.1):
     if not isinstance(bounding_boxes, np.ndarray):
         raise TypeError("Provided 'bounding_boxes' should be a numpy array...") 
 
-    if bounding_boxes.dtype.kind == "i":
-        bounding_boxes = bounding_boxes.astype("float")
+    # Pixel-inclusive boxes, with the overlap measured over the area of the box that would be suppressed
+    keep = batched_non_maximum_suppression(bounding_boxes, overlap_threshold=overlap_threshold, scores=y1_ranks(bounding_boxes), overlap="area", inclusive=True)
 
-    mask = list()
+    return bounding_boxes[keep].astype("int")
 
-    y0 = bounding_boxes[:,0]
-    x0 = bounding_boxes[:,1]
-    y1 = bounding_boxes[:,2]
-    x1 = bounding_boxes[:,3]
 
-    area = (x1 - x0 + 1) * (y1 - y0 + 1)
-    indices = np.argsort(y1)
+# Visiting order of non_maximum_suppression() as scores: by decreasing y1, ties broken the way np.argsort() breaks them
+def y1_ranks(bounding_boxes):
+    ranks = np.empty(len(bounding_boxes), dtype="int64")
+    ranks[np.argsort(np.asarray(bounding_boxes)[:, 2])] = np.arange(len(bounding_boxes))
 
-    while len(indices) > 0:
-        last = len(indices) - 1
+    return ranks
 
-        i = indices[last]
-        mask.append(i)
 
-        yy0 = np.maximum(y0[i], y0[indices[:last]])
-        xx0 = np.maximum(x0[i], x0[indices[:last]])
-        yy1 = np.minimum(y1[i], y1[indices[:last]])
-        xx1 = np.minimum(x1[i], x1[indices[:last]])
+NMS_METHODS = ["hard", "soft", "weighted"]
+NMS_OVERLAPS = ["iou", "area"]
 
-        width = np.maximum(0, xx1 - xx0 + 1)
-        height = np.maximum(0, yy1 - yy0 + 1)
+# Boxes are suppressed step by step for as long as steps settle this share of the remaining boxes, which they do
+# while groups are mostly duplicates of a few boxes. What remains goes through the suppression graph
+NMS_STEP_YIELD = 0.1
 
-        overlap = (width * height) / area[indices[:last]]
+# Groups this large on average are sorted one by one
+NMS_SORT_GROUP_SIZE = 256
 
-        indices = np.delete(indices, np.concatenate(([last], np.where(overlap > overlap_threshold)[0])))
 
-    return bounding_boxes[mask].astype("int")
+# Non-maximum suppression of many groups of (y0, x0, y1, x1) boxes in one call; group g is the boxes
+# [group_offsets[g], group_offsets[g + 1]), and boxes only suppress boxes of their own group
+#   scores: Boxes are visited by decreasing score, or by decreasing y1 without scores
+#   method: 'hard' drops the boxes overlapping a kept one by more than 'overlap_threshold'
+#           'soft' decays their scores instead (linearly, or with a gaussian of width 'sigma'), down to 'score_threshold'
+#           'weighted' is 'hard', with every kept box replaced by the score-weighted mean of the boxes it suppressed
+#   overlap: 'iou', or 'area' for the intersection over the area of the box that would be suppressed
+#   inclusive: Coordinates are pixel-inclusive (width is x1 - x0 + 1)
+#   max_pairs: Box pairs compared at once, which bounds memory use
+# Returns the indices of the kept boxes, group by group in the order they were kept. 'soft' also returns their decayed
+# scores, 'weighted' their merged boxes
+def batched_non_maximum_suppression(bounding_boxes, group_offsets=None, overlap_threshold=0.1, scores=None, method="hard", overlap="iou", inclusive=False, soft_decay="linear", sigma=0.5, score_threshold=0.001, max_pairs=1 << 22):
+    if method not in NMS_METHODS:
+        raise ValueError(f"'method' is expected to be one of: {', '.join(NMS_METHODS)}")
+
+    if overlap not in NMS_OVERLAPS:
+        raise ValueError(f"'overlap' is expected to be one of: {', '.join(NMS_OVERLAPS)}")
+
+    boxes = np.asarray(bounding_boxes, dtype="float64").reshape(-1, 4)
+    count = len(boxes)
+
+    group_offsets = np.asarray([0, count] if group_offsets is None else group_offsets, dtype="int64")
+    groups = np.repeat(np.arange(len(group_offsets) - 1), np.diff(group_offsets))
+
+    if len(groups) != count:
+        raise ValueError("'group_offsets' should cover every bounding box, from 0 to len(bounding_boxes)...")
+
+    padding = 1.0 if inclusive else 0.0
+
+    areas = _box_areas(boxes, padding)
+    columns = np.ascontiguousarray(boxes.T)
+
+    if method == "soft":
+        if scores is None:
+            raise ValueError("Soft non-maximum suppression requires 'scores'...")
+
+        return _soft_non_maximum_suppression(columns, areas, groups, np.array(scores, dtype="float64"), overlap_threshold, overlap, padding, soft_decay, sigma, score_threshold)
+
+    # Visiting order: group by group, by decreasing score. Ties go to the first box with scores, to the last one by y1
+    if scores is None:
+        order = _visiting_order(-boxes[:, 2], groups, group_offsets, last_first=True)
+    else:
+        order = _visiting_order(-np.asarray(scores, dtype="float64"), groups, group_offsets)
+
+    # From here on boxes are in visiting order: groups are contiguous, and boxes can only suppress later ones
+    columns = columns[:, order]
+    areas = areas[order]
+    groups = groups[order]
+
+    # Position of the box that suppressed each box, -1 for the kept ones
+    suppressors = np.full(count, -1, dtype="int64")
+
+    remaining = _greedy_suppression(columns, areas, groups, np.arange(count), suppressors, overlap_threshold, overlap, padding)
+
+    if len(remaining):
+        sweep, candidate_counts = _sweep_candidates(columns[:, remaining], groups[remaining], padding)
+        _graph_suppression(columns, areas, remaining[sweep], candidate_counts, suppressors, overlap_threshold, overlap, padding, max_pairs)
+
+    keep = order[suppressors < 0]
+
+    if method == "hard":
+        return keep
+
+    # Every kept box, merged with the boxes it suppressed
+    weights = np.ones(count) if scores is None else np.asarray(scores, dtype="float64")
+
+    clusters = np.empty(count, dtype="int64")
+    clusters[order] = order[np.where(suppressors < 0, np.arange(count), suppressors)]
+
+    weight_sums = np.bincount(clusters, weights=weights, minlength=count)
+    merged_boxes = np.stack([np.bincount(clusters, weights=weights * boxes[:, column], minlength=count) for column in range(4)], axis=1)
+
+    return keep, merged_boxes[keep] / weight_sums[keep, None]
+
+
+# Sort by (group, key), ties in index order, or reverse index order with 'last_first'. A few large groups are
+# cheaper to sort one by one than all together
+def _visiting_order(keys, groups, group_offsets, last_first=False):
+    if len(keys) < NMS_SORT_GROUP_SIZE * (len(group_offsets) - 1):
+        return np.lexsort((-np.arange(len(keys)) if last_first else np.arange(len(keys)), keys, groups))
+
+    orders = [np.zeros(0, dtype="int64")]
+
+    for start, end in zip(group_offsets[:-1].tolist(), group_offsets[1:].tolist()):
+        if last_first:
+            orders.append(end - 1 - np.argsort(keys[start:end][::-1], kind="stable"))
+        else:
+            orders.append(start + np.argsort(keys[start:end], kind="stable"))
+
+    return np.concatenate(orders)
+
+
+# Groups are laid out one after the other along x, and boxes sorted by where they start. The boxes overlapping box
+# sweep[i] horizontally, and starting after it, are the next candidate_counts[i] ones of the sweep
+def _sweep_candidates(columns, groups, padding):
+    _, x0, _, x1 = columns
+
+    x_min = x0.min()
+    stride = x1.max() + padding - x_min + 1
+
+    starts = x0 - x_min + groups * stride
+    ends = x1 + padding - x_min + groups * stride
+
+    sweep = np.argsort(starts, kind="stable")
+    candidate_ends = np.searchsorted(starts[sweep], ends[sweep], side="left")
+
+    return sweep, np.maximum(candidate_ends - np.arange(len(sweep)) - 1, 0)
+
+
+# Every step keeps the first remaining box of every group and drops the ones it overlaps. Decisions are final for every box up to the kept ones, so the boxes left when steps stop paying off (in
+# visiting order) are an independent NMS problem, returned
+def _greedy_suppression(columns, areas, groups, remaining, suppressors, overlap_threshold, overlap, padding):
+    selected_by_group = np.full(groups.max() + 1 if len(groups) else 0, -1, dtype="int64")
+
+    while len(remaining):
+        remaining_groups = groups[remaining]
+
+        firsts = np.flatnonzero(np.concatenate(([True], remaining_groups[1:] != remaining_groups[:-1])))
+        selected_by_group[remaining_groups[firsts]] = remaining[firsts]
+
+        rest = np.delete(remaining, firsts)
+        partners = selected_by_group[groups[rest]]
+
+        suppressing = _box_overlaps(columns, areas, partners, rest, overlap, padding) > overlap_threshold
+        suppressors[rest[suppressing]] = partners[suppressing]
+
+        settled = len(remaining) - len(rest) + np.count_nonzero(suppressing)
+        remaining = rest[~suppressing]
+
+        if settled < NMS_STEP_YIELD * (len(remaining) + settled):
+            break
+
+    return remaining
+
+
+# Greedy NMS keeps a box when no kept box before it suppresses it. Iterating that rule from 'everything kept' over
+# the (suppressor, suppressed) pairs settles one level of the suppression graph per pass, all groups at once. Pairs
+# only come from sweep candidates, generated and measured 'max_pairs' at a time, which suits sparse groups
+def _graph_suppression(columns, areas, sweep, candidate_counts, suppressors, overlap_threshold, overlap, padding, max_pairs):
+    count = len(areas)
+
+    pair_firsts = list()
+    pair_seconds = list()
+
+    cumulative_counts = np.cumsum(candidate_counts)
+    batch_ends = np.searchsorted(cumulative_counts, np.arange(max_pairs, cumulative_counts[-1] + max_pairs, max_pairs), side="right")
+
+    batch_start = 0
+
+    for batch_end in np.unique(batch_ends).tolist():
+        if batch_end <= batch_start:
+            continue
+
+        counts = candidate_counts[batch_start:batch_end]
+
+        first = np.repeat(np.arange(batch_start, batch_end), counts)
+        second = first + 1 + np.arange(len(first)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+        # Oriented by visiting order
+        a = np.minimum(sweep[first], sweep[second])
+        b = np.maximum(sweep[first], sweep[second])
+
+        suppressing = _box_overlaps(columns, areas, a, b, overlap, padding) > overlap_threshold
+
+        pair_firsts.append(a[suppressing])
+        pair_seconds.append(b[suppressing])
+
+        batch_start = batch_end
+
+    if not pair_firsts:
+        return
+
+    pair_firsts = np.concatenate(pair_firsts)
+    pair_seconds = np.concatenate(pair_seconds)
+
+    kept = np.ones(count, dtype="bool")
+
+    while True:
+        blocked = np.zeros(count, dtype="bool")
+        blocked[pair_seconds[kept[pair_firsts]]] = True
+
+        if np.array_equal(kept, ~blocked):
+            break
+
+        kept = ~blocked
+
+    # A suppressed box belongs to the first kept box overlapping it
+    suppressing = kept[pair_firsts] & ~kept[pair_seconds]
+    pair_firsts = pair_firsts[suppressing]
+    pair_seconds = pair_seconds[suppressing]
+
+    pairs = np.lexsort((pair_firsts, pair_seconds))
+    firsts = np.concatenate(([True], pair_seconds[pairs][1:] != pair_seconds[pairs][:-1])) if len(pairs) else np.zeros(0, dtype="bool")
+
+    suppressors[pair_seconds[pairs[firsts]]] = pair_firsts[pairs[firsts]]
+
+
+# Every step keeps the best remaining box of every group and decays the scores of the others of its group
+def _soft_non_maximum_suppression(columns, areas, groups, scores, overlap_threshold, overlap, padding, soft_decay, sigma, score_threshold):
+    remaining = np.flatnonzero(scores >= score_threshold)
+    selected_by_group = np.full(groups.max() + 1 if len(groups) else 0, -1, dtype="int64")
+
+    keep = list()
+    steps = list()
+
+    step = 0
+
+    while len(remaining):
+        remaining_groups = groups[remaining]
+
+        ranked = np.lexsort((remaining, -scores[remaining], remaining_groups))
+        firsts = ranked[np.flatnonzero(np.concatenate(([True], remaining_groups[ranked][1:] != remaining_groups[ranked][:-1])))]
+
+        selected = remaining[firsts]
+        selected_by_group[groups[selected]] = selected
+
+        keep.append(selected)
+        steps.append(np.full(len(selected), step))
+
+        rest = np.delete(remaining, firsts)
+        overlaps = _box_overlaps(columns, areas, selected_by_group[groups[rest]], rest, overlap, padding)
+
+        if soft_decay == "gaussian":
+            scores[rest] *= np.exp(-(overlaps ** 2) / sigma)
+        else:
+            scores[rest] *= np.where(overlaps > overlap_threshold, 1.0 - overlaps, 1.0)
+
+        remaining = rest[scores[rest] >= score_threshold]
+        step += 1
+
+    keep = np.concatenate(keep) if keep else np.zeros(0, dtype="int64")
+    steps = np.concatenate(steps) if steps else np.zeros(0, dtype="int64")
+
+    keep = keep[np.lexsort((steps, groups[keep]))]
+
+    return keep, scores[keep]
+
+
+def _box_areas(boxes, padding):
+    return np.clip(boxes[:, 3] - boxes[:, 1] + padding, 0, None) * np.clip(boxes[:, 2] - boxes[:, 0] + padding, 0, None)
+
+
+# Overlap of boxes b with boxes a: IoU, or the intersection over the area of b. 'columns' is boxes.T, contiguous
+def _box_overlaps(columns, areas, a, b, overlap, padding):
+    y0, x0, y1, x1 = columns
+
+    height = np.minimum(y1[a], y1[b]) - np.maximum(y0[a], y0[b]) + padding
+    width = np.minimum(x1[a], x1[b]) - np.maximum(x0[a], x0[b]) + padding
+
+    intersections = np.maximum(height, 0) * np.maximum(width, 0)
+    denominators = areas[b] if overlap == "area" else areas[a] + areas[b] - intersections
+
+    return np.divide(intersections, denominators, out=np.zeros(len(intersections)), where=denominators > 0)
+
+
+# Exact k-means of 1-D values, for 1 or 2 clusters. Optimal clusters are contiguous runs of the sorted values, so the
+# split is found over prefix sums, in a single vectorised sweep. Deterministic, and equal values always share a cluster,
+# so there may be fewer clusters than requested
+# Returns the cluster of every value (numbered by increasing center) and the cluster centers
+def k_means_1d(values, clusters=2):
+    if clusters not in (1, 2):
+        raise ValueError("'clusters' is expected to be 1 or 2")
+
+    values = np.asarray(values, dtype="float64").ravel()
+
+    if not len(values):
+        return np.zeros(0, dtype="int64"), np.zeros(0, dtype="float64")
+
+    order = np.argsort(values, kind="stable")
+    sorted_values = values[order]
+
+    sums = np.concatenate(([0.0], np.cumsum(sorted_values)))
+    square_sums = np.concatenate(([0.0], np.cumsum(sorted_values ** 2)))
+
+    # Clusters can only start where the sorted values change
+    boundaries = np.flatnonzero(np.diff(sorted_values) > 0) + 1
+    clusters = max(min(clusters, len(boundaries) + 1), 1)
+
+    if clusters == 1:
+        starts = [0]
+    else:
+        costs = _sum_of_squares(sums, square_sums, 0, boundaries) + _sum_of_squares(sums, square_sums, boundaries, len(values))
+        starts = [0, int(boundaries[np.argmin(costs)])]
+
+    ends = [*starts[1:], len(values)]
+
+    sorted_labels = np.repeat(np.arange(len(starts)), np.diff([*starts, len(values)]))
+
+    labels = np.empty(len(values), dtype="int64")
+    labels[order] = sorted_labels
+
+    centers = np.array([(sums[end] - sums[start]) / (end - start) for start, end in zip(starts, ends)])
+
+    return labels, centers
+
+
+# Sum of squared deviations from the mean of sorted values [start, end)
+def _sum_of_squares(sums, square_sums, start, end):
+    return (square_sums[end] - square_sums[start]) - (sums[end] - sums[start]) ** 2 / (end - start)
+
+
+# Overlap of boxes b with boxes a, for index arrays a and b into (y0, x0, y1, x1) boxes. See batched_non_maximum_suppression()
+def box_overlaps(bounding_boxes, a, b, overlap="iou", inclusive=False):
+    boxes = np.asarray(bounding_boxes, dtype="float64").reshape(-1, 4)
+    padding = 1.0 if inclusive else 0.0
+
+    return _box_overlaps(np.ascontiguousarray(boxes.T), _box_areas(boxes, padding), a, b, overlap, padding)
+
+
+# Candidate neighbours of (y0, x0, y1, x1) boxes, as (a, b) index arrays with a < b: the pairs of boxes of the same
+# group sharing a cell of a uniform grid. Overlapping boxes always share a cell. Cells default to the median box size,
+# so boxes span a handful of cells and the pairs grow with local density rather than with the square of the count
+def grid_hash_pairs(bounding_boxes, groups=None, cell_size=None):
+    boxes = np.asarray(bounding_boxes, dtype="float64").reshape(-1, 4)
+    count = len(boxes)
+
+    if count < 2:
+        return np.zeros(0, dtype="int64"), np.zeros(0, dtype="int64")
+
+    groups = np.zeros(count, dtype="int64") if groups is None else np.asarray(groups, dtype="int64")
+
+    if cell_size is None:
+        cell_size = np.median(np.maximum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1]))
+
+    cell_size = max(float(cell_size), 1.0)
+
+    cells = np.floor((boxes - np.tile(boxes[:, :2].min(axis=0), 2)) / cell_size).astype("int64")
+    rows = np.maximum(cells[:, 2] - cells[:, 0] + 1, 1)
+    columns = np.maximum(cells[:, 3] - cells[:, 1] + 1, 1)
+
+    # One (cell, box) entry per cell a box covers
+    cell_counts = rows * columns
+    entry_boxes = np.repeat(np.arange(count), cell_counts)
+    within = np.arange(len(entry_boxes)) - np.repeat(np.cumsum(cell_counts) - cell_counts, cell_counts)
+
+    grid_rows = cells[:, 2].max() + 1
+    grid_columns = cells[:, 3].max() + 1
+
+    entry_cells = (groups[entry_boxes] * grid_rows + cells[entry_boxes, 0] + within // columns[entry_boxes]) * grid_columns + cells[entry_boxes, 1] + within % columns[entry_boxes]
+
+    # Boxes of a cell are contiguous, in index order
+    entries = np.argsort(entry_cells, kind="stable")
+    entry_cells = entry_cells[entries]
+    entry_boxes = entry_boxes[entries]
+
+    cell_ends = np.searchsorted(entry_cells, entry_cells, side="right")
+    partner_counts = cell_ends - np.arange(len(entry_cells)) - 1
+
+    first = np.repeat(np.arange(len(entry_cells)), partner_counts)
+    second = first + 1 + np.arange(len(first)) - np.repeat(np.cumsum(partner_counts) - partner_counts, partner_counts)
+
+    # Boxes sharing several cells are paired once
+    pairs = np.unique(entry_boxes[first] * count + entry_boxes[second])
+
+    return pairs // count, pairs % count
+
+
+# Connected components of 'count' nodes joined by the (a, b) edges, with union-find (union by size, path halving).
+# Returns a component label per node, numbered by first node
+def union_find(count, a, b):
+    parents = list(range(count))
+    sizes = [1] * count
+
+    def find(node):
+        while parents[node] != node:
+            parents[node] = parents[parents[node]]
+            node = parents[node]
+
+        return node
+
+    for node_a, node_b in zip(np.asarray(a).tolist(), np.asarray(b).tolist()):
+        root_a = find(node_a)
+        root_b = find(node_b)
+
+        if root_a == root_b:
+            continue
+
+        if sizes[root_a] < sizes[root_b]:
+            root_a, root_b = root_b, root_a
+
+        parents[root_b] = root_a
+        sizes[root_a] += sizes[root_b]
+
+    roots = np.array([find(node) for node in range(count)], dtype="int64")
+    _, first_nodes, labels = np.unique(roots, return_index=True, return_inverse=True)
+
+    # Renumbered so components come in the order of their first node
+    renumbering = np.empty(len(first_nodes), dtype="int64")
+    renumbering[np.argsort(first_nodes, kind="stable")] = np.arange(len(first_nodes))
+
+    return renumbering[labels.reshape(-1)]
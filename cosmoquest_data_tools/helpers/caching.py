@@ -0,0 +1,75 @@
+import collections
+
+
+class LRUCache:
+    """
+    Least-recently-used cache bounded by the total byte size of its values (NumPy arrays)
+
+    Values larger than the whole budget are never cached.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+
+        self.entries = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+
+        if value is None:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+
+        return value
+
+    def put(self, key, value):
+        if value.nbytes > self.max_bytes:
+            return
+
+        self.discard(key)
+
+        self.entries[key] = value
+        self.current_bytes += value.nbytes
+
+        while self.current_bytes > self.max_bytes:
+            _, evicted_value = self.entries.popitem(last=False)
+
+            self.current_bytes -= evicted_value.nbytes
+            self.evictions += 1
+
+    def discard(self, key):
+        value = self.entries.pop(key, None)
+
+        if value is not None:
+            self.current_bytes -= value.nbytes
+
+    def clear(self):
+        self.entries.clear()
+        self.current_bytes = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+
+        return {
+            "entries": len(self.entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0
+        }
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
@@ -0,0 +1,40 @@
+class OrderedIndex:
+    """
+    Insertion-ordered collection of unique values with constant time positional access and membership tests.
+
+    Positions are stable: a value keeps the position it was added at.
+    """
+
+    def __init__(self, values=None):
+        self.values = list()
+        self.positions = dict()
+
+        for value in values or list():
+            self.add(value)
+
+    def add(self, value):
+        if value in self.positions:
+            return self.positions[value]
+
+        self.positions[value] = len(self.values)
+        self.values.append(value)
+
+        return self.positions[value]
+
+    def position(self, value):
+        return self.positions[value]
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __contains__(self, value):
+        return value in self.positions
+
+    def __repr__(self):
+        return f"OrderedIndex({len(self.values)} values)"
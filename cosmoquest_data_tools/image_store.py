@@ -0,0 +1,175 @@
+import os
+import hashlib
+import sqlite3
+import time
+
+import concurrent.futures
+
+import numpy as np
+
+
+# Images are addressed by the hex digest of their bytes
+IMAGE_HASH_SIZE = 16  # bytes, BLAKE2b
+IMAGE_HASH_LENGTH = IMAGE_HASH_SIZE * 2
+
+# Images written less than this many seconds ago are never garbage collected, so a library writing to the store
+# doesn't lose images it hasn't committed references to yet
+GC_GRACE_PERIOD = 3600
+
+
+class ImageStoreError(BaseException):
+    pass
+
+
+class ImageStore:
+    """
+    Content-addressed store of image files, shared by the Annotation Libraries that reference it instead of embedding
+    image bytes. Images are immutable files named after their hash ({path}/{hash[:2]}/{hash}), written atomically, so
+    any number of processes can read and add images concurrently.
+
+    References are counted per library in an SQLite database ({path}/references.sqlite). Each library adds what changed
+    since its previous commit to its counts; gc() deletes the images no library references anymore. A library with
+    changes not committed yet is marked pending, so that after a crash it rebuilds its counts from scratch.
+    """
+
+    def __init__(self, path="data/image_store"):
+        self.path = path
+
+        os.makedirs(self.path, exist_ok=True)
+
+        self.connection = sqlite3.connect(os.path.join(self.path, "references.sqlite"), timeout=60)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS image_references "
+            "(library TEXT NOT NULL, hash TEXT NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (library, hash))"
+        )
+        self.connection.execute("CREATE TABLE IF NOT EXISTS pending_references (library TEXT NOT NULL PRIMARY KEY)")
+        self.connection.commit()
+
+    @staticmethod
+    def hash(image_bytes):
+        return hashlib.blake2b(image_bytes, digest_size=IMAGE_HASH_SIZE).hexdigest()
+
+    # Store the image (unless already there) and return its hash
+    def put(self, image_bytes, image_hash=None):
+        image_hash = image_hash or self.hash(image_bytes)
+        file_path = self._file_path(image_hash)
+
+        if os.path.isfile(file_path):
+            # Keeps images that get referenced again out of reach of a concurrent gc()
+            os.utime(file_path)
+            return image_hash
+
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        with open(f"{file_path}.{os.getpid()}.tmp", "wb") as f:
+            f.write(image_bytes)
+
+        os.replace(f"{file_path}.{os.getpid()}.tmp", file_path)
+
+        return image_hash
+
+    def get(self, image_hash):
+        try:
+            with open(self._file_path(image_hash), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise ImageStoreError(f"Image '{image_hash}' is missing from Image Store '{self.path}'...")
+
+    def get_many(self, image_hashes, workers=None):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(self.get, image_hashes))
+
+    # Replace all the references of a library with the given image hashes (one per entry)
+    def set_references(self, library, image_hashes):
+        image_hashes, counts = np.unique([image_hash for image_hash in image_hashes if image_hash], return_counts=True)
+
+        with self.connection:
+            self.connection.execute("DELETE FROM image_references WHERE library = ?", (library,))
+            self.connection.executemany(
+                "INSERT INTO image_references (library, hash, count) VALUES (?, ?, ?)",
+                zip([library] * len(image_hashes), image_hashes.tolist(), counts.tolist())
+            )
+            self.connection.execute("DELETE FROM pending_references WHERE library = ?", (library,))
+
+    # Add the given changes ({image hash: count change}) to the references of a library
+    def update_references(self, library, changes):
+        changes = [(count, library, image_hash) for image_hash, count in changes.items() if image_hash and count]
+
+        with self.connection:
+            self.connection.executemany("INSERT OR IGNORE INTO image_references (library, hash, count) VALUES (?, ?, 0)", [(library, image_hash) for _, library, image_hash in changes])
+            self.connection.executemany("UPDATE image_references SET count = count + ? WHERE library = ? AND hash = ?", changes)
+            self.connection.executemany("DELETE FROM image_references WHERE library = ? AND hash = ? AND count <= 0", [(library, image_hash) for _, library, image_hash in changes])
+            self.connection.execute("DELETE FROM pending_references WHERE library = ?", (library,))
+
+    # Flag a library as having reference changes that aren't in the counts yet, see update_references()
+    def mark_pending(self, library):
+        with self.connection:
+            self.connection.execute("INSERT OR IGNORE INTO pending_references (library) VALUES (?)", (library,))
+
+    def pending(self, library):
+        return self.connection.execute("SELECT COUNT(*) FROM pending_references WHERE library = ?", (library,)).fetchone()[0] > 0
+
+    # Drop all the references of a library, e.g. before deleting its file
+    def release(self, library):
+        with self.connection:
+            self.connection.execute("DELETE FROM image_references WHERE library = ?", (library,))
+            self.connection.execute("DELETE FROM pending_references WHERE library = ?", (library,))
+
+    def reference_count(self, image_hash):
+        return self.connection.execute("SELECT COALESCE(SUM(count), 0) FROM image_references WHERE hash = ?", (image_hash,)).fetchone()[0]
+
+    def stats(self):
+        image_count = 0
+        image_bytes = 0
+
+        for file_path in self._iterate_files():
+            image_count += 1
+            image_bytes += os.path.getsize(file_path)
+
+        library_count, reference_count = self.connection.execute("SELECT COUNT(DISTINCT library), COALESCE(SUM(count), 0) FROM image_references").fetchone()
+
+        return {
+            "image_count": image_count,
+            "image_bytes": image_bytes,
+            "library_count": library_count,
+            "reference_count": reference_count
+        }
+
+    # Delete unreferenced images older than 'grace_period' seconds. Returns the number of images and bytes freed
+    def gc(self, grace_period=GC_GRACE_PERIOD):
+        referenced = set(image_hash for image_hash, in self.connection.execute("SELECT DISTINCT hash FROM image_references WHERE count > 0"))
+        threshold = time.time() - grace_period
+
+        freed_images = 0
+        freed_bytes = 0
+
+        for file_path in self._iterate_files():
+            image_hash = os.path.basename(file_path)
+
+            if image_hash in referenced or os.path.getmtime(file_path) > threshold:
+                continue
+
+            freed_bytes += os.path.getsize(file_path)
+            freed_images += 1
+
+            os.remove(file_path)
+
+        return freed_images, freed_bytes
+
+    def close(self):
+        self.connection.close()
+
+    def __contains__(self, image_hash):
+        return os.path.isfile(self._file_path(image_hash))
+
+    def _file_path(self, image_hash):
+        return os.path.join(self.path, image_hash[:2], image_hash)
+
+    def _iterate_files(self):
+        for root, dirs, files in os.walk(self.path):
+            if root == self.path:
+                continue
+
+            for file in files:
+                if len(file) == IMAGE_HASH_LENGTH:
+                    yield os.path.join(root, file)
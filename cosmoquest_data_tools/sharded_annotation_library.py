@@ -0,0 +1,422 @@
+import os
+import json
+
+import numpy as np
+
+from hurry.filesize import size, alternative
+
+from cosmoquest_data_tools.annotation_library import (
+    AnnotationLibrary,
+    AnnotationLibraryError,
+    BATCH_FIELDS,
+    PIXEL_SIDECAR_EXTENSION,
+    _dictionary_map,
+    _stack_if_uniform,
+    _translate_bounding_boxes
+)
+from cosmoquest_data_tools.annotation_library_statistics import AnnotationLibraryStatistics
+from cosmoquest_data_tools.helpers.indexing import OrderedIndex
+
+
+# The manifest is a JSON file listing the shard files, relative to its own directory. Shard files live in a
+# '{name}.shards' directory next to it, so AnnotationLibrary.discover() doesn't pick them up as libraries of their own
+SHARDED_MANIFEST_EXTENSION = ".alm"
+SHARDED_MANIFEST_VERSION = 1
+
+
+class ShardedAnnotationLibrary:
+    """
+    A logical Annotation Library made of a manifest and N shard Annotation Libraries (.alh5 files).
+
+    Shards are independent files, so each worker process can write its own shard without going through the parent:
+
+        sharded = ShardedAnnotationLibrary.create(name, shard_count=4)
+        sharded.close()
+
+        # In worker i
+        annotation_library = AnnotationLibrary.load(sharded.shard_file_paths[i])
+
+        # Back in the parent, once the workers are done
+        sharded = AnnotationLibrary.load(name)
+
+    Once loaded, the shards are presented as one library, with the same 'entries' and get_* API as AnnotationLibrary.
+    Entries are ordered shard by shard, and a key may only appear in a single shard. Shard label and meta ids are
+    translated into the library-wide 'labels' and 'metas' dictionaries.
+
+    merge() and rebalance() rewrite the shards offline.
+    """
+
+    def __init__(self, name, manifest_path=None, read_only=False, **kwargs):
+        self.name = name
+        self.manifest_path = manifest_path or f"data/{name}{SHARDED_MANIFEST_EXTENSION}"
+
+        self.read_only = read_only
+
+        # Passed on to every shard: storage, image_cache_size, swmr...
+        self.shard_kwargs = kwargs
+
+        self.manifest = self._load_manifest()
+        self.shards = [AnnotationLibrary.load(file_path, read_only=read_only, **kwargs) for file_path in self.shard_file_paths]
+
+        self._populate()
+
+        self.statistics = None
+
+    @property
+    def file_path(self):
+        return self.manifest_path
+
+    @property
+    def entries(self):
+        return self.keys
+
+    @property
+    def version(self):
+        return min([shard.version for shard in self.shards], default=None)
+
+    @property
+    def shard_file_paths(self):
+        return [self._shard_file_path(shard_path) for shard_path in self.manifest["shards"]]
+
+    def as_json_minimal(self):
+        return {
+            "name": self.name,
+            "file_path": self.file_path,
+            "file_size": size(sum(os.path.getsize(file_path) for file_path in self.shard_file_paths), system=alternative),
+            "entry_count": len(self.entries),
+            "annotation_classes": list(self.annotation_classes),
+            "statistics": self.stored_stats(),
+            "shard_count": len(self.shards)
+        }
+
+    # Shard statistics are summed; they never touch entry data
+    def stats(self):
+        if self.statistics is None:
+            self.statistics = AnnotationLibraryStatistics()
+
+            for shard in self.shards:
+                self.statistics.merge(AnnotationLibraryStatistics.from_json(shard.stats()))
+
+        return self.statistics.as_json()
+
+    # None if any shard has no stored statistics; see AnnotationLibrary.stored_stats()
+    def stored_stats(self):
+        if self.statistics is None:
+            shard_statistics = [shard.stored_stats() for shard in self.shards]
+
+            if None in shard_statistics:
+                return None
+
+            self.statistics = AnnotationLibraryStatistics()
+
+            for statistics in shard_statistics:
+                self.statistics.merge(AnnotationLibraryStatistics.from_json(statistics))
+
+        return self.statistics.as_json()
+
+    # Implemented purely in terms of the read API, so shared with AnnotationLibrary
+    as_json = AnnotationLibrary.as_json
+    as_json_entry = AnnotationLibrary.as_json_entry
+    checksum = AnnotationLibrary.checksum
+    export = AnnotationLibrary.export
+    select = AnnotationLibrary.select
+
+    def shard_for(self, key):
+        return self.shards[self._key_shards[self.keys.position(key)]]
+
+    def get_entry(self, key, field):
+        return self.shard_for(key).get_entry(key, field)
+
+    def get_image_bytes(self, key):
+        return self.shard_for(key).get_image_bytes(key)
+
+    def get_image_array(self, key):
+        return self.shard_for(key).get_image_array(key)
+
+    def get_image_shape(self, key):
+        return self.shard_for(key).get_image_shape(key)
+
+    def get_bounding_boxes(self, key):
+        return self.shard_for(key).get_bounding_boxes(key)
+
+    # Structured array of BOUNDING_BOX_DTYPE; resolve 'label' and 'meta' ids through self.labels and self.metas
+    def get_bounding_boxes_array(self, key):
+        shard_index = self._key_shards[self.keys.position(key)]
+        return self._translate(shard_index, self.shards[shard_index].get_bounding_boxes_array(key))
+
+    def query_region(self, key, y0, x0, y1, x1, contained=False):
+        shard_index = self._key_shards[self.keys.position(key)]
+        return self._translate(shard_index, self.shards[shard_index].query_region(key, y0, x0, y1, x1, contained=contained))
+
+    def query_near(self, key, y, x, radius):
+        shard_index = self._key_shards[self.keys.position(key)]
+        return self._translate(shard_index, self.shards[shard_index].query_near(key, y, x, radius))
+
+    # Same as AnnotationLibrary.get_batch(): keys are grouped by shard, read with one batch per shard and put back in order
+    def get_batch(self, keys, fields=("image", "shape", "bounding_boxes"), workers=None):
+        keys = list(keys)
+
+        for field in fields:
+            if field not in BATCH_FIELDS:
+                raise KeyError(f"Unknown batch field: '{field}'. Expected one of: {', '.join(BATCH_FIELDS)}")
+
+        shard_indices = self._key_shards[np.array([self.keys.position(key) for key in keys], dtype="int64")]
+
+        batch = {field: [None] * len(keys) for field in fields}
+
+        for shard_index in np.unique(shard_indices).tolist():
+            positions = np.flatnonzero(shard_indices == shard_index).tolist()
+            shard_batch = self.shards[shard_index].get_batch([keys[i] for i in positions], fields=fields, workers=workers)
+
+            if "bounding_boxes_array" in fields:
+                shard_batch["bounding_boxes_array"] = [self._translate(shard_index, bounding_boxes) for bounding_boxes in shard_batch["bounding_boxes_array"]]
+
+            for field in fields:
+                for i, value in zip(positions, shard_batch[field]):
+                    batch[field][i] = value
+
+        if "image" in fields:
+            batch["image"] = _stack_if_uniform(batch["image"])
+
+        if "shape" in fields:
+            batch["shape"] = np.array(batch["shape"], dtype="int64").reshape(-1, 3)
+
+        return batch
+
+    # SWMR readers: pick up entries committed to the shards since the last refresh. Returns the number of new entries
+    def refresh(self):
+        entry_count = len(self.keys)
+
+        if sum(shard.refresh() for shard in self.shards):
+            self._populate()
+            self.statistics = None
+
+        return len(self.keys) - entry_count
+
+    def commit(self):
+        for shard in self.shards:
+            shard.commit()
+
+        self.statistics = None
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+    # Add an empty shard, written to by whoever opens its file. Returns the shard, opened for writing
+    def add_shard(self, **kwargs):
+        if self.read_only:
+            raise AnnotationLibraryError("Adding shards requires a writable Sharded Annotation Library...")
+
+        index = len(self.manifest["shards"])
+        shard_path = self._shard_path(self.manifest["generation"], index)
+
+        os.makedirs(os.path.dirname(self._shard_file_path(shard_path)), exist_ok=True)
+
+        annotation_library = AnnotationLibrary(f"{self.name}-{index}", file_path=self._shard_file_path(shard_path), **{**self.shard_kwargs, **kwargs})
+        annotation_library.commit()
+
+        self.manifest["shards"].append(shard_path)
+        self._write_manifest()
+
+        self.shards.append(annotation_library)
+        self._populate()
+
+        return annotation_library
+
+    # Copy every entry into a single Annotation Library, in entry order
+    # Without a destination, the result replaces this library under the same name and the shards are deleted
+    def merge(self, destination_file_path=None, chunk_rows=1024):
+        in_place = destination_file_path is None
+        destination_file_path = destination_file_path or f"{os.path.dirname(self.manifest_path)}/{self.name}.alh5"
+
+        if os.path.isfile(destination_file_path):
+            raise AnnotationLibraryError(f"'{destination_file_path}' already exists...")
+
+        self.commit()
+
+        destination = AnnotationLibrary(self.name, file_path=f"{destination_file_path}.tmp", storage=self.shards[0].storage if len(self.shards) else None)
+
+        try:
+            destination._copy_entries(self, chunk_rows=chunk_rows)
+            destination.commit()
+
+            self._verify_copy(destination, self.entries[:], chunk_rows)
+        except BaseException:
+            destination.close()
+            os.remove(destination.file_path)
+            raise
+
+        destination.close()
+
+        os.replace(f"{destination_file_path}.tmp", destination_file_path)
+
+        if in_place:
+            self.close()
+            self._delete_shards(self.shard_file_paths)
+
+            os.remove(self.manifest_path)
+
+            shards_directory = self._shard_file_path(f"{self.name}.shards")
+
+            if os.path.isdir(shards_directory) and not os.listdir(shards_directory):
+                os.rmdir(shards_directory)
+
+        print(f"Merged {len(self.shards)} shards of Annotation Library '{self.name}' into '{destination_file_path}'.")
+
+        return AnnotationLibrary(self.name, file_path=destination_file_path)
+
+    # Rewrite the entries into 'shard_count' shards of (nearly) equal entry counts, keeping the entry order
+    # New shards are written next to the current ones and swapped in by replacing the manifest
+    def rebalance(self, shard_count=None, chunk_rows=1024):
+        if self.read_only:
+            raise AnnotationLibraryError("Rebalancing requires a writable Sharded Annotation Library...")
+
+        shard_count = shard_count or len(self.shards)
+
+        self.commit()
+
+        keys = self.entries[:]
+        bounds = np.linspace(0, len(keys), shard_count + 1).astype("int64").tolist()
+
+        manifest = {**self.manifest, "generation": self.manifest["generation"] + 1, "shards": list()}
+        new_shards = list()
+
+        try:
+            for i in range(shard_count):
+                manifest["shards"].append(self._shard_path(manifest["generation"], i))
+
+                annotation_library = AnnotationLibrary(f"{self.name}-{i}", file_path=self._shard_file_path(manifest["shards"][-1]), **self.shard_kwargs)
+                new_shards.append(annotation_library)
+
+                annotation_library._copy_entries(self, keys[bounds[i]:bounds[i + 1]], chunk_rows=chunk_rows)
+                annotation_library.commit()
+
+                self._verify_copy(annotation_library, keys[bounds[i]:bounds[i + 1]], chunk_rows)
+        except BaseException:
+            for annotation_library in new_shards:
+                annotation_library.close()
+
+            self._delete_shards([annotation_library.file_path for annotation_library in new_shards])
+            raise
+
+        old_shards = self.shards
+        old_shard_file_paths = self.shard_file_paths
+
+        self.manifest = manifest
+        self._write_manifest()
+
+        for annotation_library in old_shards:
+            annotation_library.close()
+
+        self._delete_shards(old_shard_file_paths)
+
+        self.shards = new_shards
+        self._populate()
+
+        print(f"Rebalanced Annotation Library '{self.name}' from {len(old_shards)} into {shard_count} shards.")
+
+    def _shard_path(self, generation, index):
+        return f"{self.name}.shards/{generation:04d}-{index:05d}.alh5"
+
+    def _shard_file_path(self, shard_path):
+        return os.path.join(os.path.dirname(self.manifest_path), shard_path)
+
+    def _translate(self, shard_index, bounding_boxes):
+        return _translate_bounding_boxes(bounding_boxes, self._label_maps[shard_index], self._meta_maps[shard_index])
+
+    # Build the library-wide key table, dictionaries and annotation classes from the shards
+    def _populate(self):
+        self.keys = OrderedIndex()
+        self.annotation_classes = set()
+
+        self.labels = OrderedIndex()
+        self.metas = OrderedIndex()
+
+        self._label_maps = list()
+        self._meta_maps = list()
+
+        key_shards = list()
+
+        for shard_index, shard in enumerate(self.shards):
+            for key in shard.entries:
+                if key in self.keys:
+                    raise AnnotationLibraryError(f"'{key}' is in more than one shard of Sharded Annotation Library '{shard.name}'...")
+
+                self.keys.add(key)
+
+            key_shards.extend([shard_index] * len(shard.entries))
+
+            self.annotation_classes |= shard.annotation_classes
+
+            self._label_maps.append(_dictionary_map(shard.labels, self.labels))
+            self._meta_maps.append(_dictionary_map(shard.metas, self.metas))
+
+        # Global entry position => shard index
+        self._key_shards = np.array(key_shards, dtype="int64")
+
+    def _verify_copy(self, destination, keys, chunk_rows):
+        if len(destination.entries) != len(keys):
+            raise AnnotationLibraryError(f"Entry count mismatch: {len(destination.entries)} != {len(keys)}")
+
+        if destination.checksum(batch_size=chunk_rows) != self.checksum(batch_size=chunk_rows, keys=keys):
+            raise AnnotationLibraryError("Checksum mismatch; keeping the original shards...")
+
+    def _load_manifest(self):
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path, "r") as f:
+                manifest = json.load(f)
+
+            if manifest.get("version", 0) > SHARDED_MANIFEST_VERSION:
+                raise AnnotationLibraryError(f"Unsupported Sharded Annotation Library manifest version: {manifest['version']}")
+
+            return manifest
+
+        if self.read_only:
+            raise FileNotFoundError(self.manifest_path)
+
+        manifest = {"name": self.name, "version": SHARDED_MANIFEST_VERSION, "generation": 0, "shards": list()}
+
+        self.manifest = manifest
+        self._write_manifest()
+
+        return manifest
+
+    # Written to a temporary file and renamed, so readers never see a partial manifest
+    def _write_manifest(self):
+        with open(f"{self.manifest_path}.tmp", "w") as f:
+            json.dump(self.manifest, f, indent=2)
+
+        os.replace(f"{self.manifest_path}.tmp", self.manifest_path)
+
+    def _delete_shards(self, file_paths):
+        for file_path in file_paths:
+            for path in [file_path, file_path.replace(".alh5", PIXEL_SIDECAR_EXTENSION)]:
+                if os.path.isfile(path):
+                    os.remove(path)
+
+    @classmethod
+    def create(cls, name, shard_count, manifest_path=None, **kwargs):
+        sharded_annotation_library = cls(name, manifest_path=manifest_path, **kwargs)
+
+        if len(sharded_annotation_library.shards):
+            raise AnnotationLibraryError(f"Sharded Annotation Library '{name}' already exists...")
+
+        for _ in range(shard_count):
+            sharded_annotation_library.add_shard()
+
+        return sharded_annotation_library
+
+    @classmethod
+    def load(cls, name_or_path, **kwargs):
+        if os.path.isfile(name_or_path):
+            manifest_path = name_or_path
+            name = name_or_path.split("/")[-1].replace(SHARDED_MANIFEST_EXTENSION, "")
+        else:
+            name = name_or_path
+            manifest_path = f"data/{name_or_path}{SHARDED_MANIFEST_EXTENSION}"
+
+            if not os.path.isfile(manifest_path):
+                raise FileNotFoundError(manifest_path)
+
+        return cls(name, manifest_path=manifest_path, **kwargs)
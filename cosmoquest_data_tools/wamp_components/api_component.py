@@ -39,7 +39,7 @@ class APIWAMPComponent(ApplicationSession):
     async def onJoin(self, details):
 
         def list_annotation_libraries():
-            annotation_libraries = AnnotationLibrary.discover("data")
+            annotation_libraries = AnnotationLibrary.discover("data", metadata_only=True)
             return {
                 "success": [True, None],
                 "annotation_libraries": [al.as_json_minimal() for al in annotation_libraries]
@@ -47,7 +47,7 @@ class APIWAMPComponent(ApplicationSession):
 
         def get_annotation_library(annotation_library_name):
             try:
-                annotation_library = AnnotationLibrary.load(annotation_library_name, read_only=True)
+                annotation_library = AnnotationLibrary.load(annotation_library_name, read_only=True, swmr=True)
             except FileNotFoundError:
                 return {"success": [False, "Annotation Library not found"]}
 
@@ -58,7 +58,7 @@ class APIWAMPComponent(ApplicationSession):
 
         def get_annotation_library_entry(annotation_library_name, entry_index):
             try:
-                annotation_library = AnnotationLibrary.load(annotation_library_name, read_only=True)
+                annotation_library = AnnotationLibrary.load(annotation_library_name, read_only=True, swmr=True)
             except FileNotFoundError:
                 return {"success": [False, "Annotation Library not found"]}
 
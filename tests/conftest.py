@@ -0,0 +1,63 @@
+import os
+import h5py
+import pytest
+
+import numpy as np
+
+from PIL import Image
+
+
+@pytest.fixture
+def data_directory(tmp_path, monkeypatch):
+    # Annotation Libraries live in data/, relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+
+    return tmp_path / "data"
+
+
+@pytest.fixture
+def entries(data_directory):
+    return make_entries("data", 8)
+
+
+# Entries as add_complete_entry() takes them: distinct 16x16 PNGs, entry i with i bounding boxes
+def make_entries(directory, count):
+    random = np.random.RandomState(0)
+    entries = list()
+
+    for i in range(count):
+        file_location = os.path.join(directory, f"image_{i}.png")
+        Image.fromarray(random.randint(0, 255, (16, 16, 3)).astype("uint8")).save(file_location)
+
+        bounding_boxes = [
+            {"top": j, "left": j + 1, "bottom": j + 6, "right": j + 7, "annotation_class": "crater" if j % 2 else "rock", "meta": f"user{j % 3}"}
+            for j in range(i)
+        ]
+
+        entries.append({"file_location": file_location, "width": 16, "height": 16, "bounding_boxes": bounding_boxes})
+
+    return entries
+
+
+# Version 1 layout, as written before versioning was introduced: one set of datasets per key
+def make_version_1_library(file_path, entries):
+    with h5py.File(file_path, "w") as h5_file:
+        annotation_classes = set()
+
+        for entry in entries:
+            key = entry["file_location"].replace(".png", "")
+
+            with open(entry["file_location"], "rb") as f:
+                h5_file.create_dataset(f"{key}-image", data=[np.void(f.read())])
+
+            h5_file.create_dataset(f"{key}-shape", data=(entry["height"], entry["width"], 3))
+            h5_file.create_dataset(f"{key}-bounding-boxes", data=[
+                (bounding_box["top"], bounding_box["left"], bounding_box["bottom"], bounding_box["right"], bounding_box["annotation_class"].encode("utf-8"), bounding_box["meta"].encode("utf-8"))
+                for bounding_box in entry["bounding_boxes"]
+            ])
+
+            annotation_classes.update(bounding_box["annotation_class"].encode("utf-8") for bounding_box in entry["bounding_boxes"])
+
+        h5_file.create_dataset("keys", data=[entry["file_location"].replace(".png", "").encode("utf-8") for entry in entries])
+        h5_file.create_dataset("annotation_classes", data=sorted(annotation_classes))
@@ -0,0 +1,127 @@
+import os
+import pytest
+
+from cosmoquest_data_tools.annotation_library import AnnotationLibrary, AnnotationLibraryError, DERIVED_LIBRARIES_EXTENSION
+
+from conftest import make_version_1_library
+
+
+def _key(entry):
+    return entry["file_location"].replace(".png", "")
+
+
+def _image_bytes(entry):
+    with open(entry["file_location"], "rb") as f:
+        return f.read()
+
+
+def _build(name, entries):
+    annotation_library = AnnotationLibrary(name)
+
+    for entry in entries:
+        annotation_library.add_complete_entry(entry)
+
+    annotation_library.commit()
+
+    return annotation_library
+
+
+def test_migrate_version_1_library(entries):
+    make_version_1_library("data/legacy.alh5", entries)
+    make_version_1_library("data/reference.alh5", entries)
+
+    migrated = AnnotationLibrary.migrate("legacy")
+    reference = AnnotationLibrary.load("reference", read_only=True)
+
+    assert migrated.version == 2
+    assert list(migrated.entries) == [_key(entry) for entry in entries]
+    assert migrated.annotation_classes == reference.annotation_classes
+
+    for entry in entries:
+        assert migrated.get_image_bytes(_key(entry)) == _image_bytes(entry)
+        assert migrated.get_bounding_boxes(_key(entry)) == reference.get_bounding_boxes(_key(entry))
+
+    assert migrated.checksum() == reference.checksum()
+
+    migrated.close()
+    reference.close()
+
+
+def test_add_replace_delete_compact(entries):
+    annotation_library = _build("edited", entries[:6])
+
+    annotation_library.replace_bounding_boxes(_key(entries[2]), annotation_library.get_bounding_boxes(_key(entries[5])))
+    annotation_library.add_entry(_key(entries[3]), "image", [_image_bytes(entries[7])])
+    annotation_library.delete_entry(_key(entries[1]))
+    annotation_library.commit()
+
+    # The same live content, written from scratch
+    reference = _build("reference", [
+        entries[0],
+        dict(entries[2], bounding_boxes=entries[5]["bounding_boxes"]),
+        dict(entries[3], file_location=entries[7]["file_location"]),
+        entries[4],
+        entries[5]
+    ])
+
+    checksum = reference.checksum()
+
+    assert annotation_library.checksum() == checksum
+
+    annotation_library.compact()
+
+    assert list(annotation_library.entries) == [_key(entry) for entry in [entries[0], *entries[2:6]]]
+    assert annotation_library.checksum() == checksum
+
+    annotation_library.close()
+
+    assert AnnotationLibrary.load("edited", read_only=True).checksum() == checksum
+
+    reference.close()
+
+
+def test_compact_source_of_derived_library(entries):
+    source = _build("source", entries)
+
+    derived = source.derive("derived")
+    derived.derive("derived_twice").close()
+
+    image_bytes = [derived.get_image_bytes(key) for key in derived.entries]
+    derived.close()
+
+    source.delete_entry(_key(entries[1]))
+    source.add_entry(_key(entries[2]), "image", [_image_bytes(entries[7])])
+    source.commit()
+    source.compact()
+
+    for name in ["derived", "derived_twice"]:
+        annotation_library = AnnotationLibrary.load(name, read_only=True)
+        assert [annotation_library.get_image_bytes(key) for key in annotation_library.entries] == image_bytes
+        annotation_library.close()
+
+    source.dedupe("data/image_store")
+
+    for name in ["derived", "derived_twice"]:
+        annotation_library = AnnotationLibrary.load(name, read_only=True)
+        assert annotation_library.get_batch(annotation_library.entries[:], fields=("image_bytes",))["image_bytes"] == image_bytes
+        annotation_library.close()
+
+    source.close()
+
+
+def test_compact_source_of_unregistered_derived_library(entries):
+    source = _build("source", entries)
+    source.derive("derived").close()
+
+    os.remove(f"{source.file_path}{DERIVED_LIBRARIES_EXTENSION}")
+
+    source.delete_entry(_key(entries[0]))
+    source.compact()
+
+    derived = AnnotationLibrary.load("derived", read_only=True)
+
+    with pytest.raises(AnnotationLibraryError):
+        derived.get_image_bytes(_key(entries[3]))
+
+    derived.close()
+    source.close()
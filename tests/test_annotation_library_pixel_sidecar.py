@@ -0,0 +1,39 @@
+import numpy as np
+
+from PIL import Image
+
+from cosmoquest_data_tools.annotation_library import AnnotationLibrary
+
+
+def test_pixel_sidecar_after_delete(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+
+    annotation_library = AnnotationLibrary("pixels")
+    image_arrays = dict()
+
+    for i in range(6):
+        image_array = np.full((8, 8, 3), i * 40, dtype="uint8")
+        Image.fromarray(image_array).save(tmp_path / f"k{i}.png")
+
+        annotation_library.add_complete_entry({"file_location": str(tmp_path / f"k{i}.png"), "width": 8, "height": 8, "bounding_boxes": list()})
+        image_arrays[str(tmp_path / f"k{i}")] = image_array
+
+    annotation_library.commit()
+
+    deleted_key = str(tmp_path / "k1")
+    annotation_library.delete_entry(deleted_key)
+    annotation_library.commit()
+
+    annotation_library.materialize_pixels()
+
+    for key in annotation_library.entries:
+        assert np.array_equal(annotation_library.get_image_array(key), image_arrays[key])
+
+    keys = list(annotation_library.entries)
+    batch = annotation_library.get_batch(keys, fields=("image",))["image"]
+
+    for key, image_array in zip(keys, batch):
+        assert np.array_equal(image_array, image_arrays[key])
+
+    annotation_library.close()
@@ -0,0 +1,23 @@
+from cosmoquest_data_tools.annotation_library import AnnotationLibrary
+from cosmoquest_data_tools.annotation_library_view import AnnotationLibraryView
+
+from conftest import make_version_1_library
+
+
+def test_select_on_version_1_library(entries):
+    make_version_1_library("data/legacy.alh5", entries)
+
+    # Freshly opened: the label and meta dictionaries are empty until bounding boxes are decoded
+    annotation_library = AnnotationLibrary.load("legacy", read_only=True)
+    view = AnnotationLibraryView(annotation_library)
+
+    craters = view.select(annotation_classes="crater")
+    user2 = view.select(metas=["user2"])
+
+    assert sorted(craters.entries) == sorted(entry["file_location"].replace(".png", "") for entry in entries[2:])
+    assert sorted(user2.entries) == sorted(entry["file_location"].replace(".png", "") for entry in entries[3:])
+    assert not len(view.select(annotation_classes="boulder").entries)
+
+    assert len(view.select(annotation_classes="rock", max_bounding_boxes=3).entries) == 3
+
+    annotation_library.close()